@@ -0,0 +1,255 @@
+"""batch_gen.py: generate conditional examples in vectorized batches
+
+gen_cond_examples(n) draws the random parameters of n instances at once as
+NumPy arrays (buffer lengths, indices, characters, variable orders and line
+positions), and computes the BUFWRITE_COND_* and BUFWRITE_TAUT_* labels
+from them in vectorized form, at several hundred thousand instances/sec.
+
+Only the labels and parameters are batched. Code is rendered on demand, one
+instance at a time, by replaying the drawn values through
+gen_cond_example.gen_cond_example_from_skeleton, so the rendered instances
+follow exactly the layout logic of the generator; rendering runs at about
+the rate of generate_instance with skeletons (see benchmarks.py), i.e.
+tens of thousands of instances/sec, so workloads which only need the labels
+and values should read the arrays and skip rendering.
+
+A batch is its own random stream: for a given seed, it does not reproduce
+the instances of gen_cond_example.generate_instance, but it follows the same
+distribution.
+
+Requires numpy.
+"""
+
+import cond_template as templates
+import gen_cond_example as gen
+
+from sa_tag import Tag
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; only this module needs it
+    np = None
+
+# number of draws made by each dummy insertion, in order: dum_len, dum_idx,
+# char, buf_dec_idx, before_control_flow, 3 setup idxes, buf_set_idx
+NUM_DUMMY_DRAWS = 9
+
+# number of rows of draws converted to lists at a time while iterating
+RENDER_BLOCK_ROWS = 4096
+
+# dtype of the tag arrays, whose unused entries are -1
+TAG_DTYPE = "int8"
+
+
+class _ReplayRng(object):
+    """Stand-in for random.Random which replays drawn values in order
+
+    randrange() returns the next value, choice() the item at the next value
+    and shuffle() applies the next MAX_NUM_VARS values as a permutation.
+    """
+
+    def __init__(self, draws):
+        """
+        Args:
+            draws (list of int): values in the order they are drawn
+        """
+        self._draws = draws
+        self._pos = 0
+
+    def randrange(self, start, stop=None):
+        if stop is None:
+            start, stop = 0, start
+        value = self._draws[self._pos]
+        self._pos += 1
+        if not start <= value < stop:
+            raise ValueError("Replayed draw {} out of range({}, {})".format(
+                value, start, stop))
+        return value
+
+    def choice(self, seq):
+        value = self._draws[self._pos]
+        self._pos += 1
+        return seq[value]
+
+    def shuffle(self, x):
+        perm = self._draws[self._pos:self._pos + len(x)]
+        self._pos += len(x)
+        x[:] = [x[itm] for itm in perm]
+
+
+class ExampleBatch(object):
+    """Parameters and labels of a batch of instances, rendered on demand
+
+    The draws and values are stored in the narrowest unsigned dtype holding
+    every drawn value (uint8 with the default settings), the tags as int8.
+
+    Attributes (arrays with one row per instance):
+        buf_len, idx_init, thresh, true_idx, false_idx: values of the
+            conditional buffer write
+        num_dummies: number of dummy buffer writes
+        dum_len, dum_idx: values of each dummy slot, (n, MAX_NUM_DUMMIES);
+            slots at or past num_dummies are unused
+        cond_tags: Tag value of the conditional buffer write, or -1 if
+            include_cond_bufwrite is False
+        taut_tags: Tag value of each dummy buffer write,
+            (n, MAX_NUM_DUMMIES); -1 for unused slots
+    """
+
+    def __init__(self, draws, num_dummies, include_cond_bufwrite, labels):
+        self._draws = draws
+        self.include_cond_bufwrite = include_cond_bufwrite
+        self.num_dummies = num_dummies
+        for name, value in labels.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self._draws)
+
+    def _render(self, draws):
+        """Render the instance of a row of draws, as a list of int"""
+        return gen.gen_cond_example_from_skeleton(
+            include_cond_bufwrite=self.include_cond_bufwrite,
+            rng=_ReplayRng(draws))
+
+    def instance(self, i):
+        """Render instance i
+
+        Returns:
+            instance_str (str): str of code example
+            tags (list of Tag): tag for each line representing buffer safety
+        """
+        return self._render(self._draws[i].tolist())
+
+    def __iter__(self):
+        """Render the instances in order, converting the draws in blocks"""
+        for start in range(0, len(self), RENDER_BLOCK_ROWS):
+            for draws in self._draws[start:start + RENDER_BLOCK_ROWS].tolist():
+                yield self._render(draws)
+
+
+def _get_setup_draws(rng, n):
+    """Draw the setup line positions of _insert_setup_lines
+
+    The number of setup lines only depends on COND_DEC_INIT_PAIRS, so the
+    range of every draw is the same for all instances.
+
+    Returns:
+        columns (list of array): one column of draws per randrange call
+        num_setup_lines (int)
+    """
+    columns = []
+    num_setup_lines = 0
+    for (_, init_str) in templates.COND_DEC_INIT_PAIRS:
+        num_lines = 1 if init_str is None else 2
+        for _ in range(num_lines):
+            columns.append(rng.integers(0, num_setup_lines + 1, size=n))
+        num_setup_lines += num_lines
+    return columns, num_setup_lines
+
+
+def gen_cond_examples(n, rng=None, include_cond_bufwrite=True):
+    """Draw the parameters and labels of n conditional examples at once
+
+    Args:
+        n (int): number of instances
+        rng (numpy.random.Generator or int): source of randomness, or a seed
+            for numpy.random.default_rng; if None, then seed from the OS
+        include_cond_bufwrite (bool): whether to include the
+            control flow-sensitive buffer write
+
+    Returns:
+        batch (ExampleBatch)
+    """
+    if np is None:
+        raise ImportError("gen_cond_examples requires numpy")
+    rng = np.random.default_rng(rng)
+    max_idx = gen.MAX_IDX
+    max_dummies = gen.MAX_NUM_DUMMIES
+    num_setup_lines = sum(1 if init_str is None else 2
+                          for (_, init_str) in templates.COND_DEC_INIT_PAIRS)
+    num_main_lines = len(templates.COND_MAIN_LINES)
+    max_num_lines = (num_setup_lines + num_main_lines + 1 +
+                     4 * max_dummies)
+    dtype = np.min_scalar_type(max(max_idx, len(gen.CHARSET),
+                                   gen.MAX_NUM_VARS, max_num_lines + 1))
+    draws = np.empty((n, gen.MAX_NUM_VARS + 6 + num_setup_lines + 1 +
+                      max_dummies * NUM_DUMMY_DRAWS), dtype=dtype)
+    num_columns = 0
+
+    def add_columns(columns):
+        """Store columns of draws, in the order they are replayed"""
+        nonlocal num_columns
+        for column in columns:
+            draws[:, num_columns] = column
+            num_columns += 1
+
+    # _get_anon_vars: uniform permutations of the variable names
+    add_columns(np.argsort(rng.random((n, gen.MAX_NUM_VARS)), axis=1).T)
+
+    # values of the conditional buffer write and its label
+    buf_len, idx_init, thresh, true_idx, false_idx = rng.integers(
+        0, max_idx, size=(5, n)).astype(dtype)
+    add_columns([buf_len, idx_init, thresh, true_idx, false_idx,
+                 rng.integers(0, len(gen.CHARSET), size=n)])
+    cond = idx_init < thresh
+    cond_safe = np.where(cond, true_idx < buf_len, false_idx < buf_len)
+    if include_cond_bufwrite:
+        cond_tags = np.where(cond_safe, Tag.BUFWRITE_COND_SAFE.value,
+                             Tag.BUFWRITE_COND_UNSAFE.value).astype(TAG_DTYPE)
+    else:
+        cond_tags = np.full(n, -1, dtype=TAG_DTYPE)
+
+    setup_columns, _ = _get_setup_draws(rng, n)
+    add_columns(setup_columns)
+
+    min_num_dummies = (0 if include_cond_bufwrite
+                       else gen.MIN_NUM_DUMMIES_TAUTONLY)
+    num_dummies = rng.integers(min_num_dummies, max_dummies + 1,
+                               size=n).astype(dtype)
+    add_columns([num_dummies])
+
+    # body length and control flow bounds, as _get_lines sets them up
+    num_lines = np.full(n, num_setup_lines + num_main_lines +
+                        int(include_cond_bufwrite))
+    control_flow_start = np.full(n, num_setup_lines)
+    control_flow_end = np.full(n, num_setup_lines + num_main_lines)
+
+    dum_len = rng.integers(0, max_idx, size=(n, max_dummies)).astype(dtype)
+    dum_idx = rng.integers(0, max_idx, size=(n, max_dummies)).astype(dtype)
+    taut_tags = np.where(dum_idx < dum_len, Tag.BUFWRITE_TAUT_SAFE.value,
+                         Tag.BUFWRITE_TAUT_UNSAFE.value).astype(TAG_DTYPE)
+    for slot in range(max_dummies):
+        # _insert_referential_dummy, vectorized over the batch
+        active = slot < num_dummies
+        taut_tags[~active, slot] = -1
+        before = rng.integers(0, 2, size=n) == 0  # choice([True, False])
+        range_start = np.where(before, 0, control_flow_end)
+        range_end = np.where(before, control_flow_start + 1, num_lines + 1)
+        setup_idxes = rng.integers(range_start, range_end, size=(3, n))
+        buf_set_idx = rng.integers(setup_idxes.max(axis=0), num_lines + 1)
+        add_columns([dum_len[:, slot], dum_idx[:, slot],
+                     rng.integers(0, len(gen.CHARSET), size=n),
+                     rng.integers(0, 3, size=n),
+                     np.where(before, 0, 1)])
+        add_columns(setup_idxes)
+        add_columns([buf_set_idx])
+
+        idxes = np.vstack([setup_idxes, buf_set_idx])
+        control_flow_start = control_flow_start + active * (
+            idxes <= control_flow_start).sum(axis=0)
+        control_flow_end = control_flow_end + active * (
+            idxes < control_flow_end).sum(axis=0)
+        num_lines = num_lines + 4 * active
+
+    labels = {
+        "buf_len": buf_len,
+        "idx_init": idx_init,
+        "thresh": thresh,
+        "true_idx": true_idx,
+        "false_idx": false_idx,
+        "dum_len": dum_len,
+        "dum_idx": dum_idx,
+        "cond_tags": cond_tags,
+        "taut_tags": taut_tags
+    }
+    return ExampleBatch(draws, num_dummies, include_cond_bufwrite, labels)
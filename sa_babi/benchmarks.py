@@ -0,0 +1,436 @@
+"""benchmarks.py: benchmarks of the generator's hot paths
+
+Reports instances/sec (best of -repeat runs) and peak traced memory of
+per-instance generation, rendering, filename hashing and end-to-end main(),
+at several numbers of instances and dummies, and can save the results as
+JSON to compare runs over time.
+
+e.g.
+    python sa_babi/benchmarks.py -output bench.json
+    python sa_babi/benchmarks.py render hash
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gen_cond_example as gen
+
+from sa_tag import Tag
+
+# number of instances per benchmark
+DEFAULT_NUM_INSTANCES = 2000
+
+# number of repetitions; the best time is reported
+DEFAULT_REPEAT = 5
+
+# seed of the instances to benchmark on
+BENCH_SEED = 0
+
+# numbers of dummies inserted by the assembly benchmark; each adds 4 lines
+ASSEMBLY_NUM_DUMMIES = [2, 16, 64, 256, 1024, 2500]
+
+# values of MAX_NUM_DUMMIES for the generation benchmark
+GENERATE_MAX_NUM_DUMMIES = [0, 2, 8, 32]
+
+# values of MAX_NUM_DUMMIES for the main() benchmark
+MAIN_MAX_NUM_DUMMIES = [2, 8]
+
+# numbers of instances of the main() benchmark, relative to -num_instances
+MAIN_SIZE_FACTORS = [0.1, 1, 10]
+
+
+def _best_time(func, repeat):
+    """Get the lowest wall time of repeat calls of func, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak_memory(func):
+    """Get the peak memory traced by tracemalloc during a call of func"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _throughput(func, num_instances, repeat):
+    """Measure a function which handles num_instances instances
+
+    The time is measured without tracing; memory in a separate traced call.
+
+    Returns:
+        result (dict): instances/sec and peak memory in bytes
+    """
+    return {
+        "inst_per_sec": num_instances / _best_time(func, repeat),
+        "peak_mem_bytes": _peak_memory(func)
+    }
+
+
+@contextlib.contextmanager
+def _max_num_dummies(max_num_dummies):
+    """Temporarily generate up to max_num_dummies dummies per instance
+
+    MAX_NUM_VARS is raised as needed, as every dummy takes two variables.
+    """
+    saved = gen.MAX_NUM_DUMMIES, gen.MAX_NUM_VARS
+    gen.MAX_NUM_DUMMIES = max_num_dummies
+    gen.MAX_NUM_VARS = max(gen.MAX_NUM_VARS, 3 + 2 * max_num_dummies)
+    try:
+        yield
+    finally:
+        gen.MAX_NUM_DUMMIES, gen.MAX_NUM_VARS = saved
+
+
+def bench_generate(num_instances=DEFAULT_NUM_INSTANCES,
+                   repeat=DEFAULT_REPEAT):
+    """Per-instance generation (sampling, assembly, rendering) throughput
+
+    Returns:
+        result (dict): throughput at each value of MAX_NUM_DUMMIES
+    """
+    result = {}
+    for max_num_dummies in GENERATE_MAX_NUM_DUMMIES:
+        with _max_num_dummies(max_num_dummies):
+            result["max_dummies_{:02d}".format(max_num_dummies)] = _throughput(
+                lambda: [gen.generate_instance(BENCH_SEED, index)
+                         for index in range(num_instances)],
+                num_instances, repeat)
+    return result
+
+
+def bench_skeletons(num_instances=DEFAULT_NUM_INSTANCES,
+                    repeat=DEFAULT_REPEAT):
+    """Generation from cached skeletons against line-by-line assembly
+
+    Every timed run starts with an empty skeleton cache.
+
+    Returns:
+        result (dict): throughput of both modes, the speedup and the cache
+            hit rate at each value of MAX_NUM_DUMMIES
+    """
+    def _generate(skeletons):
+        gen._get_skeleton.cache_clear()
+        return [gen.generate_instance(BENCH_SEED, index, skeletons=skeletons)
+                for index in range(num_instances)]
+
+    result = {}
+    for max_num_dummies in GENERATE_MAX_NUM_DUMMIES:
+        with _max_num_dummies(max_num_dummies):
+            if _generate(False) != _generate(True):
+                raise ValueError("Skeletons changed the output")
+            cache_info = gen._get_skeleton.cache_info()
+            assembled = num_instances / _best_time(
+                lambda: _generate(False), repeat)
+            skeletons = num_instances / _best_time(
+                lambda: _generate(True), repeat)
+        result["max_dummies_{:02d}".format(max_num_dummies)] = {
+            "assembled_inst_per_sec": assembled,
+            "skeleton_inst_per_sec": skeletons,
+            "speedup": skeletons / assembled,
+            "cache_hit_rate": cache_info.hits / num_instances
+        }
+    return result
+
+
+def bench_hash(num_instances=DEFAULT_NUM_INSTANCES, repeat=DEFAULT_REPEAT):
+    """Filename hashing throughput of _generate_file_name
+
+    Returns:
+        result (dict): throughput
+    """
+    instance_strs = [gen.generate_instance(BENCH_SEED, index)[0]
+                     for index in range(num_instances)]
+    return _throughput(
+        lambda: [gen._generate_file_name(itm) for itm in instance_strs],
+        num_instances, repeat)
+
+
+def bench_main(num_instances=DEFAULT_NUM_INSTANCES, repeat=DEFAULT_REPEAT):
+    """End-to-end throughput of main(), writing files and the manifest
+
+    Returns:
+        result (dict): throughput at each number of instances and value of
+            MAX_NUM_DUMMIES
+    """
+    result = {}
+    for factor in MAIN_SIZE_FACTORS:
+        size = max(1, int(num_instances * factor))
+        for max_num_dummies in MAIN_MAX_NUM_DUMMIES:
+            outdir = tempfile.mkdtemp(prefix="sa_babi_bench_")
+            try:
+                args = gen._get_args([
+                    outdir, '-num_instances', str(size),
+                    '-seed', str(BENCH_SEED),
+                    '-metadata_file', os.path.join(outdir, "manifest.json")])
+                with _max_num_dummies(max_num_dummies):
+                    key = "instances_{:07d}_max_dummies_{:02d}".format(
+                        size, max_num_dummies)
+                    result[key] = _throughput(lambda: gen.main(args), size,
+                                              repeat)
+            finally:
+                shutil.rmtree(outdir)
+    return result
+
+
+def _legacy_get_instance_str(lines, substitutions, func_tmpl_str, tags):
+    """The string.Template based rendering which _get_instance_str replaced"""
+    substitutions = dict(substitutions)
+    lines = [string.Template(itm).substitute(substitutions) for itm in lines]
+    body = "\n".join("    " + line for line in lines)
+    substitutions['body'] = body
+    instance_str = string.Template(func_tmpl_str).substitute(substitutions)
+    lines = instance_str.split("\n")
+    max_linelen = max(len(line) for line in lines)
+    fmt_str = "{:<{width}} // {}"
+    lines = [fmt_str.format(line, tag, width=max_linelen)
+             for (line, tag) in zip(lines, tags)]
+    return "\n".join(lines)
+
+
+def _get_render_inputs(num_instances):
+    """Get the arguments _get_instance_str is called with for some instances
+
+    Returns:
+        inputs (list of tuple): (lines, substitutions, func_tmpl_str, tags)
+    """
+    inputs = []
+    get_instance_str = gen._get_instance_str
+
+    def record(lines, substitutions, func_tmpl_str, tags,
+               tags_as_comments=True):
+        inputs.append((lines, dict(substitutions), func_tmpl_str, tags))
+        return get_instance_str(lines, substitutions, func_tmpl_str, tags,
+                                tags_as_comments)
+
+    gen._get_instance_str = record
+    try:
+        for index in range(num_instances):
+            gen.generate_instance(BENCH_SEED, index)
+    finally:
+        gen._get_instance_str = get_instance_str
+    return inputs
+
+
+def bench_render(num_instances=DEFAULT_NUM_INSTANCES, repeat=DEFAULT_REPEAT):
+    """Rendering throughput of _get_instance_str, against string.Template
+
+    Returns:
+        result (dict): instances/sec of both renderers and the speedup
+    """
+    inputs = _get_render_inputs(num_instances)
+    for args in inputs:
+        if gen._get_instance_str(*args) != _legacy_get_instance_str(*args):
+            raise AssertionError("Render plans changed the output")
+
+    legacy = _best_time(
+        lambda: [_legacy_get_instance_str(*args) for args in inputs], repeat)
+    plans = _best_time(
+        lambda: [gen._get_instance_str(*args) for args in inputs], repeat)
+    return {
+        "num_instances": num_instances,
+        "template_inst_per_sec": num_instances / legacy,
+        "plan_inst_per_sec": num_instances / plans,
+        "speedup": legacy / plans
+    }
+
+
+def _legacy_insert_referential_dummy(lines, dummy_vars, body_tags,
+                                     control_flow_start, control_flow_end,
+                                     rng):
+    """The slicing based insertion which _insert_referential_dummy replaced"""
+    dum_len = rng.randrange(gen.MAX_IDX)
+    dum_idx = rng.randrange(gen.MAX_IDX)
+    dum_buf_var = dummy_vars.pop()
+    dum_int_var = dummy_vars.pop()
+    buf_dec_line = "char %s[%s];" % (dum_buf_var, dum_len)
+    idx_dec_line = "int %s;" % dum_int_var
+    idx_init_line = "%s = %s;" % (dum_int_var, dum_idx)
+    buf_set_line = "%s[%s] = '%s';" % (dum_buf_var, dum_int_var,
+                                       rng.choice(gen.CHARSET))
+    setup_lines = [idx_dec_line, idx_init_line]
+    buf_dec_idx = rng.randrange(3)
+    setup_lines = (setup_lines[:buf_dec_idx] + [buf_dec_line] +
+                   setup_lines[buf_dec_idx:])
+    if rng.choice([True, False]):
+        range_start = 0
+        range_end = control_flow_start + 1
+    else:
+        range_start = control_flow_end
+        range_end = len(lines) + 1
+    setup_idxes = sorted([rng.randrange(range_start, range_end)
+                          for _ in range(3)])
+    buf_set_idx = rng.randrange(max(setup_idxes), len(lines) + 1)
+    d_start = 0
+    d_end = 0
+    for idx in setup_idxes + [buf_set_idx]:
+        if idx <= control_flow_start:
+            d_start += 1
+        if idx < control_flow_end:
+            d_end += 1
+    control_flow_start += d_start
+    control_flow_end += d_end
+    lines = (lines[:setup_idxes[0]] + [setup_lines[0]] +
+             lines[setup_idxes[0]:setup_idxes[1]] + [setup_lines[1]] +
+             lines[setup_idxes[1]:setup_idxes[2]] + [setup_lines[2]] +
+             lines[setup_idxes[2]:buf_set_idx] + [buf_set_line] +
+             lines[buf_set_idx:])
+    bufwrite_tag = (Tag.BUFWRITE_TAUT_SAFE if dum_idx < dum_len
+                    else Tag.BUFWRITE_TAUT_UNSAFE)
+    body_tags = (body_tags[:setup_idxes[0]] + [Tag.BODY] +
+                 body_tags[setup_idxes[0]:setup_idxes[1]] + [Tag.BODY] +
+                 body_tags[setup_idxes[1]:setup_idxes[2]] + [Tag.BODY] +
+                 body_tags[setup_idxes[2]:buf_set_idx] + [bufwrite_tag] +
+                 body_tags[buf_set_idx:])
+    return lines, dummy_vars, body_tags, control_flow_start, control_flow_end
+
+
+def _assemble_legacy(num_dummies):
+    """Insert num_dummies dummies into a body by slicing"""
+    rng = random.Random(BENCH_SEED)
+    lines = ["setup;"] * 3 + ["control;"] * 6
+    body_tags = [Tag.BODY] * len(lines)
+    dummy_vars = [gen.VAR_STR % itm for itm in range(2 * num_dummies)]
+    control_flow_start, control_flow_end = 3, 8
+    for _ in range(num_dummies):
+        (lines, dummy_vars, body_tags, control_flow_start, control_flow_end
+         ) = _legacy_insert_referential_dummy(
+            lines, dummy_vars, body_tags, control_flow_start,
+            control_flow_end, rng)
+    return lines, body_tags
+
+
+def _assemble(num_dummies):
+    """Insert num_dummies dummies into a body with gen._BodyLines"""
+    rng = random.Random(BENCH_SEED)
+    lines = ["setup;"] * 3 + ["control;"] * 6
+    body = gen._BodyLines(lines, [Tag.BODY] * len(lines))
+    dummy_vars = [gen.VAR_STR % itm for itm in range(2 * num_dummies)]
+    body.control_flow_start, body.control_flow_end = 3, 8
+    gen._insert_dummies(body, dummy_vars, num_dummies, rng)
+    return body.materialize()
+
+
+def bench_assembly(num_instances=DEFAULT_NUM_INSTANCES,
+                   repeat=DEFAULT_REPEAT):
+    """Time to assemble bodies of growing length, against slicing
+
+    Each size is assembled often enough to add up to about num_instances
+    bodies of typical length.
+
+    Returns:
+        result (dict): lines/sec of both assemblers at each body length
+    """
+    result = {}
+    for num_dummies in ASSEMBLY_NUM_DUMMIES:
+        if _assemble(num_dummies) != _assemble_legacy(num_dummies):
+            raise AssertionError("_BodyLines changed the output")
+        num_lines = len(_assemble(num_dummies)[0])
+        count = max(1, num_instances * 2 // num_dummies)
+        legacy = _best_time(
+            lambda: [_assemble_legacy(num_dummies) for _ in range(count)],
+            repeat)
+        log = _best_time(
+            lambda: [_assemble(num_dummies) for _ in range(count)], repeat)
+        key = "lines_{:05d}".format(num_lines)
+        result[key + "_slicing_lines_per_sec"] = num_lines * count / legacy
+        result[key + "_log_lines_per_sec"] = num_lines * count / log
+    return result
+
+
+BENCHMARKS = {
+    "assembly": bench_assembly,
+    "generate": bench_generate,
+    "hash": bench_hash,
+    "main": bench_main,
+    "render": bench_render,
+    "skeletons": bench_skeletons
+}
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help=("Benchmarks to run, out of {}; default: "
+                              "all".format(", ".join(sorted(BENCHMARKS)))),
+                        metavar="<name>")
+    parser.add_argument('-num_instances',
+                        help=("(int) Number of instances per benchmark; default "
+                              "{}".format(DEFAULT_NUM_INSTANCES)),
+                        default=DEFAULT_NUM_INSTANCES,
+                        type=int,
+                        metavar="<int>")
+    parser.add_argument('-repeat',
+                        help=("(int) Number of repetitions, the best time is "
+                              "reported; default {}".format(DEFAULT_REPEAT)),
+                        default=DEFAULT_REPEAT,
+                        type=int,
+                        metavar="<int>")
+    parser.add_argument('-output',
+                        help="(str) Path of a JSON file to save the results to",
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Run the benchmarks and print their results
+
+    Returns: 0 if no error
+    """
+    names = args.benchmarks or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark: '{}'".format(name))
+    results = {}
+    for name in names:
+        result = BENCHMARKS[name](args.num_instances, args.repeat)
+        results[name] = result
+        print(name)
+        _print_result(result, 1)
+
+    if args.output is not None:
+        report = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "num_instances": args.num_instances,
+            "repeat": args.repeat,
+            "results": results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+def _print_result(result, depth):
+    """Print a (nested) dict of results, indented by depth"""
+    indent = "    " * depth
+    for key, value in sorted(result.items()):
+        if isinstance(value, dict):
+            print(indent + key)
+            _print_result(value, depth + 1)
+        else:
+            print("{}{:<36} {:.6g}".format(indent, key, value))
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
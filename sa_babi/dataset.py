@@ -0,0 +1,193 @@
+"""dataset.py: stream generated examples in process, without writing files
+
+CondExampleDataset yields (instance_str, tag_values) records generated on the
+fly, e.g. inside the workers of a data loader:
+
+    dataset = CondExampleDataset(seed=0, num_instances=12000, dedup=True)
+    for instance_str, tag_values in dataset:
+        ...
+
+Instances are split between workers by filename hash (worker w takes the
+instances whose hash % num_workers is w), so equal instances always go to the
+same worker and no two workers yield the same instance. Each worker therefore
+generates every instance of the run and keeps its own share: the workers
+split the records, not the generating work. Generation uses the cached
+skeletons of gen_cond_example_from_skeleton to make up for part of that.
+With dedup, the records of all workers together are exactly the instances
+written by gen_cond_example.main() with the same seed.
+
+If torch is installed, CondExampleDataset is a torch.utils.data
+.IterableDataset and finds its worker id from torch.utils.data.get_worker_info.
+"""
+
+import itertools
+import os
+import queue
+import threading
+
+import dedup_index
+import gen_cond_example as gen
+
+try:
+    import torch.utils.data as torch_data
+except ImportError:  # torch is optional; without it the dataset is iterable
+    torch_data = None
+
+_DatasetBase = torch_data.IterableDataset if torch_data else object
+
+
+def iter_examples(seed=gen.DEFAULT_SEED, num_instances=None,
+                  include_cond_bufwrite=True, dedup=False, worker_id=0,
+                  num_workers=1, tags_as_comments=True):
+    """Yield the records of one worker's share of a run
+
+    Args:
+        seed (int): seed of the run
+        num_instances (int): number of records of all workers together;
+            if None, then yield without end
+        include_cond_bufwrite (bool): whether to include the
+            control flow-sensitive buffer write
+        dedup (bool): whether to skip instances whose filename hash
+            (gen_cond_example._generate_file_name of the clean source) was
+            already drawn at an earlier index, as main() does. The hashes of
+            all instances of the run, not only this worker's, are kept in a
+            dedup_index.FnameSet: 11 to 21 bytes per instance, so e.g. under
+            25 MB for a million instances; without end, it grows by that much
+            per instance
+        worker_id (int): number of this worker, in [0, num_workers)
+        num_workers (int): number of workers sharing the run
+        tags_as_comments (bool): whether each line ends with its tag as a
+            comment; if False, then the tags are only in tag_values
+
+    Yields:
+        instance_str (str): str of code example
+        tag_values (list of int): value of the tag of each line
+    """
+    if not 0 <= worker_id < num_workers:
+        raise ValueError("worker_id {} not in [0, {})".format(
+            worker_id, num_workers))
+
+    fnames = dedup_index.FnameSet(gen.FNAME_HASHLEN) if dedup else None
+    # number of records of all workers together so far
+    num_records = 0
+    try:
+        for index in itertools.count():
+            if num_instances is not None and num_records >= num_instances:
+                return
+            instance_str, tags = gen.generate_instance(
+                seed, index, include_cond_bufwrite, skeletons=True,
+                tags_as_comments=False)
+            fname = gen._generate_file_name(instance_str)
+            if dedup:
+                if fname in fnames:
+                    # Collision, try again
+                    continue
+                fnames.add(fname)
+            num_records += 1
+            if int(os.path.splitext(fname)[0], 16) % num_workers != worker_id:
+                continue
+            if tags_as_comments:
+                instance_str = gen.annotate_instance(instance_str, tags)
+            yield instance_str, [tag.value for tag in tags]
+    finally:
+        if fnames is not None:
+            fnames.close()
+
+
+def _prefetch(records, depth):
+    """Yield from records, generated ahead by a background thread
+
+    Args:
+        records (iterator): records to prefetch
+        depth (int): maximum number of records generated ahead
+    """
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def _put(item):
+        """Put an item into the queue unless the consumer stopped"""
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for record in records:
+                if not _put(("record", record)):
+                    return
+            _put(("end", None))
+        except Exception as error:  # re-raised in the consumer
+            _put(("error", error))
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+class CondExampleDataset(_DatasetBase):
+    """Iterable of generated (instance_str, tag_values) records"""
+
+    def __init__(self, seed=gen.DEFAULT_SEED, num_instances=None,
+                 include_cond_bufwrite=True, dedup=False, prefetch=0,
+                 worker_id=None, num_workers=None, tags_as_comments=True):
+        """
+        Args:
+            seed (int): seed of the run
+            num_instances (int): number of records of all workers together;
+                if None, then iterate without end
+            include_cond_bufwrite (bool): whether to include the
+                control flow-sensitive buffer write
+            dedup (bool): whether to skip instances with a filename hash
+                drawn at an earlier index (see iter_examples)
+            prefetch (int): if positive, then generate up to this many
+                records ahead in a background thread
+            worker_id (int): number of this worker; if None, then taken from
+                torch.utils.data.get_worker_info, or 0 without torch
+            num_workers (int): number of workers; if None, then likewise
+            tags_as_comments (bool): whether each line ends with its tag as
+                a comment
+        """
+        if prefetch < 0:
+            raise ValueError("prefetch must not be negative: {}".format(
+                prefetch))
+        self.seed = seed
+        self.num_instances = num_instances
+        self.include_cond_bufwrite = include_cond_bufwrite
+        self.dedup = dedup
+        self.prefetch = prefetch
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.tags_as_comments = tags_as_comments
+
+    def _get_worker(self):
+        """Get (worker_id, num_workers) of the current worker"""
+        if self.worker_id is not None or self.num_workers is not None:
+            return self.worker_id or 0, self.num_workers or 1
+        worker_info = (torch_data.get_worker_info()
+                       if torch_data is not None else None)
+        if worker_info is None:
+            return 0, 1
+        return worker_info.id, worker_info.num_workers
+
+    def __iter__(self):
+        worker_id, num_workers = self._get_worker()
+        records = iter_examples(self.seed, self.num_instances,
+                                self.include_cond_bufwrite, self.dedup,
+                                worker_id, num_workers, self.tags_as_comments)
+        if self.prefetch:
+            return _prefetch(records, self.prefetch)
+        return records
@@ -0,0 +1,160 @@
+"""dataset_stats.py: mergeable statistics of a generated dataset
+
+With --dataset_stats, gen_cond_example.main() keeps a DatasetStats while it
+generates, from the values it samples anyway, and saves it as JSON
+(dataset_stats.json, next to the manifest):
+    counters    attempts, instances, collisions, excluded and
+                canonical_duplicates, as in run_stats.py, and the number of
+                lines with each tag
+    histograms  number of lines and of dummies per instance, and the
+                sampled buf_len, idx_init, thresh, true_idx, false_idx,
+                dum_len and dum_idx; each maps a value to its count
+    derived     collision rate, canonical duplicate rate and tag
+                fractions, recomputed from the counters on every save
+
+Counters and histograms add up, so the stats of the slices of a run (see
+shard_plan.py) merge into those of the whole run:
+    python sa_babi/dataset_stats.py merged.json slice-0/dataset_stats.json ...
+Duplicates across slices, which shard_plan.py merge drops, are still
+counted in the merged stats.
+"""
+
+import argparse
+import collections
+import json
+import sys
+
+from sa_tag import Tag
+
+# name of the stats file written next to the manifest
+STATS_FNAME = "dataset_stats.json"
+
+_DUMMY_TAGS = frozenset([Tag.BUFWRITE_TAUT_SAFE.value,
+                         Tag.BUFWRITE_TAUT_UNSAFE.value])
+
+
+class DatasetStats(object):
+    """Counters and histograms of the instances of a dataset"""
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(collections.Counter)
+
+    def count(self, name, num=1):
+        """Add num to the counter name"""
+        self.counters[name] += num
+
+    def add_instance(self, tag_values, sampled_values=None):
+        """Add a written instance
+
+        Args:
+            tag_values (list of int): value of the tag of each line
+            sampled_values (dict): name -> list of the values sampled for
+                the instance, see run_stats.StageTimer.observe
+        """
+        self.counters["instances"] += 1
+        self.histograms["num_lines"][len(tag_values)] += 1
+        self.histograms["num_dummies"][
+            sum(1 for value in tag_values if value in _DUMMY_TAGS)] += 1
+        tag_counts = collections.Counter(tag_values)
+        for tag_value, num in tag_counts.items():
+            self.counters[Tag(tag_value).name] += num
+        if sampled_values:
+            for name, values in sampled_values.items():
+                self.histograms[name].update(values)
+
+    def merge(self, other):
+        """Add the counters and histograms of other to these"""
+        self.counters.update(other.counters)
+        for name, histogram in other.histograms.items():
+            self.histograms[name].update(histogram)
+
+    def summary(self):
+        """Get the stats as a JSON-serializable dict"""
+        attempts = self.counters["attempts"]
+        num_lines = sum(self.counters[tag.name] for tag in Tag)
+        return {
+            "counters": dict(self.counters),
+            "histograms": {
+                name: {str(value): num for (value, num)
+                       in sorted(histogram.items())}
+                for (name, histogram) in sorted(self.histograms.items())
+            },
+            "derived": {
+                "collision_rate": (self.counters["collisions"] / attempts
+                                   if attempts else 0.0),
+                "canonical_duplicate_rate": (
+                    self.counters["canonical_duplicates"] / attempts
+                    if attempts else 0.0),
+                "tag_fractions": {
+                    tag.name: (self.counters[tag.name] / num_lines
+                               if num_lines else 0.0)
+                    for tag in Tag
+                }
+            }
+        }
+
+    @classmethod
+    def from_summary(cls, summary):
+        """Rebuild the stats saved by write(); derived values are ignored"""
+        stats = cls()
+        stats.counters.update(summary["counters"])
+        for name, histogram in summary["histograms"].items():
+            stats.histograms[name].update(
+                {int(value): num for (value, num) in histogram.items()})
+        return stats
+
+    def write(self, path):
+        """Save the summary as JSON"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+def load(path):
+    """Load the DatasetStats saved at path"""
+    with open(path) as f:
+        return DatasetStats.from_summary(json.load(f))
+
+
+class NullDatasetStats(object):
+    """DatasetStats which records nothing, used when stats are off"""
+
+    def count(self, name, num=1):
+        pass
+
+    def add_instance(self, tag_values, sampled_values=None):
+        pass
+
+
+NULL_DATASET_STATS = NullDatasetStats()
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Merge the dataset stats of several runs or slices")
+    parser.add_argument('out_file',
+                        help="(str) Path of the merged stats to write",
+                        metavar="<path>")
+    parser.add_argument('stats_files',
+                        help="(str) Paths of the dataset_stats.json files to merge",
+                        nargs='+',
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Merge args.stats_files into args.out_file
+
+    Returns: 0 if no error
+    """
+    merged = DatasetStats()
+    for path in args.stats_files:
+        merged.merge(load(path))
+    merged.write(args.out_file)
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
@@ -0,0 +1,385 @@
+"""dedup_index.py: persistent index of the instances of earlier datasets
+
+An index directory holds one file per named dataset, e.g. train.idx for the
+seed-0 training set, with the filename hashes of all of its instances. A new
+run loads the sets it must be disjoint from (e.g. the test set run excludes
+'train') and rejects every instance whose filename is already in one of
+them, without reading any .c file.
+
+Each set file is a header (magic, number of hashes) followed by the filename
+hashes as sorted little-endian uint64. The files are memory-mapped, and
+since the hashes are uniformly distributed, interpolation search finds a hash
+in a handful of probes, whatever the size of the set.
+
+FnameSet is the set of the filenames of the run in progress, for the
+collision check of gen_cond_example.main(): an open-addressing hash table
+of the same uint64 keys, 8 bytes a slot, optionally memory-mapped from a
+file instead of held in memory.
+
+e.g. register a dataset from its manifest:
+    python sa_babi/dedup_index.py index_dir train work_directory/manifest.json
+"""
+
+import argparse
+import array
+import heapq
+import mmap
+import os
+import struct
+import sys
+
+import manifest
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; it only speeds up sorting the keys
+    np = None
+
+# identifies the file format and its version
+MAGIC = b"SADEDUP1"
+
+# magic, number of hashes
+HEADER = struct.Struct("<8sQ")
+
+# suffix of the set files in an index directory
+INDEX_SUFFIX = ".idx"
+
+# initial number of slots of a FnameSet; a power of 2
+MIN_CAPACITY = 1 << 16
+
+# fraction of the slots of a FnameSet in use above which it doubles
+MAX_LOAD = 0.75
+
+# number of keys sorted at a time by write_dataset_set without numpy
+SORT_RUN_KEYS = 1 << 20
+
+
+def _fname_to_key(fname):
+    """Get the filename hash of an instance filename as int"""
+    return int(os.path.splitext(fname)[0], 16)
+
+
+def _get_set_path(index_dir, name):
+    """Get the path of the set file of a named dataset"""
+    return os.path.join(index_dir, name + INDEX_SUFFIX)
+
+
+def write_dataset_set(index_dir, name, fnames):
+    """Add a named dataset to an index directory, replacing any of that name
+
+    Args:
+        index_dir (str): path of the index directory; created if missing
+        name (str): name of the dataset, e.g. 'train'
+        fnames (iterable of str): filenames of the instances of the dataset
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    keys = _sort_unique(array.array('Q', map(_fname_to_key, fnames)))
+    if sys.byteorder != 'little':
+        keys.byteswap()
+    path = _get_set_path(index_dir, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys)))
+        f.write(keys.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _sort_unique(keys):
+    """Sort an array of uint64 keys and drop repeated ones
+
+    The keys stay in arrays, 8 bytes each: numpy sorts them if it is
+    installed; otherwise runs of SORT_RUN_KEYS keys are sorted one at a
+    time and merged.
+
+    Args:
+        keys (array.array of 'Q')
+
+    Returns:
+        keys (array.array of 'Q'): the distinct keys, in increasing order
+    """
+    if np is not None:
+        unique = array.array('Q')
+        unique.frombytes(np.unique(np.frombuffer(keys,
+                                                 dtype=np.uint64)).tobytes())
+        return unique
+    runs = [array.array('Q', sorted(keys[start:start + SORT_RUN_KEYS]))
+            for start in range(0, len(keys), SORT_RUN_KEYS)]
+    del keys
+    unique = array.array('Q')
+    for key in heapq.merge(*runs):
+        if not unique or unique[-1] != key:
+            unique.append(key)
+    return unique
+
+
+def list_datasets(index_dir):
+    """Get the names of the datasets in an index directory"""
+    return sorted(os.path.splitext(fname)[0]
+                  for fname in os.listdir(index_dir)
+                  if fname.endswith(INDEX_SUFFIX))
+
+
+class _DatasetSet(object):
+    """Memory-mapped set of filename hashes of one dataset"""
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise NotImplementedError("Dedup indices are little-endian")
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, num_keys = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError("Not a dedup index: '{}'".format(path))
+        self._keys = memoryview(self._mmap)[
+            HEADER.size:HEADER.size + 8 * num_keys].cast('Q')
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        """Interpolation search for key, falling back to bisection"""
+        keys = self._keys
+        low = 0
+        high = len(keys) - 1
+        if high < 0 or not keys[low] <= key <= keys[high]:
+            return False
+        while low <= high:
+            low_key = keys[low]
+            high_key = keys[high]
+            if key < low_key or key > high_key:
+                return False
+            if high_key == low_key:
+                mid = low
+            else:
+                mid = low + (key - low_key) * (high - low) // (
+                    high_key - low_key)
+            mid_key = keys[mid]
+            if mid_key == key:
+                return True
+            if mid_key < key:
+                low = mid + 1
+            else:
+                high = mid - 1
+        return False
+
+    def close(self):
+        self._keys.release()
+        self._mmap.close()
+        self._file.close()
+
+
+class FnameSet(object):
+    """Set of instance filenames, stored as uint64 filename hashes
+
+    A Python set of filename strings costs well over 100 bytes per instance;
+    this table costs 8 bytes per slot, i.e. 11 to 21 bytes per instance
+    with MAX_LOAD 0.75. Keys are filename hashes, so they are already
+    uniformly distributed and the slot is the low bits of the key, with
+    linear probing. Slot value 0 marks an empty slot; key 0 is kept apart.
+    """
+
+    def __init__(self, name_len, path=None):
+        """
+        Args:
+            name_len (int): number of bytes in each filename hash, at most 8
+            path (str): file to memory-map the table from, removed on
+                close(); if None, then the table is held in memory
+        """
+        if not 0 < name_len <= 8:
+            raise ValueError("name_len must be in [1, 8]: {}".format(
+                name_len))
+        if sys.byteorder != 'little':
+            raise NotImplementedError("Filename sets are little-endian")
+        self.name_len = name_len
+        self.path = path
+        self._len = 0
+        self._has_zero = False
+        self._slots, self._mmap, self._file = self._new_table(MIN_CAPACITY,
+                                                              path)
+        self._mask = MIN_CAPACITY - 1
+
+    @staticmethod
+    def _new_table(capacity, path):
+        """Create an empty table of capacity slots
+
+        Args:
+            capacity (int): number of slots; a power of 2
+            path (str): file to memory-map the table from, or None
+
+        Returns:
+            slots (memoryview of uint64), mmap (mmap.mmap or None),
+            file (file or None)
+        """
+        if path is None:
+            return memoryview(bytearray(8 * capacity)).cast('Q'), None, None
+        table_file = open(path, 'w+b')
+        table_file.truncate(8 * capacity)
+        table_mmap = mmap.mmap(table_file.fileno(), 8 * capacity)
+        return memoryview(table_mmap).cast('Q'), table_mmap, table_file
+
+    @staticmethod
+    def _close_table(slots, table_mmap, table_file):
+        """Release a table of _new_table"""
+        slots.release()
+        if table_mmap is not None:
+            table_mmap.close()
+            table_file.close()
+
+    def _find(self, key):
+        """Get the slot of key, or the empty slot where it belongs"""
+        slots = self._slots
+        mask = self._mask
+        slot = key & mask
+        while True:
+            slot_key = slots[slot]
+            if slot_key == key or slot_key == 0:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _grow(self):
+        """Double the number of slots, rehashing the keys into a new table
+
+        The keys go straight from the old table to the new one; a file-backed
+        table is built in <path>.tmp, which then replaces the old file.
+        """
+        old_table = (self._slots, self._mmap, self._file)
+        capacity = 2 * (self._mask + 1)
+        tmp_path = self.path + ".tmp" if self.path is not None else None
+        self._slots, self._mmap, self._file = self._new_table(capacity,
+                                                              tmp_path)
+        self._mask = capacity - 1
+        slots = self._slots
+        for key in old_table[0]:
+            if key:
+                slots[self._find(key)] = key
+        self._close_table(*old_table)
+        if tmp_path is not None:
+            os.replace(tmp_path, self.path)
+
+    def __contains__(self, fname):
+        key = _fname_to_key(fname)
+        if key == 0:
+            return self._has_zero
+        return self._slots[self._find(key)] == key
+
+    def add(self, fname):
+        """Add an instance filename"""
+        key = _fname_to_key(fname)
+        if key == 0:
+            self._len += not self._has_zero
+            self._has_zero = True
+            return
+        slot = self._find(key)
+        if self._slots[slot] == key:
+            return
+        self._slots[slot] = key
+        self._len += 1
+        if self._len > MAX_LOAD * (self._mask + 1):
+            self._grow()
+
+    def update(self, fnames):
+        """Add several instance filenames"""
+        for fname in fnames:
+            self.add(fname)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        """Yield the filenames, in no particular order"""
+        fname_str = "{:0%dx}.c" % (2 * self.name_len)
+        if self._has_zero:
+            yield fname_str.format(0)
+        for key in self._slots:
+            if key:
+                yield fname_str.format(key)
+
+    def close(self):
+        """Release the table and remove its file, if any"""
+        self._close_table(self._slots, self._mmap, self._file)
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DedupIndex(object):
+    """Query the union of some named datasets of an index directory"""
+
+    def __init__(self, index_dir, names):
+        """
+        Args:
+            index_dir (str): path of the index directory
+            names (list of str): names of the datasets to query
+
+        Raises:
+            ValueError: if a dataset is not in the index directory
+        """
+        self._sets = []
+        for name in names:
+            path = _get_set_path(index_dir, name)
+            if not os.path.isfile(path):
+                self.close()
+                raise ValueError(
+                    "No dataset '{}' in dedup index '{}'; it has: {}".format(
+                        name, index_dir, ", ".join(list_datasets(index_dir))))
+            self._sets.append(_DatasetSet(path))
+
+    def __contains__(self, fname):
+        """Whether an instance filename is in any of the datasets"""
+        key = _fname_to_key(fname)
+        return any(key in dataset_set for dataset_set in self._sets)
+
+    def __len__(self):
+        return sum(len(dataset_set) for dataset_set in self._sets)
+
+    def close(self):
+        """Unmap the set files"""
+        for dataset_set in self._sets:
+            dataset_set.close()
+        self._sets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Register a generated dataset in a dedup index")
+    parser.add_argument('index_dir',
+                        help="(str) Path of the index directory",
+                        metavar="<path>")
+    parser.add_argument('name',
+                        help="(str) Name of the dataset, e.g. train",
+                        metavar="<name>")
+    parser.add_argument('metadata_file',
+                        help=("(str) Path of the manifest.json of the dataset, or "
+                              "of its manifest stream (.jsonl)"),
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Register the dataset of args.metadata_file as args.name
+
+    Returns: 0 if no error
+    """
+    fnames = (fname for (fname, _)
+              in manifest.iter_manifest_tags(args.metadata_file))
+    write_dataset_set(args.index_dir, args.name, fnames)
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
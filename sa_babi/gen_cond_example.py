@@ -1,15 +1,30 @@
 """gen_cond_example.py: generate fv_for_examples"""
 
 import argparse
+import collections
+import contextlib
+import functools
 import hashlib
+import multiprocessing
+import operator
 import os
 import random
+import re
+import signal
 import string
 import sys
 import json
+import math
 
 
 import cond_template as templates
+import dataset_stats
+import dedup_index
+import manifest
+import run_stats
+import shards
+import tag_store
+import writers
 
 from sa_tag import Tag
 
@@ -32,9 +47,20 @@ MAX_IDX = 100
 # set of available characters to write to buffer
 CHARSET = string.digits + string.ascii_letters
 
+# character literal replacing those of CHARSET in canonical forms
+CANONICAL_CHAR_LITERAL = "'?'"
+
 # the number of bytes in each hash filename
 FNAME_HASHLEN = 5  # ?
 
+# maximum number of skeletons kept by _get_skeleton: one per setup layout
+# and value of include_cond_bufwrite, i.e. 60, fit with room to spare
+SKELETON_CACHE_SIZE = 256
+
+# step between the phases of the dummy label sequences of consecutive
+# instances, see _get_taut_phase: the golden ratio, minus 1
+TAUT_PHASE_STEP = (5 ** 0.5 - 1) / 2
+
 # command-line argument default values
 # number of instances to generate
 DEFAULT_NUM_INSTANCES = 12000
@@ -42,10 +68,63 @@ DEFAULT_NUM_INSTANCES = 12000
 # random seed
 DEFAULT_SEED = 0
 
+# number of worker processes
+DEFAULT_NUM_WORKERS = 1
+
+# number of instances handed to a worker process at a time
+WORKER_CHUNKSIZE = 256
+
+# number of shard files; 0 means one .c file per instance
+DEFAULT_NUM_SHARDS = 0
+
+# number of instances between checkpoints
+DEFAULT_CHECKPOINT_EVERY = 10000
+
+# number of writer threads; 0 means writing each instance before the next
+DEFAULT_WRITER_THREADS = 0
 
-def gen_cond_example(include_cond_bufwrite=True):
+# maximum number of generated instances waiting for a writer thread
+DEFAULT_WRITE_QUEUE_DEPTH = 1024
+
+# which variants of each instance to write: "annotated" (tag comments at the
+# end of each line), "clean" (no comments; the tags only go to the metadata)
+# or "both" (clean in outdir, annotated in outdir/ANNOTATED_DIRNAME)
+VARIANTS = ("annotated", "clean", "both")
+DEFAULT_VARIANTS = "annotated"
+
+# subdirectory of outdir for the annotated variant with -variants both
+ANNOTATED_DIRNAME = "annotated"
+
+# file of the canonical hashes of the instances, one per line, written next
+# to the metadata_file (or in outdir) with --canonical_dedup
+CANONICAL_NAMES_FNAME = "canonical_names.txt"
+
+
+def gen_cond_example(include_cond_bufwrite=True, rng=random,
+                     timer=run_stats.NULL_TIMER, cond_safe_ratio=None,
+                     taut_safe_ratio=None, tags_as_comments=True,
+                     index=None):
     """Generate conditional example
 
+    Args:
+        include_cond_bufwrite (bool): whether to include the
+            control flow-sensitive buffer write
+        rng (random.Random): source of randomness; defaults to the global
+            random module
+        timer (run_stats.StageTimer): charged with the sampling, assembly
+            and render stages; records nothing by default
+        cond_safe_ratio (float): fraction of instances whose conditional
+            buffer write is safe; if None, then it follows from independent
+            uniform draws (0.495)
+        taut_safe_ratio (float): fraction of dummy buffer writes that are
+            safe; if None, then likewise
+        tags_as_comments (bool): if True, then add the tag of each line as a
+            comment at its end; the draws are the same either way
+        index (int): index of the instance in its run; with a ratio, the
+            labels follow from it (see _get_safe_label) instead of being
+            drawn. If None, then each label is drawn, safe with the
+            probability of its ratio
+
     Returns:
         instance_str (str): str of code example
         tags (list of Tag): tag for each line representing buffer safety
@@ -71,17 +150,74 @@ def gen_cond_example(include_cond_bufwrite=True):
     BUFWRITE_LINES = ["$buf_var[$idx_var] = '$char';"]
     """
 
-    anon_vars = _get_anon_vars()  # 生成10个随机的变量名
+    substitutions, dummy_vars, safe = _sample_cond_values(rng,
+                                                          cond_safe_ratio,
+                                                          index)
+    _observe_cond_values(timer, substitutions)
+
+    # 主条件语句模板
+    main_lines = templates.COND_MAIN_LINES
+
+    # 条件语句声明和初始化模板
+    dec_init_pairs = templates.COND_DEC_INIT_PAIRS
+    timer.split("sampling")
+
+    # 进一步整合汇聚
+    # 1.当include_cond_bufwrite为真时，main_lines将添加cond_buf_write行
+    # 2.随机插入若干buf_write干扰组合
+    return _assemble_general_example(dec_init_pairs, main_lines, dummy_vars,
+                                     safe, substitutions,
+                                     include_cond_bufwrite, rng, timer,
+                                     taut_safe_ratio, tags_as_comments,
+                                     index)
+
+
+def _observe_cond_values(timer, substitutions):
+    """Record the sampled values of the conditional with timer.observe"""
+    for name in ("buf_len", "idx_init", "thresh", "true_idx", "false_idx"):
+        timer.observe(name, substitutions[name])
+
+
+def _sample_cond_values(rng=random, cond_safe_ratio=None, index=None):
+    """Draw the variable names and values of a conditional example
+
+    Args:
+        rng (random.Random): source of randomness
+        cond_safe_ratio (float): see gen_cond_example
+        index (int): see gen_cond_example
+
+    Returns:
+        substitutions (dict): names to substitute into the templates
+        dummy_vars (list of str): variable names left for dummies
+        safe (bool): whether the conditional buffer write is safe
+    """
+    anon_vars = _get_anon_vars(rng)  # 生成10个随机的变量名
 
     # 给模板中所有的变量赋值
     buf_var, idx_var, thresh_var = anon_vars[:3]  # 获取前三个变量名 缓存变量，索引变量 阈值变量
     dummy_vars = anon_vars[3:]  # 获取剩余的变量名（作伪装用）
-    buf_len = random.randrange(MAX_IDX)  # 随机获取一个缓存的长度
-    idx_init = random.randrange(MAX_IDX)  # 随机获取一个初始索引
-    thresh = random.randrange(MAX_IDX)  # 随机获取一个合法阈值索引
-    true_idx = random.randrange(MAX_IDX)  # 正确的索引
-    false_idx = random.randrange(MAX_IDX)  # 错误的索引
-    char = _get_char()  # 随机获取一个数字或字母字符
+    if cond_safe_ratio is None:
+        buf_len = rng.randrange(MAX_IDX)  # 随机获取一个缓存的长度
+        idx_init = rng.randrange(MAX_IDX)  # 随机获取一个初始索引
+        thresh = rng.randrange(MAX_IDX)  # 随机获取一个合法阈值索引
+        true_idx = rng.randrange(MAX_IDX)  # 正确的索引
+        false_idx = rng.randrange(MAX_IDX)  # 错误的索引
+    else:
+        # set the label first, then draw the values uniformly among those
+        # with that label; only the index of the branch taken decides it
+        idx_init = rng.randrange(MAX_IDX)
+        thresh = rng.randrange(MAX_IDX)
+        if index is None:
+            label = rng.random() < cond_safe_ratio
+        else:
+            label = _get_safe_label(index, cond_safe_ratio)
+        buf_len, taken_idx = _sample_len_idx(label, rng)
+        other_idx = rng.randrange(MAX_IDX)
+        if idx_init < thresh:
+            true_idx, false_idx = taken_idx, other_idx
+        else:
+            true_idx, false_idx = other_idx, taken_idx
+    char = _get_char(rng)  # 随机获取一个数字或字母字符
     substitutions = {
         'buf_var': buf_var,  # 缓存变量
         'idx_var': idx_var,  # 索引变量即为最终索引的索引值
@@ -94,9 +230,6 @@ def gen_cond_example(include_cond_bufwrite=True):
         'char': char
     }
 
-    # 主条件语句模板
-    main_lines = templates.COND_MAIN_LINES
-
     # 下面是cond_buf_write代码安全(未溢出)的2种情况：
     # 1.cond为真，且true_idx<buf_len
     # 2.cond为假，且false_idex<buf_len
@@ -104,20 +237,248 @@ def gen_cond_example(include_cond_bufwrite=True):
     cond = idx_init < thresh
     safe = ((cond and (true_idx < buf_len)) or
             (not cond and (false_idx < buf_len)))
+    return substitutions, dummy_vars, safe
+
+
+def gen_cond_example_from_skeleton(include_cond_bufwrite=True, rng=random,
+                                   timer=run_stats.NULL_TIMER,
+                                   cond_safe_ratio=None,
+                                   taut_safe_ratio=None,
+                                   tags_as_comments=True, index=None):
+    """Generate conditional example from the cached skeleton of its layout
+
+    Before dummies are added, the structure of an instance (the order of its
+    lines and which of them is the buffer write) only depends on its setup
+    layout, of which there are 30. The skeleton of each layout is assembled
+    and compiled into format strings once (see _get_skeleton), and an
+    instance fills in its variable names and values with one formatting
+    operation instead of assembling and rendering line by line.
+
+    The dummy buffer writes are then placed among the format strings of the
+    skeleton lines by _insert_dummies: their layouts are too many to cache
+    (thousands with one dummy, and nearly all distinct with two), but their
+    lines are rendered as they are drawn. This is about 1.65 times as fast
+    as gen_cond_example without dummies and 1.5 times with the default of
+    up to 2 (see benchmarks.py skeletons); with many dummies, drawing and
+    placing them dominates and the gain falls to about 1.15. The draws are
+    those of gen_cond_example, in the same order, so the instance is the
+    same as that of gen_cond_example with the same rng state.
 
-    # 条件语句声明和初始化模板
-    dec_init_pairs = templates.COND_DEC_INIT_PAIRS
+    Args:
+        see gen_cond_example
 
-    # 进一步整合汇聚
-    # 1.当include_cond_bufwrite为真时，main_lines将添加cond_buf_write行
-    # 2.随机插入若干buf_write干扰组合
-    return _assemble_general_example(dec_init_pairs, main_lines, dummy_vars,
-                                     safe, substitutions,
-                                     include_cond_bufwrite)
+    Returns:
+        instance_str (str): str of code example
+        tags (list of Tag): tag for each line representing buffer safety
+    """
+    substitutions, dummy_vars, safe = _sample_cond_values(rng,
+                                                          cond_safe_ratio,
+                                                          index)
+    _observe_cond_values(timer, substitutions)
+    setup_layout = _sample_setup_layout(templates.COND_DEC_INIT_PAIRS, rng)
+    num_dummies = _sample_num_dummies(include_cond_bufwrite, rng)
+    timer.split("sampling")
+
+    skeleton = _get_skeleton(include_cond_bufwrite, tuple(substitutions),
+                             setup_layout)
+    query_tag = Tag.BUFWRITE_COND_SAFE if safe else Tag.BUFWRITE_COND_UNSAFE
+    values = skeleton.get_values(list(substitutions.values()))
+    if num_dummies:
+        # the dummy lines go between the format strings of the body lines;
+        # they hold no '%', being made of names, numbers and CHARSET
+        # characters, so the whole instance is still formatted at once
+        body = _BodyLines(skeleton.body_formats,
+                          [query_tag if tag is None else tag
+                           for tag in skeleton.body_tags])
+        body.control_flow_start, body.control_flow_end = \
+            skeleton.control_flow
+        _insert_dummies(body, dummy_vars, num_dummies, rng, taut_safe_ratio,
+                        timer, index)
+        body_formats, body_tags = body.materialize()
+        tags = _get_tags(body_tags)
+        timer.split("assembly")
+        instance_str = (skeleton.head_format_str +
+                        "\n    ".join(body_formats) +
+                        skeleton.tail_format_str) % values
+        if tags_as_comments:
+            instance_str = annotate_instance(instance_str, tags)
+        timer.split("render")
+        return instance_str, tags
+
+    tags = list(skeleton.tags)
+    comments = list(skeleton.comments)
+    if skeleton.query_pos is not None:
+        tags[skeleton.query_pos] = query_tag
+        comments[skeleton.query_pos] = _TAG_COMMENTS[query_tag]
+    timer.split("assembly")
+
+    # as _get_instance_str
+    instance_str = skeleton.format_str % values
+    if not tags_as_comments:
+        timer.split("render")
+        return instance_str, tags
+    lines = instance_str.split("\n")
+    max_linelen = max(map(len, lines))
+    instance_str = "\n".join(map(operator.add,
+                                 [line.ljust(max_linelen) for line in lines],
+                                 comments))
+    timer.split("render")
+    return instance_str, tags
+
+
+# skeleton of a setup layout, see _get_skeleton
+_Skeleton = collections.namedtuple("_Skeleton", [
+    "format_str", "get_values", "tags", "comments", "query_pos",
+    "head_format_str", "body_formats", "tail_format_str", "body_tags",
+    "control_flow"])
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def _get_skeleton(include_cond_bufwrite, names, setup_layout):
+    """Assemble and compile the skeleton of a setup layout, without dummies
+
+    The body is assembled as by _get_lines, and the function with the body
+    is compiled into a single render plan. The format strings of the body
+    lines are also kept apart, for dummy lines to be inserted between them.
+
+    Args:
+        include_cond_bufwrite (bool): whether to include the
+            control flow-sensitive buffer write
+        names (tuple of str): names of the substitutions of the templates
+        setup_layout (tuple): see _sample_setup_layout
+
+    Returns:
+        skeleton (_Skeleton): with
+            format_str (str): the %-format string of the whole instance,
+                without tag comments
+            get_values (callable): gets the tuple of values to fill
+                format_str with from the list of the values of the
+                substitutions, in the order of names
+            tags (tuple): tag of each line; None for the conditional buffer
+                write
+            comments (tuple of str): tag comment of each line, "" for the
+                conditional buffer write
+            query_pos (int): line of the conditional buffer write, or None
+            head_format_str, tail_format_str (str): the parts of
+                format_str before and after the body lines, such that
+                head_format_str + "\\n    ".join(body_formats) +
+                tail_format_str == format_str
+            body_formats (tuple of str): format string of each body line,
+                without indentation
+            body_tags (tuple): tag of each body line, None for the
+                conditional buffer write
+            control_flow (tuple of int): control_flow_start and
+                control_flow_end of the body, see _BodyLines
+    """
+    main_lines = templates.COND_MAIN_LINES
+    if include_cond_bufwrite:
+        main_lines = main_lines + templates.BUFWRITE_LINES
+    body = _get_main_body(templates.COND_DEC_INIT_PAIRS, main_lines,
+                          setup_layout, include_cond_bufwrite, None)
+    control_flow = (body.control_flow_start, body.control_flow_end)
+    lines, body_tags = body.materialize()
+    tags = tuple(_get_tags(body_tags))
+    body_plans = [_compile_template(line) for line in lines]
+    func_plans = _compile_func_template(templates.FUNC_TMPL_STR)
+    body_pos = func_plans.index(None)
+    plans = (list(func_plans[:body_pos]) +
+             [("    " + format_str, plan_names)
+              for (format_str, plan_names) in body_plans] +
+             list(func_plans[body_pos + 1:]))
+    positions = {name: pos for (pos, name) in enumerate(names)}
+    get_values = operator.itemgetter(*[
+        positions[name] for (_, plan_names) in plans for name in plan_names])
+    format_strs = [format_str for (format_str, _) in plans]
+    num_tail_lines = len(func_plans) - body_pos - 1
+    return _Skeleton(
+        format_str="\n".join(format_strs),
+        get_values=get_values,
+        tags=tags,
+        comments=tuple(_TAG_COMMENTS[tag] if tag is not None else ""
+                       for tag in tags),
+        query_pos=tags.index(None) if include_cond_bufwrite else None,
+        head_format_str="".join(format_str + "\n" for format_str
+                                in format_strs[:body_pos]) + "    ",
+        body_formats=tuple(format_str for (format_str, _) in body_plans),
+        tail_format_str="".join("\n" + format_str for format_str
+                                in format_strs[len(format_strs) -
+                                               num_tail_lines:]),
+        body_tags=tuple(body_tags),
+        control_flow=control_flow)
+
+
+def _sample_len_idx(safe, rng=random):
+    """Draw a (buffer length, index) pair uniformly among those with a label
+
+    The pairs are those of two independent draws from range(MAX_IDX); safe
+    pairs (idx < buf_len) are two distinct values in increasing order,
+    unsafe pairs are two distinct values in decreasing order or one value
+    twice. Sampling them directly needs no rejection.
+
+    Args:
+        safe (bool): whether idx < buf_len
+        rng (random.Random): source of randomness
+
+    Returns:
+        buf_len (int), idx (int)
+    """
+    if not safe and rng.randrange(MAX_IDX * (MAX_IDX + 1) // 2) < MAX_IDX:
+        # one of the MAX_IDX pairs with idx == buf_len
+        value = rng.randrange(MAX_IDX)
+        return value, value
+    low = rng.randrange(MAX_IDX)
+    high = rng.randrange(MAX_IDX - 1)
+    if high >= low:
+        high += 1
+    else:
+        low, high = high, low
+    return (high, low) if safe else (low, high)
+
+
+def generate_instance(seed, index, include_cond_bufwrite=True,
+                      timer=run_stats.NULL_TIMER, cond_safe_ratio=None,
+                      taut_safe_ratio=None, skeletons=False,
+                      tags_as_comments=True):
+    """Generate the instance with the given index of the run with the given seed
+
+    Every instance draws from its own random.Random, seeded from (seed, index),
+    so any instance can be rebuilt without replaying the ones before it.
+    Indices count collisions, i.e. they are the attempts made by main().
+
+    Args:
+        seed (int): seed of the run
+        index (int): index of the instance in the run
+        include_cond_bufwrite (bool): whether to include the
+            control flow-sensitive buffer write
+        timer (run_stats.StageTimer): see gen_cond_example
+        cond_safe_ratio (float): see gen_cond_example
+        taut_safe_ratio (float): see gen_cond_example
+        skeletons (bool): whether to stamp the values into a cached skeleton
+            (see gen_cond_example_from_skeleton); the instance is the same
+        tags_as_comments (bool): see gen_cond_example
+
+    Returns:
+        instance_str (str): str of code example
+        tags (list of Tag): tag for each line representing buffer safety
+    """
+    rng = random.Random(_get_instance_seed(seed, index))
+    if skeletons:
+        return gen_cond_example_from_skeleton(
+            include_cond_bufwrite=include_cond_bufwrite, rng=rng, timer=timer,
+            cond_safe_ratio=cond_safe_ratio, taut_safe_ratio=taut_safe_ratio,
+            tags_as_comments=tags_as_comments, index=index)
+    return gen_cond_example(include_cond_bufwrite=include_cond_bufwrite,
+                            rng=rng, timer=timer,
+                            cond_safe_ratio=cond_safe_ratio,
+                            taut_safe_ratio=taut_safe_ratio,
+                            tags_as_comments=tags_as_comments, index=index)
 
 
 def _assemble_general_example(dec_init_pairs, main_lines, dummy_vars,
-                              safe, substitutions, include_cond_bufwrite):
+                              safe, substitutions, include_cond_bufwrite,
+                              rng=random, timer=run_stats.NULL_TIMER,
+                              taut_safe_ratio=None, tags_as_comments=True,
+                              index=None):
     """Get instance lines, convert to string, generate tags
        1.当include_cond_bufwrite为真时，main_lines将添加cond_buf_write行
        2.随机插入若干buf_write干扰组合
@@ -132,6 +493,13 @@ def _assemble_general_example(dec_init_pairs, main_lines, dummy_vars,
         substitutions (dict): names to substitute into templates
         include_cond_bufwrite (bool): whether to include the
             control flow-sensitive buffer write
+        rng (random.Random): source of randomness
+        timer (run_stats.StageTimer): charged with the assembly and render
+            stages
+        taut_safe_ratio (float): fraction of dummy buffer writes that are
+            safe, or None
+        tags_as_comments (bool): see _get_instance_str
+        index (int): see gen_cond_example
 
     Returns:
         instance_str (str): str of code example
@@ -151,38 +519,142 @@ def _assemble_general_example(dec_init_pairs, main_lines, dummy_vars,
 
     # 随机插入若干干扰buf_write组合
     lines, body_tags = _get_lines(dec_init_pairs, main_lines,
-                                  dummy_vars, safe, include_cond_bufwrite)
+                                  dummy_vars, safe, include_cond_bufwrite,
+                                  rng, taut_safe_ratio, timer, index)
     tags = _get_tags(body_tags)
+    timer.split("assembly")
     instance_str = _get_instance_str(lines, substitutions,
-                                     templates.FUNC_TMPL_STR, tags)  # 对模板进行替换。
+                                     templates.FUNC_TMPL_STR, tags,
+                                     tags_as_comments)  # 对模板进行替换。
+    timer.split("render")
     return instance_str, tags
 
 
 # 返回MAX_NUM_VARS个变量名
-def _get_anon_vars():
+def _get_anon_vars(rng=random):
     """Get list of unique, anonymized variable names in random order
 
+    Args:
+        rng (random.Random): source of randomness
+
     Returns:
         anon_vars (list of str)
     """
     anon_vars = [VAR_STR % itm for itm in range(MAX_NUM_VARS)]  # VAR_STR是变量名模板
-    random.shuffle(anon_vars)
+    rng.shuffle(anon_vars)
     return anon_vars
 
 
 # 从字符集中任意返回一个字符（数字字符，大小写字母字符）
-def _get_char():
+def _get_char(rng=random):
     """Get a random single character
 
+    Args:
+        rng (random.Random): source of randomness
+
     Returns:
         char (str): random single character from charset
     """
-    char = random.choice(CHARSET)
+    char = rng.choice(CHARSET)
     return char
 
 
+class _BodyLines(object):
+    """Body lines under construction, kept as a log of insertions
+
+    Rebuilding the lines from slices costs O(n) per inserted line, so building
+    a long body line by line is quadratic. Instead, insert() only records
+    where a line goes, and materialize() places all lines at once.
+    control_flow_start and control_flow_end are kept up to date on every
+    insertion: a line inserted at control_flow_start goes before the control
+    flow, a line inserted at control_flow_end goes after it.
+    """
+
+    # number of lines from which materialize() places the lines in
+    # O(n log n); below it, replaying list.insert() (a memmove each) is faster
+    FENWICK_MIN_LINES = 8192
+
+    def __init__(self, lines=(), tags=()):
+        """
+        Args:
+            lines (list of str): initial lines
+            tags (list of Tag instances): tag of each initial line
+        """
+        # each initial line goes after the ones before it, as by append()
+        self._inserts = list(zip(range(len(lines)), lines, tags))
+        # first line of control flow, inclusive
+        self.control_flow_start = len(self._inserts)
+        # last line of control flow, exclusive
+        self.control_flow_end = 0
+
+    def __len__(self):
+        return len(self._inserts)
+
+    def insert(self, idx, line, tag):
+        """Record that line goes before the line which is at idx right now"""
+        self._inserts.append((idx, line, tag))
+        if idx <= self.control_flow_start:
+            self.control_flow_start += 1
+        if idx < self.control_flow_end:
+            self.control_flow_end += 1
+
+    def append(self, line, tag):
+        """Record that line goes after all lines recorded so far"""
+        self.insert(len(self._inserts), line, tag)
+
+    def tag_last(self, tag):
+        """Change the tag of the line recorded last"""
+        idx, line, _ = self._inserts[-1]
+        self._inserts[-1] = (idx, line, tag)
+
+    def materialize(self):
+        """Place every line
+
+        For long bodies, the insertions are replayed backwards: a line takes
+        the (idx + 1)-th slot not yet taken by lines inserted after it. Free
+        slots are counted with a Fenwick tree, which makes this O(n log n).
+
+        Returns:
+            lines (list of str)
+            tags (list of Tag instances): tag of each line
+        """
+        num_lines = len(self._inserts)
+        if num_lines < self.FENWICK_MIN_LINES:
+            placed = []
+            for entry in self._inserts:
+                placed.insert(entry[0], entry)
+            return ([line for (_, line, _) in placed],
+                    [tag for (_, _, tag) in placed])
+
+        # tree[i] counts the free slots in (i - lowbit(i), i]; all are free
+        tree = [i & -i for i in range(num_lines + 1)]
+        top_bit = 1 << num_lines.bit_length()
+        lines = [None] * num_lines
+        tags = [None] * num_lines
+        for (idx, line, tag) in reversed(self._inserts):
+            # binary lifting to the slot with idx free slots before it
+            pos = 0
+            rank = idx
+            step = top_bit
+            while step:
+                nxt = pos + step
+                if nxt <= num_lines and tree[nxt] <= rank:
+                    pos = nxt
+                    rank -= tree[nxt]
+                step >>= 1
+            lines[pos] = line
+            tags[pos] = tag
+            # take the slot
+            pos += 1
+            while pos <= num_lines:
+                tree[pos] -= 1
+                pos += pos & -pos
+        return lines, tags
+
+
 def _get_lines(dec_init_pairs, main_lines, dummy_vars, safe,
-               include_cond_bufwrite):
+               include_cond_bufwrite, rng=random, taut_safe_ratio=None,
+               timer=run_stats.NULL_TIMER, index=None):
     """Create full body lines with setup, main content, and dummy interaction
 
     Args:
@@ -193,34 +665,71 @@ def _get_lines(dec_init_pairs, main_lines, dummy_vars, safe,
             or None, if no conditional query line should be added
         include_cond_bufwrite (bool): whether to include the
             control flow-sensitive buffer write
+        rng (random.Random): source of randomness
+        taut_safe_ratio (float): fraction of dummy buffer writes that are
+            safe, or None
+        timer (run_stats.StageTimer): observes the values of the dummies
+        index (int): see gen_cond_example
 
     Returns:
         lines (list of str)
         body_tags (list of Tag instances): tags for each body line
     """
     # setup lines (declaring and initializing variables)
-    setup_lines = _get_setup_lines(dec_init_pairs)  # 获得声明初始化代码列表，这样做是为了让每一行只有一条语句
-    lines = setup_lines + main_lines
+    setup_layout = _sample_setup_layout(dec_init_pairs, rng)  # 获得声明初始化代码列表，这样做是为了让每一行只有一条语句
+    query_tag = Tag.BUFWRITE_COND_SAFE if safe else Tag.BUFWRITE_COND_UNSAFE
+    body = _get_main_body(dec_init_pairs, main_lines, setup_layout,
+                          include_cond_bufwrite, query_tag)
+
+    num_dummies = _sample_num_dummies(include_cond_bufwrite, rng)
+
+    # Insert dummy array declare/set pairs (all safe sets)
+    _insert_dummies(body, dummy_vars, num_dummies, rng, taut_safe_ratio,
+                    timer, index)
+
+    return body.materialize()
+
+
+def _get_main_body(dec_init_pairs, main_lines, setup_layout,
+                   include_cond_bufwrite, query_tag):
+    """Place the setup lines and the main lines, before adding dummies
+
+    Args:
+        dec_init_pairs (list of tuple)
+        main_lines (list of str): lines that use the declared vars, ending
+            with the conditional query line if include_cond_bufwrite
+        setup_layout (tuple): see _sample_setup_layout
+        include_cond_bufwrite (bool): whether main_lines end with the
+            control flow-sensitive buffer write
+        query_tag (Tag): tag of the conditional query line
+
+    Returns:
+        body (_BodyLines): with the control flow bounds set
+    """
+    body = _BodyLines()
+    _place_setup_lines(body, dec_init_pairs, setup_layout)
+    num_setup_lines = len(body)
     # construct body tags before adding dummies
-    body_tags = [Tag.BODY for _ in lines]  # 将所有行全部打上body tag
+    for line in main_lines:
+        body.append(line, Tag.BODY)  # 将所有行全部打上body tag
+    # 确定main_lines的开始和结束索引，为插入干扰buf_write组合做准备
+    body.control_flow_start = num_setup_lines
+    body.control_flow_end = len(body)
     if include_cond_bufwrite:  # 如果包含了cond_bufwrite，则对cond_bufwrite行的tag进行修正
-        query_tag = Tag.BUFWRITE_COND_SAFE if safe else Tag.BUFWRITE_COND_UNSAFE
-        body_tags[-1] = query_tag  # cond_bufwrite行在主条件语句的尾部
+        body.control_flow_end -= 1
+        body.tag_last(query_tag)  # cond_bufwrite行在主条件语句的尾部
+    return body
+
 
+def _sample_num_dummies(include_cond_bufwrite, rng=random):
+    """Draw the number of dummy buffer writes of an instance"""
     # 根据是否include_cond_bufwrite设置干扰buf_write代码组合的个数
     min_num_dummies = 0 if include_cond_bufwrite else MIN_NUM_DUMMIES_TAUTONLY  # 如果包含了cond_buf_write，可不包含干扰buf_write代码组合
-    num_dummies = random.randrange(min_num_dummies, MAX_NUM_DUMMIES + 1)  # 随机在该区间内去一个值作为干扰buf_write组合
-
-    # Insert dummy array declare/set pairs (all safe sets)
-    lines, body_tags = _insert_dummies(
-        setup_lines, main_lines, dummy_vars, num_dummies, body_tags,
-        include_cond_bufwrite)
-
-    return lines, body_tags
+    return rng.randrange(min_num_dummies, MAX_NUM_DUMMIES + 1)  # 随机在该区间内去一个值作为干扰buf_write组合
 
 
 # 将声明和定义语句对排好。因为字符数组只声明，不赋值。则用None表示
-def _get_setup_lines(dec_init_pairs):
+def _get_setup_lines(dec_init_pairs, rng=random):
     """Get setup lines (declaring and initializing variables) in random order
     so that variables are declared before initialized. If the second entry of
     the tuple is None, this line only needs to be declared, not initialized,
@@ -239,67 +748,128 @@ def _get_setup_lines(dec_init_pairs):
 
     Args:
         dec_init_pairs (list of tuple)
+        rng (random.Random): source of randomness
 
     Returns:
         setup_lines (list of str)
     """
-    setup_lines = []
-    for (dec_str, init_str) in dec_init_pairs:
+    body = _BodyLines()
+    _insert_setup_lines(body, dec_init_pairs, rng)
+    setup_lines, _ = body.materialize()
+    return setup_lines
+
+
+def _insert_setup_lines(body, dec_init_pairs, rng=random):
+    """Record the setup lines of _get_setup_lines in an empty body
+
+    Args:
+        body (_BodyLines): empty body to add the setup lines to
+        dec_init_pairs (list of tuple)
+        rng (random.Random): source of randomness
+    """
+    _place_setup_lines(body, dec_init_pairs,
+                       _sample_setup_layout(dec_init_pairs, rng))
+
+
+def _sample_setup_layout(dec_init_pairs, rng=random):
+    """Draw the positions of the setup lines of _insert_setup_lines
+
+    Returns:
+        layout (tuple of tuple): for each pair, the sorted positions of its
+            lines among the setup lines before it
+    """
+    layout = []
+    num_lines = 0
+    for (_, init_str) in dec_init_pairs:
         if init_str is None:  # 表明是个数组声明模板 可以随机插入到任意一行
-            idx = random.randrange(len(setup_lines) + 1)
-            setup_lines = setup_lines[:idx] + [dec_str] + setup_lines[idx:]  # 因为是只声明，所以可以直接插入进来。
+            layout.append((rng.randrange(num_lines + 1),))
+            num_lines += 1
         else:
-            idxes = sorted(  # 表明既有声明，又有初始化，则需要随机选择两个位置，而且要从小到大进行排序
-                [random.randrange(len(setup_lines) + 1) for _ in range(2)])
-            # 插入这两个特定的位置，先插入声明语句，再插入赋值语句
-            setup_lines = (setup_lines[:idxes[0]] + [dec_str] +
-                           setup_lines[idxes[0]:idxes[1]] + [init_str] +
-                           setup_lines[idxes[1]:])
+            layout.append(tuple(sorted(  # 表明既有声明，又有初始化，则需要随机选择两个位置，而且要从小到大进行排序
+                [rng.randrange(num_lines + 1) for _ in range(2)])))
+            num_lines += 2
+    return tuple(layout)
 
-    return setup_lines
+
+def _place_setup_lines(body, dec_init_pairs, layout):
+    """Insert the setup lines at the positions of _sample_setup_layout"""
+    for ((dec_str, init_str), idxes) in zip(dec_init_pairs, layout):
+        # 插入这两个特定的位置，先插入声明语句，再插入赋值语句
+        # (the declaration shifts the second position by one)
+        body.insert(idxes[0], dec_str, Tag.BODY)  # 因为是只声明，所以可以直接插入进来。
+        if init_str is not None:
+            body.insert(idxes[1] + 1, init_str, Tag.BODY)
 
 
-def _insert_dummies(setup_lines, main_lines, dummy_vars, num_dummies,
-                    body_tags, include_cond_bufwrite):
+def _insert_dummies(body, dummy_vars, num_dummies, rng=random,
+                    taut_safe_ratio=None, timer=run_stats.NULL_TIMER,
+                    index=None):
     """Insert dummy array declare/set pairs (all safe sets)
 
     Args:
-        setup_lines (list of str): declaration and initialization lines
-        main_lines (list of str): control flow lines
+        body (_BodyLines): declaration, initialization and control flow lines
+            (main_lines仅包含有控制语句(包括cond_buf_write)), with the control
+            flow bounds set; dummy lines and tags are added
         dummy_vars (list of str): variable names available for dummy use
         num_dummies (int): number of dummy vars to insert
-        body_tags (list of Tag instances): tags before adding dummies
-        include_cond_bufwrite (bool): whether to include the
-            control flow-sensitive buffer write
+        rng (random.Random): source of randomness
+        taut_safe_ratio (float): fraction of dummy buffer writes that are
+            safe, or None
+        timer (run_stats.StageTimer): observes the values of the dummies
+        index (int): see gen_cond_example; the dummies of the instance are
+            the positions of a label sequence of their own, whose phase
+            follows from the index (see _get_taut_phase)
+    """
+
+    # 根据control_flow_start和control_flow_end,向lines插入num_dummies个干扰buf_write语句组合
+    if taut_safe_ratio is not None and index is not None:
+        phase = _get_taut_phase(index)
+    for dummy_num in range(num_dummies):
+        if taut_safe_ratio is None:
+            taut_safe = None
+        elif index is None:
+            taut_safe = rng.random() < taut_safe_ratio
+        else:
+            taut_safe = _get_safe_label(dummy_num, taut_safe_ratio, phase)
+        _insert_referential_dummy(body, dummy_vars, rng=rng,
+                                  taut_safe=taut_safe, timer=timer)
+
+
+def _get_safe_label(position, ratio, phase=0.5):
+    """Get the label of the buffer write at a position of a label sequence
+
+    Position n is safe if floor((n + 1) * ratio + phase) > floor(n * ratio +
+    phase), so that the first N positions hold floor(N * ratio + phase) -
+    floor(phase) safe writes: with the default phase, round(N * ratio)
+    rounded half up, i.e. the ratio is met by every prefix, not only in
+    expectation.
+
+    Args:
+        position (int): position in the sequence, from 0
+        ratio (float): fraction of safe writes, in [0, 1]
+        phase (float): offset of the sequence, in [0, 1)
 
     Returns:
-        lines (list of str): with dummy dec/set pairs added
-        body_tags (list of Tag instances): with tags added for dummy lines
+        safe (bool)
     """
+    return (math.floor((position + 1) * ratio + phase) >
+            math.floor(position * ratio + phase))
 
-    lines = setup_lines + main_lines  # 将声明初始化列表和主行合并，main_lines仅包含有控制语句(包括cond_buf_write)
-
-    # 确定main_lines的开始和结束索引，为插入干扰buf_write组合做准备
-    # first line of control flow, inclusive
-    control_flow_start = len(setup_lines)
-    # last line of control flow, exclusive
-    control_flow_end = len(setup_lines + main_lines)
-    if include_cond_bufwrite:
-        control_flow_end -= 1
 
-    # 根据control_flow_start和control_flow_end,向lines插入num_dummies个干扰buf_write语句组合
-    for _ in range(num_dummies):
-        (lines, dummy_vars, body_tags, control_flow_start, control_flow_end
-         ) = _insert_referential_dummy(
-            lines, dummy_vars, body_tags, control_flow_start,
-            control_flow_end)
+def _get_taut_phase(index):
+    """Get the phase of the dummy label sequence of an instance
 
-    return lines, body_tags
+    The phases of consecutive instances are the fractional parts of index
+    times the golden ratio, which spread evenly over [0, 1); the rounding
+    of each instance's safe count, floor or ceil of num_dummies * ratio, is
+    thereby balanced across instances.
+    """
+    return (index * TAUT_PHASE_STEP) % 1.0
 
 
-def _insert_referential_dummy(lines, dummy_vars, body_tags,
-                              control_flow_start, control_flow_end,
-                              require_safe=False):
+def _insert_referential_dummy(body, dummy_vars, require_safe=False,
+                              rng=random, taut_safe=None,
+                              timer=run_stats.NULL_TIMER):
     """Insert dummy declare/set lines with referential index access
     下面是干扰语句组合的例子
     E.g. char entity_0[10];
@@ -313,41 +883,28 @@ def _insert_referential_dummy(lines, dummy_vars, body_tags,
 
 
     Args:
-        lines (list of str): lines to insert dummy lines around
-        dummy_vars (list of str): variable names available for dummy use
-        body_tags (list of Tag instance): body tags before adding dummies
-        control_flow_start (int): first idx of control flow lines
-        control_flow_end (int): last idx of control flow lines
+        body (_BodyLines): lines to insert dummy lines around, with their
+            tags and control flow bounds; dummy lines and tags are added
+        dummy_vars (list of str): variable names available for dummy use;
+            used dummy varnames are removed
         require_safe (bool): if True, then require that dummy accesses are
             all safe
-
-
-    Returns:
-         lines (list of str): with dummy dec/set pair added
-         dummy_vars (list of str): with used dummy varnames removed
-         body_tags (list of Tag instance): with dummy tags added
-         control_flow_start (int): updated from args
-         control_flow_end (int): updated from args
+        rng (random.Random): source of randomness
+        taut_safe (bool): if not None, then whether the dummy access is
+            safe; the values are drawn uniformly among those with that label
+        timer (run_stats.StageTimer): observes dum_len and dum_idx
     """
     if len(dummy_vars) < 2:  # 一个干扰buf_write组合至少需要利用2个dummy_var
         raise ValueError("Trying to insert more dummy vars than available")
 
-    # 是否要求干扰buf_write语句组合必须安全
-    if require_safe:
-        dum_len = random.randrange(1, MAX_IDX)
-        dum_idx = random.randrange(dum_len)  # dum_idx小于dum_len，则干扰buf_write语句安全
-    else:
-        # dum_len和dum_idx均随机取自[0,MAX_IDX),无法保证dum_idx<dum_len
-        dum_len = random.randrange(MAX_IDX)  # dum数组的长度
-        dum_idx = random.randrange(MAX_IDX)  # dum的index
+    dum_len, dum_idx, char = _sample_dummy_values(rng, require_safe,
+                                                  taut_safe)
+    timer.observe("dum_len", dum_len)
+    timer.observe("dum_idx", dum_idx)
 
     dum_buf_var = dummy_vars.pop()  # 弹出一个变量名作为数组变量名
     dum_int_var = dummy_vars.pop()  # 弹出一个变量名作为索引变量名
-    buf_dec_line = "char %s[%s];" % (dum_buf_var, dum_len)  # 干扰数组声明语句
-    idx_dec_line = "int %s;" % dum_int_var  # 索引变量声明语句
-    idx_init_line = "%s = %s;" % (dum_int_var, dum_idx)  # 索引变量赋值语句
-    buf_set_line = "%s[%s] = '%s';" % (dum_buf_var, dum_int_var,
-                                       random.choice(CHARSET))  # buf_write语句
+    lines = _get_dummy_lines(dum_buf_var, dum_int_var, dum_len, dum_idx, char)
 
     """
     char $dum_buf_var[$dum_len]            buf_dec_line 干扰数组声明语句
@@ -357,43 +914,112 @@ def _insert_referential_dummy(lines, dummy_vars, body_tags,
     其中$char = random.choice(CHARSET)
     """
 
-    # idx declaration must go before idx initialization
-    setup_lines = [idx_dec_line, idx_init_line]
+    layout = _sample_dummy_layout(rng, body.control_flow_start,
+                                  body.control_flow_end, len(body))
+
+    # 判断这个干扰组合中的buf_write是否安全
+    safe = dum_idx < dum_len
+    bufwrite_tag = Tag.BUFWRITE_TAUT_SAFE if safe else Tag.BUFWRITE_TAUT_UNSAFE
+
+    _place_dummy(body, layout, lines, bufwrite_tag)
+
+
+def _get_dummy_lines(dum_buf_var, dum_int_var, dum_len, dum_idx, char):
+    """Get the lines of a dummy with the given values
+
+    Returns:
+        lines (tuple of str): buffer declaration, index declaration, index
+            initialization and buffer set lines, see _place_dummy
+    """
+    buf_dec_line = "char %s[%s];" % (dum_buf_var, dum_len)  # 干扰数组声明语句
+    idx_dec_line = "int %s;" % dum_int_var  # 索引变量声明语句
+    idx_init_line = "%s = %s;" % (dum_int_var, dum_idx)  # 索引变量赋值语句
+    buf_set_line = "%s[%s] = '%s';" % (dum_buf_var, dum_int_var,
+                                       char)  # buf_write语句
+    return buf_dec_line, idx_dec_line, idx_init_line, buf_set_line
+
+
+def _sample_dummy_values(rng=random, require_safe=False, taut_safe=None):
+    """Draw the values of a dummy buffer write
+
+    Args:
+        rng (random.Random): source of randomness
+        require_safe (bool): see _insert_referential_dummy
+        taut_safe (bool): see _insert_referential_dummy
+
+    Returns:
+        dum_len (int), dum_idx (int), char (str)
+    """
+    # 是否要求干扰buf_write语句组合必须安全
+    if require_safe:
+        dum_len = rng.randrange(1, MAX_IDX)
+        dum_idx = rng.randrange(dum_len)  # dum_idx小于dum_len，则干扰buf_write语句安全
+    elif taut_safe is not None:
+        dum_len, dum_idx = _sample_len_idx(taut_safe, rng)
+    else:
+        # dum_len和dum_idx均随机取自[0,MAX_IDX),无法保证dum_idx<dum_len
+        dum_len = rng.randrange(MAX_IDX)  # dum数组的长度
+        dum_idx = rng.randrange(MAX_IDX)  # dum的index
+    return dum_len, dum_idx, rng.choice(CHARSET)
+
+
+def _sample_dummy_layout(rng, control_flow_start, control_flow_end,
+                         num_lines):
+    """Draw where the lines of a dummy go, given the body so far
+
+    Args:
+        rng (random.Random): source of randomness
+        control_flow_start (int): first line of control flow, inclusive
+        control_flow_end (int): last line of control flow, exclusive
+        num_lines (int): number of lines of the body
+
+    Returns:
+        layout (tuple): buf_dec_idx (int), the position of the buffer
+            declaration among the setup lines, setup_idxes (tuple of int)
+            and buf_set_idx (int), lines of the body before which the setup
+            lines and the buffer set go
+    """
     # buffer declaration can go anywhere between them
-    buf_dec_idx = random.randrange(3)  # 将buf_write语句随意选择一个位置插入
-    setup_lines = (setup_lines[:buf_dec_idx] + [buf_dec_line] +
-                   setup_lines[buf_dec_idx:])
+    buf_dec_idx = rng.randrange(3)  # 将buf_write语句随意选择一个位置插入
 
-    # 至此，setup_lines内部3条语句的相对位置已确定
     # 干扰组合的setup_lines和控制流无关，因此不能放在控制流里面，所以要么放在控制流行的前面，要么放在控制流行的后面。
 
     # whether these setup lines go before the control flow lines
-    before_control_flow = random.choice([True, False])
+    before_control_flow = rng.choice([True, False])
     if before_control_flow:
         range_start = 0
         range_end = control_flow_start + 1
     else:  # 若将setup语句放在control flow语句后面
         range_start = control_flow_end
-        range_end = len(lines) + 1
+        range_end = num_lines + 1
 
     # lines where buffer and index are declared; index is initialized
-    setup_idxes = sorted([random.randrange(range_start, range_end)
+    setup_idxes = sorted([rng.randrange(range_start, range_end)
                           for _ in range(3)])  # setup lines共3条语句，因此需要寻找3个位置，并从小到大进行排序，保持setup lines内部语句相对位置不变
 
     # line where buffer is set
-    buf_set_idx = random.randrange(max(setup_idxes), len(lines) + 1)  # buf_set语句需要放到setup_lines语句之后
-
-    # the amounts by which control_flow_{start, end} increase
-    # after inserting these lines
-    d_start = 0
-    d_end = 0
-    for idx in setup_idxes + [buf_set_idx]:
-        if idx <= control_flow_start:
-            d_start += 1
-        if idx < control_flow_end:
-            d_end += 1
-    control_flow_start += d_start
-    control_flow_end += d_end
+    buf_set_idx = rng.randrange(setup_idxes[-1], num_lines + 1)  # buf_set语句需要放到setup_lines语句之后
+    return buf_dec_idx, tuple(setup_idxes), buf_set_idx
+
+
+def _place_dummy(body, layout, lines, bufwrite_tag):
+    """Insert the lines of a dummy at the positions of _sample_dummy_layout
+
+    Args:
+        body (_BodyLines): lines to insert the dummy lines into
+        layout (tuple): see _sample_dummy_layout
+        lines (list of str): buffer declaration, index declaration, index
+            initialization and buffer set lines
+        bufwrite_tag (Tag): tag of the buffer set line
+    """
+    buf_dec_idx, setup_idxes, buf_set_idx = layout
+    buf_dec_line, idx_dec_line, idx_init_line, buf_set_line = lines
+
+    # idx declaration must go before idx initialization
+    setup_lines = [idx_dec_line, idx_init_line]
+    setup_lines.insert(buf_dec_idx, buf_dec_line)
+
+    # 至此，setup_lines内部3条语句的相对位置已确定
 
     # 将干扰代码组合添加到lines中
     """
@@ -402,29 +1028,23 @@ def _insert_referential_dummy(lines, dummy_vars, body_tags,
     setup_idxes[2]放buf_dec,idx_dec,idx_init中的一条，setup_lines[2]
     接下来是buf_set_idx放buf_set_line
     """
-
-    lines = (lines[:setup_idxes[0]] + [setup_lines[0]] +
-             lines[setup_idxes[0]:setup_idxes[1]] + [setup_lines[1]] +
-             lines[setup_idxes[1]:setup_idxes[2]] + [setup_lines[2]] +
-             lines[setup_idxes[2]:buf_set_idx] + [buf_set_line] +
-             lines[buf_set_idx:])
-
-    # 判断这个干扰组合中的buf_write是否安全，并修改body_tags
-    safe = dum_idx < dum_len
-    bufwrite_tag = Tag.BUFWRITE_TAUT_SAFE if safe else Tag.BUFWRITE_TAUT_UNSAFE
-    body_tags = (body_tags[:setup_idxes[0]] + [Tag.BODY] +
-                 body_tags[setup_idxes[0]:setup_idxes[1]] + [Tag.BODY] +
-                 body_tags[setup_idxes[1]:setup_idxes[2]] + [Tag.BODY] +
-                 body_tags[setup_idxes[2]:buf_set_idx] + [bufwrite_tag] +
-                 body_tags[buf_set_idx:])  # 更新boday_tags
-
-    return lines, dummy_vars, body_tags, control_flow_start, control_flow_end
+    # the idxes refer to the lines before this insertion, so each one is
+    # shifted by the number of dummy lines already inserted
+    inserted = zip(setup_idxes + (buf_set_idx,),
+                   setup_lines + [buf_set_line],
+                   [Tag.BODY, Tag.BODY, Tag.BODY, bufwrite_tag])
+    for (shift, (idx, line, tag)) in enumerate(inserted):
+        body.insert(idx + shift, line, tag)
 
 
 def _get_instance_str(lines, substitutions, func_tmpl_str, tags,
                       tags_as_comments=True):
     """Make substitutions and construct function instance string
 
+    Lines are rendered with the cached render plans of their templates (see
+    _compile_template), and the body lines go straight into the lines of the
+    function template, so the function is not substituted and split again.
+
     Args:
         lines (list of str): lines in body, to be substituted
         substitutions (dict)
@@ -436,21 +1056,145 @@ def _get_instance_str(lines, substitutions, func_tmpl_str, tags,
     Returns:
         instance_str (str): complete function as string
     """
-    lines = [string.Template(itm).substitute(substitutions) for itm in lines]  # 将所有模板代码语句进行替换
-    body = "\n".join("    " + line for line in lines)  # 对body进行重新赋值
-    substitutions['body'] = body
-    instance_str = string.Template(func_tmpl_str).substitute(substitutions)
+    body_lines = ["    " + _render(itm, substitutions) for itm in lines]  # 将所有模板代码语句进行替换
+    lines = []
+    for plan in _compile_func_template(func_tmpl_str):
+        if plan is None:  # $body
+            lines.extend(body_lines)
+        else:
+            lines.append(_render_plan(plan, substitutions))
 
     # 如果需要添加tag作为注释
     if tags_as_comments:
-        lines = instance_str.split("\n")
-        max_linelen = max(len(line) for line in lines)  # 获得最长的行的长度
-        fmt_str = "{:<{width}} // {}"  # 左对齐
-        lines = [fmt_str.format(line, tag, width=max_linelen)
-                 for (line, tag) in zip(lines, tags)]  # TODO(chenglinyu): Python zip函数的使用方法
-        instance_str = "\n".join(lines)
+        lines = _add_tag_comments(lines, tags)
+
+    return "\n".join(lines)
+
+
+def _add_tag_comments(lines, tags):
+    """Pad the lines to a common width and end each with its tag comment"""
+    max_linelen = max(map(len, lines))  # 获得最长的行的长度
+    return list(map(operator.add,
+                    [line.ljust(max_linelen) for line in lines],  # 左对齐
+                    map(_TAG_COMMENTS.__getitem__, tags)))
+
 
-    return instance_str
+def annotate_instance(instance_str, tags):
+    """Add the tag comments to an instance generated without them
+
+    annotate_instance(clean_str, tags) is the instance generated with
+    tags_as_comments=True from the same draws, without rendering it again.
+
+    Args:
+        instance_str (str): str of code example, without tag comments
+        tags (list of Tag): tag for each line
+
+    Returns:
+        instance_str (str): str of code example with tag comments
+    """
+    return "\n".join(_add_tag_comments(instance_str.split("\n"), tags))
+
+
+def canonicalize_instance(instance_str):
+    """Get the canonical form of an instance, equal for renamed copies
+
+    _get_anon_vars shuffles the variable names and _get_char draws the
+    character of each dummy write, neither of which changes the structure
+    of an instance. In the canonical form, the variables are renamed in
+    order of first use (VAR_STR % 0, VAR_STR % 1, ...) and the character
+    literals are masked.
+
+    Args:
+        instance_str (str): str of code example
+
+    Returns:
+        canonical_str (str)
+    """
+    names = {}
+
+    def rename(match):
+        name = match.group(0)
+        if name not in names:
+            names[name] = VAR_STR % len(names)
+        return names[name]
+
+    return _CHAR_LITERAL_RE.sub(CANONICAL_CHAR_LITERAL,
+                                _VAR_NAME_RE.sub(rename, instance_str))
+
+
+# variable names and character literals, as replaced in canonical forms
+_VAR_NAME_RE = re.compile(VAR_STR % r"\d+")
+_CHAR_LITERAL_RE = re.compile("'[{}]'".format(re.escape(CHARSET)))
+
+# comment appended to a line with each tag
+_TAG_COMMENTS = {tag: " // {}".format(tag) for tag in Tag}
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_template(template_str):
+    """Compile a string.Template into a render plan
+
+    The plan is a %-format string and the names to fill it with, in order, so
+    that rendering is a single % operation. Templates are compiled once;
+    lines without placeholders are not templates and are not cached.
+
+    Args:
+        template_str (str): string.Template source, e.g. "int $idx_var;"
+
+    Returns:
+        plan (tuple): (format_str, names)
+
+    Raises:
+        ValueError: on an invalid placeholder, as string.Template does
+    """
+    pattern = string.Template.pattern
+    parts = []
+    names = []
+    pos = 0
+    for match in pattern.finditer(template_str):
+        parts.append(template_str[pos:match.start()].replace("%", "%%"))
+        pos = match.end()
+        if match.group('escaped') is not None:
+            parts.append("$")
+            continue
+        name = match.group('named') or match.group('braced')
+        if name is None:
+            raise ValueError("Invalid placeholder in template: {!r}".format(
+                template_str))
+        parts.append("%s")
+        names.append(name)
+    parts.append(template_str[pos:].replace("%", "%%"))
+    return "".join(parts), tuple(names)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_func_template(func_tmpl_str):
+    """Compile a function template line by line
+
+    Returns:
+        plans (tuple): render plan of each line, None for the $body line
+
+    Raises:
+        ValueError: if $body is not on a line of its own
+    """
+    plans = tuple(None if line == "$body" else _compile_template(line)
+                  for line in func_tmpl_str.split("\n"))
+    if any(plan is not None and "body" in plan[1] for plan in plans):
+        raise ValueError("$body must be on a line of its own")
+    return plans
+
+
+def _render_plan(plan, substitutions):
+    """Render a compiled template with the given substitutions"""
+    format_str, names = plan
+    return format_str % tuple(substitutions[name] for name in names)
+
+
+def _render(template_str, substitutions):
+    """Substitute a template line, like string.Template.substitute"""
+    if "$" not in template_str:
+        return template_str
+    return _render_plan(_compile_template(template_str), substitutions)
 
 
 def _get_tags(body_tags):
@@ -470,8 +1214,12 @@ def _get_tags(body_tags):
     return tags
 
 
-def _get_args():
-    """Get command-line arguments 返回从命令行解析之后的参数"""
+def _get_args(argv=None):
+    """Get command-line arguments 返回从命令行解析之后的参数
+
+    Args:
+        argv (list of str): arguments to parse; default sys.argv[1:]
+    """
     separator = '\n' + "#" * 79 + '\n'
     parser = argparse.ArgumentParser(
         description=__doc__ + separator,
@@ -494,11 +1242,188 @@ def _get_args():
                         default=DEFAULT_SEED,
                         metavar="<int>")
 
+    parser.add_argument('-index_offset',
+                        help=("(int) Index of the first instance of the run; default 0. "
+                              "With -index_stride, splits a run into disjoint slices "
+                              "for several machines, see shard_plan.py"),
+                        default=0,
+                        metavar="<int>")
+
+    parser.add_argument('-index_stride',
+                        help=("(int) Distance between the indices of consecutive "
+                              "instances; default 1"),
+                        default=1,
+                        metavar="<int>")
+
     parser.add_argument('-metadata_file',
                         help=("(str) Path to a file which shall be used to store simple "
                               "json metadata about the generated instances"),
                         metavar="<path>")
 
+    parser.add_argument('-workers',
+                        help=("(int) Number of worker processes used to generate instances; "
+                              "default {}. The output only depends on the seed, not on the "
+                              "number of workers".format(DEFAULT_NUM_WORKERS)),
+                        default=DEFAULT_NUM_WORKERS,
+                        metavar="<int>")
+
+    parser.add_argument('-num_shards',
+                        help=("(int) If positive, then pack the instances and their tags "
+                              "into this many shard files instead of writing one .c file "
+                              "per instance; read them back with shards.ShardReader. "
+                              "Default {}".format(DEFAULT_NUM_SHARDS)),
+                        default=DEFAULT_NUM_SHARDS,
+                        metavar="<int>")
+
+    parser.add_argument('-writer_threads',
+                        help=("(int) If positive, then write the .c files from this many "
+                              "background threads, so that generation overlaps with I/O; "
+                              "default {}".format(DEFAULT_WRITER_THREADS)),
+                        default=DEFAULT_WRITER_THREADS,
+                        metavar="<int>")
+
+    parser.add_argument('-write_queue_depth',
+                        help=("(int) Maximum number of instances waiting for a writer "
+                              "thread; generation blocks when it is reached. Default "
+                              "{}".format(DEFAULT_WRITE_QUEUE_DEPTH)),
+                        default=DEFAULT_WRITE_QUEUE_DEPTH,
+                        metavar="<int>")
+
+    parser.add_argument('--fsync',
+                        action='store_true',
+                        help=("If passed, then the writer threads flush each batch of "
+                              ".c files to disk"))
+
+    parser.add_argument('-manifest_stream',
+                        help=("(str) Path to a JSON Lines file to which the tags of each "
+                              "instance are appended as soon as it is written. Tags are "
+                              "then not kept in memory; the metadata_file, if any, is "
+                              "converted from this file at the end. The filename hashes "
+                              "of the collision check (8-byte slots, 11 to 21 bytes per "
+                              "instance) are memory-mapped from <path>.fnames, removed "
+                              "at the end"),
+                        metavar="<path>")
+
+    parser.add_argument('-tag_store',
+                        help=("(str) Path to a binary tag store to write next to the "
+                              "metadata, which loaders can memory-map; see tag_store.py"),
+                        metavar="<path>")
+
+    parser.add_argument('-token_store',
+                        help=("(str) Path to a store of the token ids of each line of "
+                              "each instance, aligned to the tags, with the fixed "
+                              "vocabulary of token_store.py"),
+                        metavar="<path>")
+
+    parser.add_argument('-dedup_index',
+                        help=("(str) Path to a directory of dedup indices of earlier "
+                              "datasets; see dedup_index.py"),
+                        metavar="<path>")
+
+    parser.add_argument('-exclude_datasets',
+                        help=("(str) Comma-separated names of datasets in -dedup_index; "
+                              "instances already in one of them are rejected, e.g. to "
+                              "keep a test set disjoint from the training set"),
+                        metavar="<names>")
+
+    parser.add_argument('-register_dataset',
+                        help=("(str) Name under which to add the generated instances to "
+                              "-dedup_index, so that later runs can exclude them"),
+                        metavar="<name>")
+
+    parser.add_argument('-checkpoint_file',
+                        help=("(str) Path to a file to which the state of the run is saved "
+                              "periodically, so that an interrupted run can be resumed "
+                              "with --resume. Unless -manifest_stream is passed, the tags "
+                              "are journaled to <checkpoint_file>.jsonl"),
+                        metavar="<path>")
+
+    parser.add_argument('-checkpoint_every',
+                        help=("(int) Number of instances between checkpoints; default "
+                              "{}".format(DEFAULT_CHECKPOINT_EVERY)),
+                        default=DEFAULT_CHECKPOINT_EVERY,
+                        metavar="<int>")
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help=("If passed, then resume the run saved in -checkpoint_file; "
+                              "the result is the same as that of an uninterrupted run"))
+
+    parser.add_argument('--append',
+                        action='store_true',
+                        help=("If passed, then add num_instances instances to the "
+                              "dataset of -metadata_file, written to outdir by an earlier "
+                              "run with -manifest_stream: the run goes on from the index "
+                              "where that run stopped, skips the filenames of the stream "
+                              "and writes only the new instances. The new records are "
+                              "appended to the stream and to the end of the manifest, "
+                              "in place. Requires the -manifest_stream of the dataset"))
+
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help=("If passed, then time the stages of the run, count "
+                              "collisions and bytes written, report progress to stderr "
+                              "and save the stats to {} next to the metadata_file (or "
+                              "in outdir); see run_stats.py".format(
+                                  run_stats.STATS_FNAME)))
+
+    parser.add_argument('--dataset_stats',
+                        action='store_true',
+                        help=("If passed, then keep counters (tags, collisions) and "
+                              "histograms (line counts, sampled lengths and indices) of "
+                              "the dataset while generating it, and save them to {} next "
+                              "to the metadata_file (or in outdir); see "
+                              "dataset_stats.py".format(dataset_stats.STATS_FNAME)))
+
+    parser.add_argument('-cond_safe_ratio',
+                        help=("(float) Fraction of BUFWRITE_COND_SAFE among the conditional "
+                              "buffer writes, e.g. 0.5 for a balanced dataset. The label "
+                              "follows from the instance index, so that any N consecutive "
+                              "indices from 0 hold round(N * ratio) safe ones (instances "
+                              "dropped as collisions aside), and the values are sampled "
+                              "directly within the label, so this costs no rejections. "
+                              "Default: unconstrained uniform draws"),
+                        metavar="<float>")
+
+    parser.add_argument('-taut_safe_ratio',
+                        help=("(float) Fraction of BUFWRITE_TAUT_SAFE among the dummy "
+                              "buffer writes. Each instance with n dummies gets floor or "
+                              "ceil of n * ratio safe ones, balanced across instances, so "
+                              "the ratio is met closely but not exactly; default: "
+                              "unconstrained uniform draws"),
+                        metavar="<float>")
+
+    parser.add_argument('-variants',
+                        help=("(str) Which variants of each instance to write: "
+                              "'annotated' (each line ends with its tag as a comment), "
+                              "'clean' (no comments, the tags only go to the metadata) "
+                              "or 'both' (clean in outdir, annotated in "
+                              "outdir/{}). Both variants come from one render, and the "
+                              "filenames are hashes of the clean source in every "
+                              "variant. Default {}".format(ANNOTATED_DIRNAME,
+                                                           DEFAULT_VARIANTS)),
+                        choices=VARIANTS,
+                        default=DEFAULT_VARIANTS)
+
+    parser.add_argument('--skeletons',
+                        help=("If passed, then stamp the values of each instance into a "
+                              "cached, pre-rendered skeleton of its setup layout and "
+                              "place its dummy buffer writes among the skeleton lines, "
+                              "instead of assembling it line by line; about 1.5 times "
+                              "as fast with the default settings. The output is the "
+                              "same"),
+                        action='store_true')
+
+    parser.add_argument('--canonical_dedup',
+                        action='store_true',
+                        help=("If passed, then also reject instances equal to one already "
+                              "generated up to the names of the variables and the dummy "
+                              "characters (see canonicalize_instance), and report the rate "
+                              "of such duplicates. The canonical hashes are saved to {} "
+                              "next to the metadata_file (or in outdir), from which "
+                              "--append and --resume load them".format(
+                                  CANONICAL_NAMES_FNAME)))
+
     parser.add_argument('--taut_only',
                         action='store_true',
                         help=("If passed, then generate examples with only flow-insensitive "
@@ -508,19 +1433,71 @@ def _get_args():
                         action='store_true',
                         help="If passed, then generate only flow-insensitive linear examples")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args  # 返回从命令行解析之后的参数
 
 
 def main(args):
     """With fixed initial seed, generate instances and save as C files
 
+    Every instance is generated from its own seed, derived from the run seed
+    and the instance index (see _get_instance_seed), so the instances can be
+    spread over several worker processes. Records are merged in index order,
+    which makes the file set and the metadata independent of the number of
+    workers, collisions included.
+
+    With a checkpoint file, the state of the run is saved every
+    checkpoint_every instances. The tags then go to a manifest stream (the
+    journal), from which a resumed run restores the filenames written so far.
+
     Args:
         args (argparse.Namespace), with attributes:
             num_instances (int): how many instances to generate
             outdir (str): path to directory to save instances; must exist
-            seed (int): seed to use for random.seed(). If -1, then seed by
+            seed (int): seed of the run. If -1, then draw the run seed from
                 default Python seeding
+            index_offset (int): index of the first instance
+            index_stride (int): distance between the indices of consecutive
+                instances; the indices are index_offset + k * index_stride
+            workers (int): number of worker processes
+            num_shards (int): number of shard files to pack the instances
+                into; if 0, then write one .c file per instance
+            writer_threads (int): number of threads writing the .c files; if
+                0, then each instance is written before the next is generated
+            write_queue_depth (int): maximum number of instances waiting for
+                a writer thread
+            fsync (bool): whether the writer threads flush each batch of
+                files to disk
+            metadata_file (str): path of the manifest.json to write, or None
+            manifest_stream (str): path of the manifest stream to write,
+                or None
+            tag_store (str): path of the binary tag store to write, or None
+            token_store (str): path of the token store to write, or None
+            dedup_index (str): path of the dedup index directory, or None
+            exclude_datasets (str): comma-separated names of datasets in
+                dedup_index whose instances are rejected, or None
+            register_dataset (str): name under which to add the generated
+                instances to dedup_index, or None
+            checkpoint_file (str): path of the checkpoint to write, or None
+            checkpoint_every (int): number of instances between checkpoints
+            resume (bool): whether to resume from checkpoint_file
+            append (bool): whether to add num_instances instances to the
+                dataset of metadata_file and manifest_stream, continuing its
+                run
+            stats (bool): whether to collect and save run_stats.RunStats
+            dataset_stats (bool): whether to collect and save
+                dataset_stats.DatasetStats
+            cond_safe_ratio (float): target fraction of safe conditional
+                buffer writes, or None
+            taut_safe_ratio (float): target fraction of safe dummy buffer
+                writes, or None
+            skeletons (bool): whether to generate from cached skeletons
+            variants (str): which variants of each instance to write, one of
+                VARIANTS
+            canonical_dedup (bool): whether to reject instances whose
+                canonical form (see canonicalize_instance) was generated;
+                the canonical hashes are saved to CANONICAL_NAMES_FNAME, from
+                which --append and --resume load them
 
     Returns: 0 if no error
     """
@@ -531,52 +1508,669 @@ def main(args):
     if not os.path.isdir(outdir):  # 判断路径是否为目录
         raise OSError("outdir does not exist: '{}'".format(outdir))
 
-    # set seed
-    seed = int(args.seed)
-    if seed != -1:
-        random.seed(seed)
+    index_offset = int(args.index_offset)
+    index_stride = int(args.index_stride)
+    if index_offset < 0 or index_stride < 1:
+        raise ValueError("index_offset must not be negative and index_stride "
+                         "must be positive: {}, {}".format(index_offset,
+                                                          index_stride))
+
+    workers = int(args.workers)
+    if workers < 1:
+        raise ValueError("workers must be positive: {}".format(workers))
+
+    num_shards = int(args.num_shards)
+    if num_shards < 0:
+        raise ValueError("num_shards must not be negative: {}".format(
+            num_shards))
+
+    writer_threads = int(args.writer_threads)
+    write_queue_depth = int(args.write_queue_depth)
+    if writer_threads < 0:
+        raise ValueError("writer_threads must not be negative: {}".format(
+            writer_threads))
+    if write_queue_depth < 1:
+        raise ValueError("write_queue_depth must be positive: {}".format(
+            write_queue_depth))
+    if writer_threads and num_shards:
+        raise ValueError("-writer_threads only applies to .c files, not to "
+                         "-num_shards")
+    if args.fsync and not writer_threads:
+        raise ValueError("--fsync requires -writer_threads")
+
+    checkpoint_file = args.checkpoint_file
+    if args.token_store is not None and checkpoint_file is not None:
+        raise ValueError("-token_store cannot be combined with "
+                         "-checkpoint_file; tokenize the finished dataset "
+                         "with token_store.py instead")
+    if args.append:
+        if args.metadata_file is None:
+            raise ValueError("--append requires -metadata_file")
+        if args.manifest_stream is None:
+            raise ValueError("--append requires the -manifest_stream of the "
+                             "dataset, to which the new records are added")
+        if (checkpoint_file is not None or args.token_store is not None or
+                args.tag_store is not None):
+            raise ValueError("--append cannot be combined with "
+                             "-checkpoint_file, -token_store or -tag_store; "
+                             "build the stores of the whole dataset with "
+                             "token_store.py or tag_store.py instead")
+        if num_shards:
+            raise ValueError("--append only applies to .c files, not to "
+                             "-num_shards")
+        if index_offset:
+            raise ValueError("--append continues from the index saved in "
+                             "the manifest; -index_offset does not apply")
+    checkpoint_every = int(args.checkpoint_every)
+    if checkpoint_every < 1:
+        raise ValueError("checkpoint_every must be positive: {}".format(
+            checkpoint_every))
+
+    if args.exclude_datasets:
+        exclude_datasets = args.exclude_datasets.split(",")
+    else:
+        exclude_datasets = []
+    if ((exclude_datasets or args.register_dataset is not None) and
+            args.dedup_index is None):
+        raise ValueError("-exclude_datasets and -register_dataset require "
+                         "-dedup_index")
 
-    tag_metadata = {} # store instance tag metadata
     taut_only = args.taut_only
     include_cond_bufwrite = not taut_only # 要么所有代码实例都包含cond_buf_write，要不都不包含
-    inst_num = 0
+    ratios = {}
+    for name in ("cond_safe_ratio", "taut_safe_ratio"):
+        value = getattr(args, name)
+        if value is not None:
+            value = float(value)
+            if not 0 <= value <= 1:
+                raise ValueError("{} must be in [0, 1]: {}".format(name, value))
+        ratios[name] = value
+    gen_kwargs = dict(ratios, include_cond_bufwrite=include_cond_bufwrite,
+                      skeletons=args.skeletons)
+    variants = args.variants
+    if variants not in VARIANTS:
+        raise ValueError("variants must be one of {}: '{}'".format(
+            ", ".join(VARIANTS), variants))
     num_instances = int(args.num_instances)
-    while inst_num < num_instances:
-        # generate example
-        instance_str, tags = gen_cond_example(
-            include_cond_bufwrite=include_cond_bufwrite)
-
-        # generate filename by instance_str
-        fname = _generate_file_name(instance_str)
-        if fname in tag_metadata:  # 如果刚好生成的两个文件名一样，那就说明这两个文件是一样的。
-            # Collision, try again
-            continue
-
-        # insert record into metadata for this c file
-        tag_metadata[fname] = [tag.value for tag in tags]
-
-        # write instance_str to file
-        path = os.path.join(outdir, fname)
-        with open(path, 'w') as f:
-            f.write(instance_str)
 
-        inst_num += 1
+    # set seed
+    seed = int(args.seed)
+    if args.resume:
+        if checkpoint_file is None:
+            raise ValueError("--resume requires -checkpoint_file")
+        checkpoint = _load_checkpoint(checkpoint_file)
+        _check_checkpoint(checkpoint, seed, num_instances, taut_only,
+                          num_shards, exclude_datasets, ratios, variants,
+                          index_stride, args.canonical_dedup)
+        seed = checkpoint["seed"]
+    elif args.append:
+        checkpoint = None
+        append_header = manifest.read_manifest_header(args.metadata_file)
+        _check_append_header(append_header, args.metadata_file, outdir, seed,
+                             index_stride, taut_only, ratios, variants,
+                             args.canonical_dedup)
+        if args.canonical_dedup:
+            _check_canonical_names(
+                os.path.join(os.path.dirname(os.path.abspath(
+                    args.metadata_file)), CANONICAL_NAMES_FNAME),
+                append_header["num_instances"])
+        seed = append_header["seed"]
+    else:
+        checkpoint = None
+        if seed == -1:
+            seed = random.randrange(2 ** 64)
+
+    # with a manifest stream, the tags go to the stream, so that only the
+    # filename hashes have to be kept for collision checks, in a table
+    # memory-mapped from <stream>.fnames (see dedup_index.FnameSet)
+    journal = args.manifest_stream
+    if journal is None and checkpoint_file is not None:
+        journal = checkpoint_file + ".jsonl"
+    fnames = dedup_index.FnameSet(
+        FNAME_HASHLEN, journal + ".fnames" if journal is not None else None)
+    tag_metadata = {} # store instance tag metadata
+    num_existing = 0
+    if args.append:
+        # only the filenames of the dataset are loaded, from its manifest
+        # stream; the new records are appended to the stream, and from it
+        # to the end of the manifest
+        fnames.update(fname for (fname, _, _)
+                      in manifest.iter_manifest_stream(journal))
+        if len(fnames) != append_header["num_instances"]:
+            fnames.close()
+            raise ValueError("Manifest stream '{}' has {} instances, the "
+                             "manifest {}".format(
+                                 journal, len(fnames),
+                                 append_header["num_instances"]))
+        stream = manifest.ManifestStreamWriter(journal, 'a')
+        append_offset = stream.tell()
+        index = append_header["next_index"]
+        num_existing = len(fnames)
+        inst_num = 0
+        shard_sizes = None
+        annotated_shard_sizes = None
+        saved_dataset_stats = None
+    elif checkpoint is None:
+        stream = (manifest.ManifestStreamWriter(journal)
+                  if journal is not None else None)
+        index = index_offset
+        inst_num = 0
+        shard_sizes = None
+        annotated_shard_sizes = None
+        saved_dataset_stats = None
+    else:
+        if checkpoint["journal"] != journal:
+            raise ValueError("Checkpoint was written with manifest stream "
+                             "'{}'".format(checkpoint["journal"]))
+        manifest.truncate_manifest_stream(journal, checkpoint["journal_size"])
+        fnames.update(fname for (fname, _, _)
+                      in manifest.iter_manifest_stream(journal))
+        stream = manifest.ManifestStreamWriter(journal, 'a')
+        index = checkpoint["next_index"]
+        inst_num = checkpoint["num_written"]
+        shard_sizes = checkpoint["shard_sizes"]
+        annotated_shard_sizes = checkpoint["annotated_shard_sizes"]
+        saved_dataset_stats = checkpoint.get("dataset_stats")
 
     # Generate metadata only if the metadata_file argument is present
     generate_metadata = args.metadata_file is not None
     if generate_metadata:
+        stats_dir = os.path.dirname(os.path.abspath(args.metadata_file))
+    else:
+        stats_dir = outdir
+    data_stats_path = os.path.join(stats_dir, dataset_stats.STATS_FNAME)
+
+    # canonical hashes of the instances written so far, saved as they are
+    # written to canonical_names.txt next to the manifest
+    if not args.canonical_dedup:
+        canonical_names = None
+        canonical_file = None
+    else:
+        canonical_path = os.path.join(stats_dir, CANONICAL_NAMES_FNAME)
+        canonical_names, canonical_file = _open_canonical_names(
+            canonical_path, num_existing + inst_num,
+            journal + ".canonical" if journal is not None else None)
+
+    writer = _open_writer(outdir, num_shards, shard_sizes, writer_threads,
+                          write_queue_depth, args.fsync)
+    if variants == "both":
+        annotated_dir = os.path.join(outdir, ANNOTATED_DIRNAME)
+        os.makedirs(annotated_dir, exist_ok=True)
+        annotated_writer = _open_writer(
+            annotated_dir, num_shards, annotated_shard_sizes, writer_threads,
+            write_queue_depth, args.fsync)
+    else:
+        annotated_writer = None
+
+    if args.token_store is not None:
+        # imported here, as its vocabulary is built from this module
+        import token_store
+        token_writer = token_store.TokenStoreWriter(args.token_store,
+                                                    FNAME_HASHLEN)
+    else:
+        token_writer = None
+
+    if exclude_datasets:
+        excluded = dedup_index.DedupIndex(args.dedup_index, exclude_datasets)
+    else:
+        excluded = ()
+
+    if args.stats:
+        stats = run_stats.RunStats(num_instances)
+    else:
+        stats = run_stats.NULL_STATS
+
+    if not args.dataset_stats:
+        data_stats = dataset_stats.NULL_DATASET_STATS
+    elif saved_dataset_stats is not None:
+        data_stats = dataset_stats.DatasetStats.from_summary(
+            saved_dataset_stats)
+    elif args.append and os.path.isfile(data_stats_path):
+        data_stats = dataset_stats.load(data_stats_path)
+    else:
+        data_stats = dataset_stats.DatasetStats()
+
+    records = _iter_records(seed, gen_kwargs, workers, index,
+                            with_stats=args.stats or args.dataset_stats,
+                            variants=variants, index_stride=index_stride,
+                            canonical=args.canonical_dedup)
+    next_index = index
+    num_attempts = 0
+    num_canonical_duplicates = 0
+    try:
+        with _enter_writers(writer, annotated_writer):
+            while inst_num < num_instances:
+                # generate example, filename generated by instance_str
+                (index, instance_str, tag_values, fname, annotated_str,
+                 stage_times, sampled_values, canonical_name) = next(records)
+                num_attempts += 1
+                stats.split("generate")
+                stats.add_times(stage_times)
+                stats.count("attempts")
+                data_stats.count("attempts")
+                if fname in fnames:  # 如果刚好生成的两个文件名一样，那就说明这两个文件是一样的。
+                    # Collision, try again
+                    stats.count("collisions")
+                    data_stats.count("collisions")
+                    continue
+                if fname in excluded:
+                    # in an earlier dataset, try again
+                    stats.count("excluded")
+                    data_stats.count("excluded")
+                    continue
+                if canonical_names is not None:
+                    if canonical_name in canonical_names:
+                        # renamed copy of an earlier instance, try again
+                        num_canonical_duplicates += 1
+                        stats.count("canonical_duplicates")
+                        data_stats.count("canonical_duplicates")
+                        continue
+                    canonical_names.add(canonical_name)
+
+                # insert record into metadata for this c file
+                fnames.add(fname)
+                if stream is None:
+                    tag_metadata[fname] = tag_values
+                else:
+                    stream.write(fname, index, tag_values)
+                if canonical_file is not None:
+                    canonical_file.write(canonical_name + "\n")
+
+                # write instance_str to file (or shard)
+                stats.count("bytes_written",
+                            writer.write(fname, instance_str, tag_values))
+                if annotated_writer is not None:
+                    stats.count("bytes_written", annotated_writer.write(
+                        fname, annotated_str, tag_values))
+                if token_writer is not None:
+                    token_writer.write(fname, instance_str, tag_values)
+                stats.split("write")
+
+                inst_num += 1
+                next_index = index + index_stride
+                stats.count("instances")
+                data_stats.add_instance(tag_values, sampled_values)
+                if checkpoint_file is not None and (
+                        inst_num % checkpoint_every == 0 or
+                        inst_num == num_instances):
+                    if canonical_file is not None:
+                        _sync_size(canonical_file)
+                    _save_checkpoint(checkpoint_file, {
+                        "seed": seed,
+                        "num_instances": num_instances,
+                        "taut_only": taut_only,
+                        "num_shards": num_shards,
+                        "exclude_datasets": exclude_datasets,
+                        "cond_safe_ratio": ratios["cond_safe_ratio"],
+                        "taut_safe_ratio": ratios["taut_safe_ratio"],
+                        "variants": variants,
+                        "index_stride": index_stride,
+                        "canonical_dedup": args.canonical_dedup,
+                        "next_index": next_index,
+                        "num_written": inst_num,
+                        "journal": journal,
+                        "journal_size": _sync_size(stream),
+                        "shard_sizes": writer.sync(),
+                        "annotated_shard_sizes": (
+                            annotated_writer.sync()
+                            if annotated_writer is not None else None),
+                        "dataset_stats": (data_stats.summary()
+                                          if args.dataset_stats else None)
+                    })
+                    stats.split("checkpoint")
+                stats.progress(inst_num)
+    except BaseException:
+        _stop_records(records)
+        raise
+    finally:
+        records.close()
+        if stream is not None:
+            stream.close()
+        if exclude_datasets:
+            excluded.close()
+        if token_writer is not None:
+            token_writer.close()
+        if canonical_file is not None:
+            canonical_file.close()
+
+    if args.canonical_dedup:
+        sys.stderr.write("{} of {} attempts were canonical duplicates "
+                         "({:.2%})\n".format(
+                             num_canonical_duplicates, num_attempts,
+                             num_canonical_duplicates / max(num_attempts, 1)))
+
+    if args.register_dataset is not None:
+        dedup_index.write_dataset_set(args.dedup_index, args.register_dataset,
+                                      fnames)
+    fnames.close()
+    if canonical_names is not None:
+        canonical_names.close()
+
+    # the state from which --append continues the run
+    run_state = {
+        "seed": seed,
+        "index_stride": index_stride,
+        "next_index": next_index,
+        "taut_only": taut_only,
+        "variants": variants,
+        "canonical_dedup": args.canonical_dedup
+    }
+    run_state.update(sorted(ratios.items()))
+    if args.append:
+        manifest.append_to_manifest(
+            args.metadata_file,
+            ((fname, tag_values) for (fname, _, tag_values)
+             in manifest.iter_manifest_stream(journal, append_offset)),
+            num_existing + num_instances, run_state)
+    elif generate_metadata and stream is not None:
+        manifest.convert_stream_to_manifest(
+            journal, args.metadata_file, outdir, num_existing + num_instances,
+            run_state)
+    elif generate_metadata:
         # construct the complete metadata
         metadata = {
             "working_dir": outdir,
-            "num_instances": num_instances,
-            "tags": tag_metadata
+            "num_instances": num_instances
         }
+        metadata.update(run_state)
+        metadata["tags"] = tag_metadata
         with open(args.metadata_file, 'w') as f:
             json.dump(metadata, f)
 
+    if args.tag_store is not None:
+        if stream is not None:
+            tag_items = ((fname, tag_values) for (fname, _, tag_values)
+                         in manifest.iter_manifest_stream(journal))
+        else:
+            tag_items = tag_metadata.items()
+        tag_store.write_tag_store(args.tag_store, tag_items, FNAME_HASHLEN)
+
+    if args.dataset_stats:
+        data_stats.write(data_stats_path)
+    if args.stats:
+        stats.split("metadata")
+        stats.write(os.path.join(stats_dir, run_stats.STATS_FNAME))
+
     return 0
 
 
+def _open_writer(outdir, num_shards, shard_sizes, writer_threads,
+                 write_queue_depth, fsync):
+    """Open the writer of the instances, see main() for the arguments
+
+    Returns:
+        writer: shards.ShardWriter, writers.PipelinedFileWriter or
+            writers.FileWriter
+    """
+    if num_shards:
+        return shards.ShardWriter(outdir, num_shards, FNAME_HASHLEN,
+                                  shard_sizes)
+    if writer_threads:
+        return writers.PipelinedFileWriter(outdir, writer_threads,
+                                           write_queue_depth, fsync)
+    return writers.FileWriter(outdir)
+
+
+def _enter_writers(*writers):
+    """Enter the writers which are not None, in one with statement
+
+    Each writer leaves the with statement knowing whether it was left on an
+    exception, e.g. a ShardWriter then keeps its indices to resume from.
+    """
+    stack = contextlib.ExitStack()
+    for writer in writers:
+        if writer is not None:
+            stack.enter_context(writer)
+    return stack
+
+
+def _sync_size(stream):
+    """Flush a manifest stream (or file) to disk and get its size in bytes"""
+    if isinstance(stream, manifest.ManifestStreamWriter):
+        stream.sync()
+    else:
+        stream.flush()
+        os.fsync(stream.fileno())
+    return stream.tell()
+
+
+def _save_checkpoint(checkpoint_file, checkpoint):
+    """Atomically replace the checkpoint file
+
+    Args:
+        checkpoint_file (str): path of the checkpoint
+        checkpoint (dict): state of the run, see main()
+    """
+    tmp_path = checkpoint_file + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_file)
+
+
+def _load_checkpoint(checkpoint_file):
+    """Load the state of an interrupted run saved by _save_checkpoint"""
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+def _check_checkpoint(checkpoint, seed, num_instances, taut_only,
+                      num_shards, exclude_datasets, ratios, variants,
+                      index_stride, canonical_dedup):
+    """Check that a checkpoint belongs to a run with the given arguments
+
+    Args:
+        ratios (dict): cond_safe_ratio and taut_safe_ratio of the run
+
+    Raises:
+        ValueError: if the arguments do not match those of the checkpoint
+    """
+    if seed != -1 and seed != checkpoint["seed"]:
+        raise ValueError("Checkpoint was written with seed {}".format(
+            checkpoint["seed"]))
+    for (name, value) in [("num_instances", num_instances),
+                          ("taut_only", taut_only),
+                          ("num_shards", num_shards),
+                          ("exclude_datasets", exclude_datasets),
+                          ("variants", variants),
+                          ("index_stride", index_stride),
+                          ("canonical_dedup", canonical_dedup)] + sorted(
+                              ratios.items()):
+        if checkpoint.get(name) != value:
+            raise ValueError("Checkpoint was written with {} {}".format(
+                name, checkpoint.get(name)))
+
+
+def _check_append_header(header, metadata_file, outdir, seed, index_stride,
+                         taut_only, ratios, variants, canonical_dedup):
+    """Check that --append can continue the run of a manifest
+
+    Args:
+        header (dict): top-level entries of the manifest, see
+            manifest.read_manifest_header
+        ratios (dict): cond_safe_ratio and taut_safe_ratio of the run
+
+    Raises:
+        ValueError: if the manifest has no run state, or if the arguments
+            do not match it
+    """
+    if "next_index" not in header:
+        raise ValueError("'{}' has no next_index to continue from; it was "
+                         "not written by main()".format(metadata_file))
+    if header["working_dir"] != outdir:
+        raise ValueError("The instances of '{}' are in '{}'".format(
+            metadata_file, header["working_dir"]))
+    if seed != -1 and seed != header["seed"]:
+        raise ValueError("'{}' was written with seed {}".format(
+            metadata_file, header["seed"]))
+    for (name, value) in [("index_stride", index_stride),
+                          ("taut_only", taut_only),
+                          ("variants", variants),
+                          ("canonical_dedup", canonical_dedup)] + sorted(
+                              ratios.items()):
+        if header.get(name) != value:
+            raise ValueError("'{}' was written with {} {}".format(
+                metadata_file, name, header.get(name)))
+
+
+def _get_instance_seed(seed, index):
+    """Derive the seed of a single instance from the run seed and its index
+
+    Args:
+        seed (int): seed of the run
+        index (int): index of the instance in the run, counting collisions
+
+    Returns:
+        instance_seed (int)
+    """
+    key = "{}:{}".format(seed, index).encode('utf-8')
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big')
+
+
+def _generate_record(task):
+    """Generate the instance with the given index; run in worker processes
+
+    The instance is rendered once, without tag comments, and named by the
+    hash of that clean source whatever the variants, so that an instance
+    has the same filename in every variant; the annotated variant, if
+    needed, only adds the comments.
+
+    Args:
+        task (tuple): (seed, index, gen_kwargs, with_stats, variants,
+            canonical), where gen_kwargs (dict) are keyword arguments of
+            generate_instance, variants (str) is one of VARIANTS and
+            canonical (bool) whether to hash the canonical form
+
+    Returns:
+        index (int): index of the instance
+        instance_str (str): str of code example, annotated unless variants
+            is "clean" or "both"
+        tag_values (list of int): value of the tag of each line
+        fname (str): filename generated by the clean source
+        annotated_str (str): instance_str with tag comments if variants is
+            "both", else None
+        stage_times (dict): seconds spent in each stage of generating the
+            instance if with_stats, else None
+        sampled_values (dict): name -> list of the values sampled for the
+            instance (see run_stats.StageTimer.observe) if with_stats, else
+            None
+        canonical_name (str): hash of the canonical form of the clean
+            source if canonical, else None
+    """
+    seed, index, gen_kwargs, with_stats, variants, canonical = task
+    timer = run_stats.StageTimer() if with_stats else run_stats.NULL_TIMER
+    clean_str, tags = generate_instance(
+        seed, index, timer=timer, tags_as_comments=False, **gen_kwargs)
+    if variants == "clean":
+        instance_str = clean_str
+        annotated_str = None
+    else:
+        annotated_str = annotate_instance(clean_str, tags)
+        timer.split("render")
+        if variants == "annotated":
+            instance_str = annotated_str
+            annotated_str = None
+        else:
+            instance_str = clean_str
+    fname = _generate_file_name(clean_str)
+    if canonical:
+        canonical_name = _generate_canonical_name(clean_str)
+    else:
+        canonical_name = None
+    timer.split("hashing")
+    return (index, instance_str, [tag.value for tag in tags], fname,
+            annotated_str, timer.times, timer.values, canonical_name)
+
+
+def _init_worker():
+    """Leave Ctrl-C to the main process, which terminates the pool
+
+    A worker interrupted while taking a task can die holding the lock of the
+    task queue, on which Pool.terminate() then blocks forever.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _iter_records(seed, gen_kwargs, workers, start_index=0,
+                  chunksize=WORKER_CHUNKSIZE, with_stats=False,
+                  variants=DEFAULT_VARIANTS, index_stride=1, canonical=False):
+    """Yield generated records in index order, without end
+
+    With more than one worker, batches of indices are handed to a process
+    pool; at most two batches are in flight so that memory stays bounded.
+    Closing the generator waits for them; after an exception, stop it with
+    _stop_records instead.
+
+    Args:
+        seed (int): seed of the run
+        gen_kwargs (dict): keyword arguments of generate_instance, e.g.
+            include_cond_bufwrite
+        workers (int): number of worker processes
+        start_index (int): index of the first instance
+        chunksize (int): number of instances handed to a worker at a time
+        with_stats (bool): whether to time the stages of each instance and
+            record its sampled values
+        variants (str): which variants of each instance to render, one of
+            VARIANTS
+        index_stride (int): distance between the indices of consecutive
+            instances
+        canonical (bool): whether to hash the canonical form of each
+            instance
+
+    Yields:
+        record (tuple): see _generate_record
+    """
+    index = start_index
+    if workers == 1:
+        while True:
+            yield _generate_record((seed, index, gen_kwargs, with_stats,
+                                    variants, canonical))
+            index += index_stride
+
+    batch_size = workers * chunksize
+    pool = multiprocessing.Pool(workers, _init_worker)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < 2:
+                end = index + batch_size * index_stride
+                tasks = [(seed, idx, gen_kwargs, with_stats, variants,
+                          canonical)
+                         for idx in range(index, end, index_stride)]
+                pending.append(
+                    pool.map_async(_generate_record, tasks, chunksize))
+                index = end
+            for record in pending.popleft().get():
+                yield record
+    except GeneratorExit:
+        # terminating the pool while batches are in flight can deadlock its
+        # handler threads, so let them finish when the caller is done; the
+        # caller stops the pool with _StopRecords instead on an exception
+        for result in pending:
+            result.wait()
+        raise
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class _StopRecords(Exception):
+    """Thrown into _iter_records to stop its pool without waiting for it"""
+
+
+def _stop_records(records):
+    """Stop a generator of _iter_records after an exception of its caller
+
+    Unlike records.close(), this does not wait for the batches in flight:
+    workers killed by the same Ctrl-C as the caller never complete theirs.
+    """
+    try:
+        records.throw(_StopRecords())
+    except _StopRecords:
+        pass
+
+
 def _generate_file_name(instance_str):
     """generate filename according to instance_str"""
     byte_obj = bytes(instance_str, 'utf-8')
@@ -585,6 +2179,60 @@ def _generate_file_name(instance_str):
     return fname
 
 
+def _generate_canonical_name(instance_str):
+    """Hash the canonical form of instance_str, see canonicalize_instance"""
+    byte_obj = bytes(canonicalize_instance(instance_str), 'utf-8')
+    return hashlib.shake_128(byte_obj).hexdigest(FNAME_HASHLEN)
+
+
+def _check_canonical_names(path, num_names):
+    """Check that a canonical names file has at least num_names hashes
+
+    Raises:
+        ValueError: if it has fewer, e.g. if the run was generated without
+            --canonical_dedup
+    """
+    line_len = 2 * FNAME_HASHLEN + 1
+    size = os.path.getsize(path) if os.path.isfile(path) else 0
+    if size < num_names * line_len:
+        raise ValueError("'{}' has {} canonical names, but {} instances were "
+                         "written; was the run generated with "
+                         "--canonical_dedup?".format(
+                             path, size // line_len, num_names))
+
+
+def _open_canonical_names(path, num_names, table_path=None):
+    """Load the canonical hashes of a run and open their file to append
+
+    The file has one hash per line, in the order the instances were
+    written; lines after the first num_names, written after the last
+    checkpoint of an interrupted run, are dropped.
+
+    Args:
+        path (str): path of the canonical names file
+        num_names (int): number of instances written so far, 0 for a new run
+        table_path (str): file to memory-map the set from, see
+            dedup_index.FnameSet; if None, then it is held in memory
+
+    Returns:
+        canonical_names (dedup_index.FnameSet): the first num_names hashes
+        canonical_file (file): path, open to append
+
+    Raises:
+        ValueError: if the file has fewer than num_names hashes, e.g. if the
+            earlier run was generated without --canonical_dedup
+    """
+    if not num_names:
+        return (dedup_index.FnameSet(FNAME_HASHLEN, table_path),
+                open(path, 'w'))
+    _check_canonical_names(path, num_names)
+    os.truncate(path, num_names * (2 * FNAME_HASHLEN + 1))
+    canonical_names = dedup_index.FnameSet(FNAME_HASHLEN, table_path)
+    with open(path) as f:
+        canonical_names.update(line.rstrip("\n") for line in f)
+    return canonical_names, open(path, 'a')
+
+
 if __name__ == '__main__':
     RET = main(_get_args())
     sys.exit(RET)
@@ -0,0 +1,283 @@
+"""gen_server.py: long-running generator serving records over localhost HTTP
+
+Instead of starting a container and a Python process per dataset, one
+server stays up and generates batches of instances on request; several
+trainers can share it. A request names the run by its seed and the range of
+instance indices it wants:
+
+    GET /records?seed=0&offset=0&count=1000
+
+and receives the records as a JSON Lines stream, one per index, in order:
+    {"fname": "4a2405d586.c", "index": 17, "tags": [0, 0, ...],
+     "instance": "#include <stdlib.h>\\n..."}
+i.e. a manifest stream record (see manifest.py) with the instance. The
+instance with a given index is that of gen_cond_example.generate_instance,
+so the records do not depend on how a run is split into requests, nor on
+the number of workers. Collisions are not skipped: clients which need
+unique instances drop repeated fnames, as gen_cond_example.main() does.
+
+Optional query parameters, with the meaning of the options of
+gen_cond_example.py: taut_only (0 or 1), cond_safe_ratio, taut_safe_ratio,
+skeletons (0 or 1) and variants; with variants=both, each record also has
+the "annotated" instance.
+
+e.g. serve with 4 worker processes, then fetch a batch:
+    python sa_babi/gen_server.py -workers 4
+    curl 'http://127.0.0.1:8765/records?seed=0&offset=0&count=10'
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import multiprocessing
+import signal
+import socketserver
+import sys
+import urllib.parse
+import urllib.request
+
+import gen_cond_example as gen
+
+# address the server listens on; localhost only by default
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# number of worker processes shared by all requests
+DEFAULT_NUM_WORKERS = 1
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           http.server.HTTPServer):
+    """HTTPServer serving every request in its own thread
+
+    Attributes:
+        pool (multiprocessing.Pool): worker processes shared by the
+            requests, or None to generate in the request threads
+        workers (int): number of worker processes
+    """
+
+    daemon_threads = True
+
+
+def _get_flag(query, name):
+    """Get a 0/1 query parameter as bool"""
+    value = query.get(name, "0")
+    if value not in ("0", "1"):
+        raise ValueError("{} must be 0 or 1: '{}'".format(name, value))
+    return value == "1"
+
+
+def _parse_query(query):
+    """Get the batch requested by the query parameters of a request
+
+    Args:
+        query (dict): query parameters, each with its last value
+
+    Returns:
+        seed (int), offset (int), count (int)
+        gen_kwargs (dict): keyword arguments of generate_instance
+        variants (str): one of gen_cond_example.VARIANTS
+
+    Raises:
+        ValueError: if a parameter is missing or invalid
+    """
+    try:
+        seed = int(query["seed"])
+        offset = int(query.get("offset", 0))
+        count = int(query["count"])
+    except KeyError as error:
+        raise ValueError("missing parameter: {}".format(error.args[0]))
+    if offset < 0 or count < 0:
+        raise ValueError("offset and count must not be negative")
+
+    gen_kwargs = {
+        "include_cond_bufwrite": not _get_flag(query, "taut_only"),
+        "skeletons": _get_flag(query, "skeletons")
+    }
+    for name in ("cond_safe_ratio", "taut_safe_ratio"):
+        value = query.get(name)
+        if value is not None:
+            value = float(value)
+            if not 0 <= value <= 1:
+                raise ValueError("{} must be in [0, 1]: {}".format(name, value))
+        gen_kwargs[name] = value
+
+    variants = query.get("variants", gen.DEFAULT_VARIANTS)
+    if variants not in gen.VARIANTS:
+        raise ValueError("variants must be one of {}: '{}'".format(
+            ", ".join(gen.VARIANTS), variants))
+    return seed, offset, count, gen_kwargs, variants
+
+
+def iter_batch_records(pool, workers, seed, gen_kwargs, variants, offset,
+                       count, chunksize=gen.WORKER_CHUNKSIZE):
+    """Yield the records of indices [offset, offset + count), in order
+
+    Like gen_cond_example._iter_records, but on a pool shared between
+    requests: batches of indices are handed to the pool, at most two at a
+    time, so that a slow client does not make results pile up.
+
+    Args:
+        pool (multiprocessing.Pool): worker processes, or None to generate
+            in the calling thread
+        workers (int): number of worker processes of pool
+        seed (int): seed of the run
+        gen_kwargs (dict): keyword arguments of generate_instance
+        variants (str): one of gen_cond_example.VARIANTS
+        offset (int): index of the first instance
+        count (int): number of instances
+        chunksize (int): number of instances handed to a worker at a time
+
+    Yields:
+        record (tuple): see gen_cond_example._generate_record
+    """
+    end = offset + count
+    if pool is None:
+        for index in range(offset, end):
+            yield gen._generate_record((seed, index, gen_kwargs, False,
+                                        variants, False))
+        return
+
+    batch_size = workers * chunksize
+    index = offset
+    pending = collections.deque()
+    while pending or index < end:
+        while len(pending) < 2 and index < end:
+            tasks = [(seed, idx, gen_kwargs, False, variants, False)
+                     for idx in range(index, min(index + batch_size, end))]
+            pending.append(
+                pool.map_async(gen._generate_record, tasks, chunksize))
+            index += len(tasks)
+        for record in pending.popleft().get():
+            yield record
+
+
+def _record_line(record):
+    """Encode a record as a line of the JSON Lines response"""
+    index, instance_str, tag_values, fname, annotated_str, _, _, _ = record
+    obj = {"fname": fname, "index": index, "tags": tag_values,
+           "instance": instance_str}
+    if annotated_str is not None:
+        obj["annotated"] = annotated_str
+    return (json.dumps(obj) + "\n").encode('utf-8')
+
+
+class GeneratorRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve GET /records as a JSON Lines stream"""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/records":
+            self.send_error(404, "Unknown path: {}".format(url.path))
+            return
+        query = {name: values[-1] for (name, values)
+                 in urllib.parse.parse_qs(url.query).items()}
+        try:
+            seed, offset, count, gen_kwargs, variants = _parse_query(query)
+        except ValueError as error:
+            self.send_error(400, str(error))
+            return
+
+        # no Content-Length: the stream ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        records = iter_batch_records(self.server.pool, self.server.workers,
+                                     seed, gen_kwargs, variants, offset, count)
+        try:
+            for record in records:
+                self.wfile.write(_record_line(record))
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped reading
+        finally:
+            records.close()
+
+
+def iter_remote_records(url, seed, offset, count, **params):
+    """Yield the records of a batch from a running generator server
+
+    Args:
+        url (str): base URL of the server, e.g. 'http://127.0.0.1:8765'
+        seed (int): seed of the run
+        offset (int): index of the first instance
+        count (int): number of instances
+        params: further query parameters, e.g. taut_only=1
+
+    Yields:
+        record (dict): with keys fname, index, tags and instance (and
+            annotated with variants=both)
+    """
+    query = urllib.parse.urlencode(
+        dict(params, seed=seed, offset=offset, count=count))
+    with urllib.request.urlopen("{}/records?{}".format(
+            url.rstrip("/"), query)) as response:
+        for line in response:
+            yield json.loads(line.decode('utf-8'))
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Serve generated instances over HTTP")
+    parser.add_argument('-host',
+                        help=("(str) Address to listen on; default {}. Use 0.0.0.0 "
+                              "inside a container".format(DEFAULT_HOST)),
+                        default=DEFAULT_HOST,
+                        metavar="<host>")
+    parser.add_argument('-port',
+                        help="(int) Port to listen on; default {}".format(
+                            DEFAULT_PORT),
+                        default=DEFAULT_PORT,
+                        metavar="<int>")
+    parser.add_argument('-workers',
+                        help=("(int) Number of worker processes shared by all "
+                              "requests; default {}".format(DEFAULT_NUM_WORKERS)),
+                        default=DEFAULT_NUM_WORKERS,
+                        metavar="<int>")
+    return parser.parse_args()
+
+
+def _exit_on_sigterm(signum, frame):
+    """Stop serving on SIGTERM (e.g. docker stop) as on Ctrl-C"""
+    raise KeyboardInterrupt
+
+
+def _init_worker():
+    """Leave signals to the server process, which terminates the pool"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def main(args):
+    """Serve until interrupted or terminated
+
+    Returns: 0 if no error
+    """
+    workers = int(args.workers)
+    if workers < 1:
+        raise ValueError("workers must be positive: {}".format(workers))
+
+    server = _ThreadingHTTPServer((args.host, int(args.port)),
+                                  GeneratorRequestHandler)
+    server.workers = workers
+    if workers > 1:
+        server.pool = multiprocessing.Pool(workers, _init_worker)
+    else:
+        server.pool = None
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.pool is not None:
+            server.pool.terminate()
+            server.pool.join()
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
@@ -0,0 +1,420 @@
+"""loader.py: load a generated dataset as columnar arrays, with a cache
+
+load(manifest_path) pairs every line of every instance with its tag, in
+the order of the manifest, as three columns:
+    instance    number of the instance of each line (see instance_ids)
+    line        source of each line, without its tag comment
+    tag         Tag value of each line
+
+The first load parses the manifest one entry at a time (see
+manifest.iter_manifest_json), reads the .c files in batches from a pool of
+threads (or the shards, if the dataset was written to shards) and saves
+the columns in two memory-mappable files: a tag store (see tag_store.py)
+and a line store. They are named by the SHA-256 of the manifest, so any
+later load of the same manifest only maps them. Hashing a multi-GB manifest
+takes as long as reading it, so a stat key (path, size and mtime of the
+manifest, and the num_instances, seed and next_index of its header) maps to
+the SHA-256 in a small <stat key>.key file; the manifest is only hashed
+again when its stat key is new:
+
+    with loader.load("work_directory/manifest.json") as dataset:
+        tags, instance_ids = dataset.tags, dataset.instance_ids()
+        lines = dataset.get_lines(0)
+
+Line store layout (little-endian, every section starts on a multiple of 8
+bytes):
+    header          magic, num_lines, text_len (3 x uint64)
+    line_offsets    (num_lines + 1) x uint64; line j is
+                    text[line_offsets[j]:line_offsets[j + 1]]
+    text            text_len bytes; utf-8 source of all lines
+
+e.g. build the cache ahead of training:
+    python sa_babi/loader.py work_directory/manifest.json
+"""
+
+import argparse
+import array
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import time
+
+import manifest
+import shards
+import tag_store
+
+# identifies the line store format and its version
+LINES_MAGIC = b"SALINE01"
+
+# magic, num_lines, text_len
+LINES_HEADER = struct.Struct("<8sQQ")
+
+# name of the cache directory, next to the manifest by default
+CACHE_DIRNAME = "loader_cache"
+
+# number of threads reading .c files
+DEFAULT_NUM_THREADS = 16
+
+# number of files read by the thread pool at a time
+READ_BATCH_SIZE = 1024
+
+
+def _pad(size):
+    """Round size up to a multiple of 8"""
+    return (size + 7) // 8 * 8
+
+
+def _hash_file(path):
+    """Get the SHA-256 hex digest of the contents of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_stat_key(metadata_file):
+    """Get a key of the path, size, mtime and header of a manifest
+
+    Only the header of the manifest is read, see
+    manifest.read_manifest_header.
+    """
+    stat = os.stat(metadata_file)
+    if metadata_file.endswith(".jsonl"):
+        header = {}
+    else:
+        header = manifest.read_manifest_header(metadata_file)
+    key = {
+        "path": os.path.abspath(metadata_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns
+    }
+    for name in ("num_instances", "seed", "next_index"):
+        key[name] = header.get(name)
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _strip_tag_comment(line):
+    """Get the source of a line, without its tag comment and padding"""
+    return line.split("//", 1)[0].rstrip()
+
+
+class LineStoreWriter(object):
+    """Write a line store one instance at a time
+
+    Text and offsets are spooled to temporary files until close()
+    assembles the store.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): path of the store to write
+        """
+        self.path = path
+        self._num_lines = 0
+        self._text_len = 0
+        self._offsets = open(path + ".offsets.tmp", 'w+b')
+        self._text = open(path + ".text.tmp", 'w+b')
+        self._offsets.write(struct.pack("<Q", 0))
+
+    def write(self, lines):
+        """Append the lines of an instance
+
+        Args:
+            lines (list of str): source of each line
+        """
+        offsets = array.array('Q')
+        for line in lines:
+            data = line.encode('utf-8')
+            self._text.write(data)
+            self._text_len += len(data)
+            offsets.append(self._text_len)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        self._offsets.write(offsets.tobytes())
+        self._num_lines += len(lines)
+
+    def close(self):
+        """Assemble the store and remove the temporary files"""
+        with open(self.path, 'wb') as f:
+            f.write(LINES_HEADER.pack(LINES_MAGIC, self._num_lines,
+                                      self._text_len))
+            for tmp_file in (self._offsets, self._text):
+                size = tmp_file.tell()
+                tmp_file.seek(0)
+                shutil.copyfileobj(tmp_file, f)
+                f.write(b"\0" * (_pad(size) - size))
+        for tmp_file in (self._offsets, self._text):
+            tmp_file.close()
+            os.remove(tmp_file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LoadedDataset(object):
+    """Memory-mapped columns of a dataset, as built by load()
+
+    Attributes:
+        offsets (memoryview of uint64): num_instances + 1 offsets into the
+            lines; the lines of instance i are offsets[i] to offsets[i + 1]
+        tags (memoryview of uint8): Tag value of each line
+        line_offsets (memoryview of uint64): num_lines + 1 offsets into text
+        text (memoryview of bytes): utf-8 source of all lines
+    """
+
+    def __init__(self, tags_path, lines_path):
+        """
+        Args:
+            tags_path (str): path of the tag store
+            lines_path (str): path of the line store
+        """
+        if sys.byteorder != 'little':
+            raise NotImplementedError("Line stores are little-endian")
+        self._tag_store = tag_store.TagStore(tags_path)
+        self.offsets = self._tag_store.offsets
+        self.tags = self._tag_store.tags
+
+        self._file = open(lines_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, num_lines, text_len = LINES_HEADER.unpack_from(self._mmap)
+        if magic != LINES_MAGIC:
+            raise ValueError("Not a line store: '{}'".format(lines_path))
+        if num_lines != len(self.tags):
+            raise ValueError("Line store has {} lines, tag store {}".format(
+                num_lines, len(self.tags)))
+        view = memoryview(self._mmap)
+        pos = LINES_HEADER.size
+        size = 8 * (num_lines + 1)
+        self.line_offsets = view[pos:pos + size].cast('Q')
+        pos += _pad(size)
+        self.text = view[pos:pos + text_len]
+
+    def __len__(self):
+        return len(self._tag_store)
+
+    def fname(self, i):
+        """Get the filename of instance i"""
+        return self._tag_store.fname(i)
+
+    def index(self, fname):
+        """Get the instance number of a filename, see TagStore.index"""
+        return self._tag_store.index(fname)
+
+    def get_tags(self, i):
+        """Get the tag values of instance i, as a memoryview of uint8"""
+        return self._tag_store.get_tags(i)
+
+    def line(self, j):
+        """Get the source of line j of the whole dataset"""
+        return self.text[self.line_offsets[j]:
+                         self.line_offsets[j + 1]].tobytes().decode('utf-8')
+
+    def get_lines(self, i):
+        """Get the source of each line of instance i, aligned to get_tags(i)"""
+        return [self.line(j)
+                for j in range(self.offsets[i], self.offsets[i + 1])]
+
+    def instance_ids(self):
+        """Get the instance number of each line
+
+        Returns:
+            instance_ids (array.array of uint32), or numpy.ndarray if numpy
+            is installed
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            instance_ids = array.array('I')
+            for i in range(len(self)):
+                instance_ids.extend(
+                    itertools.repeat(i, self.offsets[i + 1] - self.offsets[i]))
+            return instance_ids
+        offsets = np.frombuffer(self.offsets, dtype=np.uint64)
+        return np.repeat(np.arange(len(self), dtype=np.uint32),
+                         np.diff(offsets).astype(np.int64))
+
+    def close(self):
+        """Release the views and unmap the stores"""
+        for view in (self.line_offsets, self.text):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+        self._tag_store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _iter_files(working_dir, tag_items, num_threads):
+    """Yield the instances of tag_items, read by a pool of threads
+
+    Args:
+        working_dir (str): directory of the .c files
+        tag_items (iterable of tuple): (fname, tag_values) pairs
+        num_threads (int): number of reading threads
+
+    Yields:
+        fname (str), instance_str (str), tag_values (list of int), in the
+        order of tag_items
+    """
+    def read(fname):
+        with open(os.path.join(working_dir, fname)) as f:
+            return f.read()
+
+    tag_items = iter(tag_items)
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        while True:
+            batch = list(itertools.islice(tag_items, READ_BATCH_SIZE))
+            if not batch:
+                return
+            instance_strs = executor.map(read, [fname for (fname, _)
+                                                in batch])
+            for (fname, tag_values), instance_str in zip(batch,
+                                                         instance_strs):
+                yield fname, instance_str, tag_values
+
+
+def _build_cache(metadata_file, tags_path, lines_path, working_dir,
+                 num_threads):
+    """Read a dataset and write its tag store and line store
+
+    The stores are written under temporary names and renamed when both
+    are complete, so an interrupted build leaves no partial cache.
+    """
+    header = {}
+    if metadata_file.endswith(".jsonl"):
+        tag_items = ((fname, tag_values) for (fname, _, tag_values)
+                     in manifest.iter_manifest_stream(metadata_file))
+    else:
+        tag_items = manifest.iter_manifest_json(metadata_file, header)
+    tag_items = iter(tag_items)
+    first = next(tag_items, None)
+    if first is None:
+        raise ValueError("No instances in '{}'".format(metadata_file))
+    tag_items = itertools.chain([first], tag_items)
+    if working_dir is None:
+        if "working_dir" not in header:
+            raise ValueError("No working_dir in '{}'; pass it to "
+                             "load()".format(metadata_file))
+        working_dir = header["working_dir"]
+
+    if os.path.isfile(os.path.join(working_dir, shards.SHARDS_META_FNAME)):
+        reader = shards.ShardReader(working_dir)
+        instances = ((fname, reader.get(fname)[0], tag_values)
+                     for (fname, tag_values) in tag_items)
+    else:
+        reader = None
+        instances = _iter_files(working_dir, tag_items, num_threads)
+
+    name_len = len(os.path.splitext(first[0])[0]) // 2
+    tmp_tags_path = tags_path + ".tmp"
+    tmp_lines_path = lines_path + ".tmp"
+    try:
+        with tag_store.TagStoreWriter(tmp_tags_path, name_len) as tag_writer, \
+                LineStoreWriter(tmp_lines_path) as line_writer:
+            for fname, instance_str, tag_values in instances:
+                lines = instance_str.split("\n")
+                if len(lines) != len(tag_values):
+                    raise ValueError("{} has {} lines but {} tags".format(
+                        fname, len(lines), len(tag_values)))
+                tag_writer.write(fname, tag_values)
+                line_writer.write([_strip_tag_comment(line)
+                                   for line in lines])
+    finally:
+        if reader is not None:
+            reader.close()
+    os.replace(tmp_tags_path, tags_path)
+    os.replace(tmp_lines_path, lines_path)
+
+
+def load(metadata_file, cache_dir=None, working_dir=None,
+         num_threads=DEFAULT_NUM_THREADS):
+    """Load a dataset, from the cache if its manifest was loaded before
+
+    Args:
+        metadata_file (str): path of the manifest.json (or manifest stream)
+        cache_dir (str): directory of the cache; default CACHE_DIRNAME
+            next to metadata_file
+        working_dir (str): directory of the instances; default the
+            working_dir of the manifest.json
+        num_threads (int): number of threads reading .c files
+
+    Returns:
+        dataset (LoadedDataset)
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(metadata_file)), CACHE_DIRNAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    stat_path = os.path.join(cache_dir, _get_stat_key(metadata_file) + ".key")
+    if os.path.isfile(stat_path):
+        with open(stat_path) as f:
+            key = f.read().strip()
+        tags_path = os.path.join(cache_dir, key + ".tags")
+        lines_path = os.path.join(cache_dir, key + ".lines")
+        if os.path.isfile(tags_path) and os.path.isfile(lines_path):
+            return LoadedDataset(tags_path, lines_path)
+
+    key = _hash_file(metadata_file)
+    tags_path = os.path.join(cache_dir, key + ".tags")
+    lines_path = os.path.join(cache_dir, key + ".lines")
+    if not (os.path.isfile(tags_path) and os.path.isfile(lines_path)):
+        _build_cache(metadata_file, tags_path, lines_path, working_dir,
+                     num_threads)
+    with open(stat_path + ".tmp", 'w') as f:
+        f.write(key)
+    os.replace(stat_path + ".tmp", stat_path)
+    return LoadedDataset(tags_path, lines_path)
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Build (or check) the loader cache of a dataset")
+    parser.add_argument('metadata_file',
+                        help="(str) Path of the manifest.json of the dataset",
+                        metavar="<path>")
+    parser.add_argument('-cache_dir',
+                        help=("(str) Directory of the cache; default {} next to the "
+                              "manifest".format(CACHE_DIRNAME)),
+                        metavar="<path>")
+    parser.add_argument('-threads',
+                        help=("(int) Number of threads reading .c files; default "
+                              "{}".format(DEFAULT_NUM_THREADS)),
+                        default=DEFAULT_NUM_THREADS,
+                        metavar="<int>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Load args.metadata_file and report its size and the load time
+
+    Returns: 0 if no error
+    """
+    start = time.perf_counter()
+    with load(args.metadata_file, args.cache_dir,
+              num_threads=int(args.threads)) as dataset:
+        print("{} instances, {} lines loaded in {:.2f}s".format(
+            len(dataset), len(dataset.tags), time.perf_counter() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
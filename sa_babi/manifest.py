@@ -0,0 +1,395 @@
+"""manifest.py: streaming, append-only manifest in JSON Lines format
+
+The manifest stream holds one JSON record per line, written while the
+instances are generated:
+    {"fname": "4a2405d586.c", "index": 17, "tags": [0, 0, 0, 1, ...]}
+where index is the index of the instance in its run (see
+gen_cond_example.generate_instance). A crash loses at most the records not
+yet flushed; a truncated last line is ignored when reading.
+
+The stream converts to the manifest.json layout written by
+gen_cond_example.main() without loading it into memory,
+iter_manifest_json reads a manifest.json one entry at a time, and
+append_to_manifest adds entries at its end in place.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+
+# number of characters read from a manifest.json at a time
+JSON_CHUNK_SIZE = 1 << 20
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class ManifestStreamWriter(object):
+    """Append manifest records to a JSON Lines file"""
+
+    def __init__(self, path, mode='w'):
+        """
+        Args:
+            path (str): path of the manifest stream
+            mode (str): 'w' to start a new stream, 'a' to append to one
+        """
+        self.path = path
+        self._file = open(path, mode)
+
+    def write(self, fname, index, tag_values):
+        """Append the record of an instance
+
+        Args:
+            fname (str): filename of the instance
+            index (int): index of the instance in its run
+            tag_values (list of int): value of the tag of each line
+        """
+        self._file.write(json.dumps(
+            {"fname": fname, "index": index, "tags": tag_values}) + "\n")
+
+    def flush(self):
+        """Flush the written records to the operating system"""
+        self._file.flush()
+
+    def sync(self):
+        """Flush the written records to disk"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def tell(self):
+        """Get the size in bytes of the stream written so far"""
+        return self._file.tell()
+
+    def close(self):
+        """Close the stream"""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def truncate_manifest_stream(path, size):
+    """Drop the records written after the stream had the given size
+
+    Args:
+        path (str): path of the manifest stream
+        size (int): size in bytes to truncate the stream to
+    """
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+
+def iter_manifest_stream(path, offset=0):
+    """Yield the records of a manifest stream in the order they were written
+
+    Args:
+        path (str): path of the manifest stream
+        offset (int): size in bytes of the stream before the first record to
+            yield, e.g. ManifestStreamWriter.tell() at the start of a run
+
+    Yields:
+        fname (str), index (int), tag_values (list of int)
+    """
+    with open(path) as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith("\n"):
+                # the write of the last record was interrupted
+                break
+            record = json.loads(line)
+            yield record["fname"], record["index"], record["tags"]
+
+
+class _JsonReader(object):
+    """Read the JSON values of a file one at a time, in chunks"""
+
+    def __init__(self, f, chunk_size=JSON_CHUNK_SIZE):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk; False at the end of the file"""
+        if self._eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        """Move to the next non-whitespace character, reading as needed"""
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return
+
+    def skip(self, char):
+        """Consume the next character if it is char
+
+        Returns:
+            skipped (bool)
+        """
+        self._skip_whitespace()
+        if self._buf[self._pos:self._pos + 1] == char:
+            self._pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        """Consume the next character, which must be char"""
+        if not self.skip(char):
+            raise ValueError("Expected '{}' at '{}'".format(
+                char, self._buf[self._pos:self._pos + 20]))
+
+    def value(self):
+        """Decode the next JSON value"""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number may go on in the next chunk
+            if end < len(self._buf) or not self._fill():
+                self._pos = end
+                return value
+
+
+def iter_manifest_json(path, header=None):
+    """Yield the tags of a manifest.json without loading it whole
+
+    Args:
+        path (str): path of the manifest.json
+        header (dict): if given, then the other top-level entries, e.g.
+            working_dir and num_instances, are stored into it as they are
+            read; gen_cond_example.main() writes them before the tags
+
+    Yields:
+        fname (str), tag_values (list of int), in the order of the file
+    """
+    with open(path) as f:
+        reader = _JsonReader(f)
+        reader.expect("{")
+        if reader.skip("}"):
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == "tags":
+                reader.expect("{")
+                while not reader.skip("}"):
+                    fname = reader.value()
+                    reader.expect(":")
+                    yield fname, reader.value()
+                    reader.skip(",")
+            else:
+                value = reader.value()
+                if header is not None:
+                    header[key] = value
+            if reader.skip("}"):
+                return
+            reader.expect(",")
+
+
+def iter_manifest_tags(path):
+    """Yield the tags of a manifest.json or of a manifest stream (.jsonl)
+
+    Args:
+        path (str): path of the manifest.json or manifest stream
+
+    Yields:
+        fname (str), tag_values (list of int)
+    """
+    if path.endswith(".jsonl"):
+        for fname, _, tag_values in iter_manifest_stream(path):
+            yield fname, tag_values
+    else:
+        for item in iter_manifest_json(path):
+            yield item
+
+
+def read_manifest_header(path):
+    """Get the top-level entries of a manifest.json written before its tags
+
+    Only the start of the file is read.
+
+    Args:
+        path (str): path of the manifest.json
+
+    Returns:
+        header (dict): e.g. working_dir, num_instances and the run state
+    """
+    header = {}
+    items = iter_manifest_json(path, header)
+    next(items, None)
+    items.close()
+    return header
+
+
+def write_manifest(path, working_dir, num_instances, tag_items,
+                   run_state=None):
+    """Write a manifest.json from an iterable of tags, one entry at a time
+
+    The output is byte-identical to json.dump() of
+    {"working_dir": ..., "num_instances": ..., **run_state,
+     "tags": {fname: tags, ...}}
+
+    Args:
+        path (str): path of the manifest.json to write
+        working_dir (str): directory the instances were written to
+        num_instances (int): number of instances
+        tag_items (iterable of tuple): (fname, tag_values) pairs
+        run_state (dict): further entries to write before the tags, e.g.
+            the seed and next_index that --append continues from
+    """
+    with open(path, 'w') as f:
+        f.write(_format_header(working_dir, num_instances, run_state))
+        _write_tags(f, tag_items, "")
+        f.write("}}")
+
+
+def _format_header(working_dir, num_instances, run_state):
+    """Get the start of a manifest.json, up to the opening brace of the tags"""
+    parts = ['{"working_dir": %s, "num_instances": %s, ' % (
+        json.dumps(working_dir), json.dumps(num_instances))]
+    for key, value in (run_state or {}).items():
+        parts.append('%s: %s, ' % (json.dumps(key), json.dumps(value)))
+    parts.append('"tags": {')
+    return "".join(parts)
+
+
+def _write_tags(f, tag_items, separator):
+    """Write the entries of the tags of a manifest.json
+
+    Args:
+        f (file): manifest.json, open for writing
+        tag_items (iterable of tuple): (fname, tag_values) pairs
+        separator (str): written before the first entry; ", " if entries
+            were written before it, else ""
+    """
+    for fname, tag_values in tag_items:
+        f.write("%s%s: %s" % (separator, json.dumps(fname),
+                              json.dumps(tag_values)))
+        separator = ", "
+
+
+def append_to_manifest(path, tag_items, num_instances, run_state=None):
+    """Add entries to the tags of a manifest.json of write_manifest, in place
+
+    The new entries are written over the closing braces at the end of the
+    file, and the header (the entries before the tags) over the old one, so
+    that the cost is that of the new entries only. If the new header is
+    longer, i.e. num_instances or an entry of run_state such as next_index
+    gained a digit, then the whole file is rewritten instead; this happens
+    once per power of 10, so the cost of the rewrites stays within about
+    that of writing the final manifest once.
+
+    Args:
+        path (str): path of the manifest.json
+        tag_items (iterable of tuple): (fname, tag_values) pairs to add
+        num_instances (int): number of instances, with the new ones
+        run_state (dict): entries before the tags, see write_manifest
+
+    Raises:
+        ValueError: if the manifest.json was not written by write_manifest
+    """
+    header = read_manifest_header(path)
+    working_dir = header.pop("working_dir")
+    old_header = _format_header(working_dir, header.pop("num_instances"),
+                                header)
+    new_header = _format_header(working_dir, num_instances, run_state)
+    if len(new_header) != len(old_header):
+        tmp_path = path + ".tmp"
+        write_manifest(tmp_path, working_dir, num_instances,
+                       itertools.chain(iter_manifest_json(path), tag_items),
+                       run_state)
+        os.replace(tmp_path, path)
+        return
+
+    # json.dumps escapes all but ASCII, so characters are bytes
+    size = os.path.getsize(path)
+    with open(path, 'r+') as f:
+        if f.read(len(old_header)) != old_header:
+            raise ValueError("Manifest '{}' was not written by "
+                             "write_manifest".format(path))
+        f.seek(size - 3)
+        end = f.read(3)
+        if end[1:] != "}}":
+            raise ValueError("Manifest '{}' does not end with its "
+                             "tags".format(path))
+        f.seek(size - 2)
+        _write_tags(f, tag_items, "" if end == "{}}" else ", ")
+        f.write("}}")
+        f.seek(0)
+        f.write(new_header)
+
+
+def convert_stream_to_manifest(stream_path, manifest_path, working_dir,
+                               num_instances=None, run_state=None):
+    """Convert a manifest stream to the manifest.json layout
+
+    Args:
+        stream_path (str): path of the manifest stream
+        manifest_path (str): path of the manifest.json to write
+        working_dir (str): directory the instances were written to
+        num_instances (int): number of instances; if None, then the number
+            of records in the stream
+        run_state (dict): further entries, see write_manifest
+    """
+    if num_instances is None:
+        num_instances = sum(1 for _ in iter_manifest_stream(stream_path))
+    tag_items = ((fname, tag_values) for (fname, _, tag_values)
+                 in iter_manifest_stream(stream_path))
+    write_manifest(manifest_path, working_dir, num_instances, tag_items,
+                   run_state)
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Convert a manifest stream to the manifest.json layout")
+    parser.add_argument('manifest_stream',
+                        help="(str) Path of the manifest stream (JSON Lines)",
+                        metavar="<path>")
+    parser.add_argument('metadata_file',
+                        help="(str) Path of the manifest.json to write",
+                        metavar="<path>")
+    parser.add_argument('-working_dir',
+                        help=("(str) Directory the instances were written to; "
+                              "default: the directory of the manifest stream"),
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Convert args.manifest_stream to args.metadata_file
+
+    Returns: 0 if no error
+    """
+    working_dir = args.working_dir
+    if working_dir is None:
+        working_dir = os.path.dirname(args.manifest_stream)
+    working_dir = os.path.abspath(os.path.expanduser(working_dir))
+    convert_stream_to_manifest(args.manifest_stream, args.metadata_file,
+                               working_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
@@ -0,0 +1,150 @@
+"""run_stats.py: per-stage timers, counters and progress of a generator run
+
+With --stats, gen_cond_example.main() keeps a RunStats:
+    stages      seconds spent in each stage. The stages of generating an
+                instance (sampling, assembly, render, hashing) are timed where
+                the instance is generated, i.e. summed over the worker
+                processes; the others (generate, write, checkpoint, metadata)
+                are wall-clock time of the main process, where generate is
+                the time spent waiting for the next instance
+    counters    attempts, instances, collisions (filename already generated
+                in this run), excluded (instance of an excluded dataset),
+                canonical_duplicates (renamed copy of an instance already
+                generated, with --canonical_dedup) and bytes_written
+                (instances, as written to files or shards)
+
+Progress, with instances/sec and ETA, goes to stderr every PROGRESS_INTERVAL
+seconds, and the final stats are saved as JSON (run_stats.json, next to the
+manifest).
+"""
+
+import collections
+import json
+import sys
+import time
+
+# seconds between progress reports
+PROGRESS_INTERVAL = 10.0
+
+# name of the stats file written next to the manifest
+STATS_FNAME = "run_stats.json"
+
+
+class StageTimer(object):
+    """Accumulate the time spent in consecutive stages
+
+    split(stage) charges the time since the previous split (or since
+    creation) to stage. observe(name, value) records a value sampled while
+    generating, e.g. a buffer length, for dataset_stats.DatasetStats.
+    """
+
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.values = collections.defaultdict(list)
+        self._last = time.perf_counter()
+
+    def split(self, stage):
+        """Charge the time since the previous split to stage"""
+        now = time.perf_counter()
+        self.times[stage] += now - self._last
+        self._last = now
+
+    def observe(self, name, value):
+        """Record a sampled value"""
+        self.values[name].append(value)
+
+
+class NullTimer(object):
+    """StageTimer which records nothing, used when stats are off"""
+
+    times = None
+    values = None
+
+    def split(self, stage):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class RunStats(StageTimer):
+    """Timers, counters and progress reports of a run"""
+
+    def __init__(self, num_instances, out=sys.stderr,
+                 interval=PROGRESS_INTERVAL):
+        """
+        Args:
+            num_instances (int): number of instances the run writes, for
+                the ETA
+            out (file): where progress is reported
+            interval (float): seconds between progress reports
+        """
+        super(RunStats, self).__init__()
+        self.num_instances = num_instances
+        self.counters = collections.Counter()
+        self._out = out
+        self._interval = interval
+        self._start = self._last
+        self._next_report = self._start + interval
+
+    def count(self, name, num=1):
+        """Add num to the counter name"""
+        self.counters[name] += num
+
+    def add_times(self, times):
+        """Add the stage times of a StageTimer, e.g. of a worker"""
+        for stage, seconds in times.items():
+            self.times[stage] += seconds
+
+    def progress(self, num_written):
+        """Report progress if the last report is older than the interval
+
+        Args:
+            num_written (int): number of instances written so far
+        """
+        if self._last < self._next_report:
+            return
+        self._next_report = self._last + self._interval
+        elapsed = self._last - self._start
+        rate = self.counters["instances"] / elapsed if elapsed > 0 else 0.0
+        if rate > 0:
+            eta = "{:.0f}s".format((self.num_instances - num_written) / rate)
+        else:
+            eta = "?"
+        self._out.write("{}/{} instances, {:.1f} inst/s, ETA {}\n".format(
+            num_written, self.num_instances, rate, eta))
+        self._out.flush()
+
+    def summary(self):
+        """Get the stats as a JSON-serializable dict"""
+        elapsed = time.perf_counter() - self._start
+        return {
+            "elapsed_seconds": elapsed,
+            "inst_per_sec": self.counters["instances"] / elapsed,
+            "stages": dict(self.times),
+            "counters": dict(self.counters)
+        }
+
+    def write(self, path):
+        """Save the summary as JSON"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+class NullStats(NullTimer):
+    """RunStats which records nothing, used when stats are off"""
+
+    def count(self, name, num=1):
+        pass
+
+    def add_times(self, times):
+        pass
+
+    def progress(self, num_written):
+        pass
+
+
+NULL_STATS = NullStats()
@@ -0,0 +1,231 @@
+"""shard_plan.py: split a run over several machines and merge the results
+
+Every instance is generated from (seed, index) alone (see
+gen_cond_example.generate_instance), so a run splits into slices of its
+index space. Slice k of K takes the indices k, k + K, k + 2K, ... through
+-index_offset k -index_stride K, and writes its share of num_instances; the
+slices never generate the same index, whatever their collisions.
+
+    python sa_babi/shard_plan.py plan 0 1200000 8
+
+prints the arguments of gen_cond_example.py for each of the 8 slices. Each
+slice writes a manifest stream, whose records carry their global index;
+
+    python sa_babi/shard_plan.py merge manifest.json slice-*.jsonl -seed 0
+
+merges them in global index order into one manifest and drops the instances
+already generated by another slice (equal filenames, i.e. equal sources),
+keeping the one with the lowest index. This reads every stream once and
+never reads the .c files. The merged manifest has slightly fewer than
+num_instances instances if there were cross-slice duplicates; their number
+is reported. A merged manifest.json carries the run state of a single run
+(the seed and generation options of the slices, index_stride 1 and the
+index after the last one of any slice), so gen_cond_example.py --append
+can continue it.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import sys
+
+import dedup_index
+import gen_cond_example as gen
+import manifest
+
+# name of the manifest stream of slice k, in the arguments printed by plan
+SLICE_STREAM_STR = "slice-%05d.jsonl"
+
+
+def plan_slices(seed, num_instances, num_slices):
+    """Split a run into deterministic slices of its index space
+
+    Args:
+        seed (int): seed of the run
+        num_instances (int): number of instances of the whole run
+        num_slices (int): number of slices
+
+    Returns:
+        slices (list of dict): seed, num_instances, index_offset and
+            index_stride of each slice, i.e. the gen_cond_example.py
+            arguments of the same names
+    """
+    if num_slices < 1:
+        raise ValueError("num_slices must be positive: {}".format(num_slices))
+    return [{
+        "seed": seed,
+        "num_instances": (num_instances // num_slices +
+                          int(slice_num < num_instances % num_slices)),
+        "index_offset": slice_num,
+        "index_stride": num_slices
+    } for slice_num in range(num_slices)]
+
+
+def merge_streams(stream_paths, out_path):
+    """Merge the manifest streams of slices into one stream
+
+    Every slice writes its records in increasing index order, so a k-way
+    merge yields them in global index order, one record in memory per
+    slice; only the filename hashes are kept, to drop duplicates, in a
+    dedup_index.FnameSet memory-mapped from <out_path>.fnames.
+
+    Args:
+        stream_paths (list of str): paths of the manifest streams of the
+            slices
+        out_path (str): path of the merged manifest stream
+
+    Returns:
+        num_records (int): number of records written
+        num_duplicates (int): number of records dropped as duplicates
+        next_index (int): index after the last one of any slice, from which
+            a single run continues the merged one
+
+    Raises:
+        ValueError: if two slices have a record with the same index, e.g.
+            if a stream was passed twice
+    """
+    num_duplicates = 0
+    last_index = None
+    records = heapq.merge(
+        *[manifest.iter_manifest_stream(path) for path in stream_paths],
+        key=lambda record: record[1])
+    with dedup_index.FnameSet(gen.FNAME_HASHLEN,
+                              out_path + ".fnames") as fnames, \
+            manifest.ManifestStreamWriter(out_path) as out:
+        for fname, index, tag_values in records:
+            if index == last_index:
+                raise ValueError("Index {} is in more than one slice".format(
+                    index))
+            last_index = index
+            if fname in fnames:
+                num_duplicates += 1
+                continue
+            fnames.add(fname)
+            out.write(fname, index, tag_values)
+        num_records = len(fnames)
+    next_index = last_index + 1 if last_index is not None else 0
+    return num_records, num_duplicates, next_index
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Split a run over several machines and merge the results")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    plan_parser = subparsers.add_parser(
+        'plan', help="Print the gen_cond_example.py arguments of each slice")
+    plan_parser.add_argument('seed',
+                             help="(int) Seed of the run",
+                             metavar="<int>")
+    plan_parser.add_argument('num_instances',
+                             help="(int) Number of instances of the whole run",
+                             metavar="<int>")
+    plan_parser.add_argument('num_slices',
+                             help="(int) Number of slices",
+                             metavar="<int>")
+    plan_parser.add_argument('-plan_file',
+                             help="(str) Path of a JSON file to save the plan to",
+                             metavar="<path>")
+
+    merge_parser = subparsers.add_parser(
+        'merge', help="Merge the manifest streams of the slices")
+    merge_parser.add_argument('metadata_file',
+                              help=("(str) Path of the merged manifest to write; "
+                                    "a manifest stream if it ends with .jsonl, "
+                                    "else a manifest.json, next to which the merged "
+                                    "stream is kept as <path>.jsonl for --append"),
+                              metavar="<path>")
+    merge_parser.add_argument('manifest_streams',
+                              help="(str) Paths of the manifest streams of the slices",
+                              nargs='+',
+                              metavar="<path>")
+    merge_parser.add_argument('-seed',
+                              help=("(int) Seed of the slices, saved in the merged "
+                                    "manifest for --append"),
+                              required=True,
+                              metavar="<int>")
+    merge_parser.add_argument('--taut_only',
+                              help="The slices were generated with --taut_only",
+                              action='store_true')
+    merge_parser.add_argument('-cond_safe_ratio',
+                              help="(float) -cond_safe_ratio of the slices, if any",
+                              metavar="<float>")
+    merge_parser.add_argument('-taut_safe_ratio',
+                              help="(float) -taut_safe_ratio of the slices, if any",
+                              metavar="<float>")
+    merge_parser.add_argument('-variants',
+                              help="(str) -variants of the slices; default {}".format(
+                                  gen.DEFAULT_VARIANTS),
+                              choices=gen.VARIANTS,
+                              default=gen.DEFAULT_VARIANTS)
+    merge_parser.add_argument('-working_dir',
+                              help=("(str) Directory the .c files of all slices were "
+                                    "gathered in; default: the directory of "
+                                    "metadata_file"),
+                              metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Print the plan of a run, or merge the manifests of its slices
+
+    Returns: 0 if no error
+    """
+    if args.command == 'plan':
+        slices = plan_slices(int(args.seed), int(args.num_instances),
+                             int(args.num_slices))
+        for (slice_num, slice_args) in enumerate(slices):
+            print("-seed {seed} -num_instances {num_instances} "
+                  "-index_offset {index_offset} -index_stride {index_stride} "
+                  "-manifest_stream {stream}".format(
+                      stream=SLICE_STREAM_STR % slice_num, **slice_args))
+        if args.plan_file is not None:
+            with open(args.plan_file, 'w') as f:
+                json.dump({"seed": int(args.seed),
+                           "num_instances": int(args.num_instances),
+                           "slices": slices}, f, indent=2)
+        return 0
+
+    for path in args.manifest_streams:
+        if not path.endswith(".jsonl"):
+            raise ValueError("Not a manifest stream, the indices are needed "
+                             "to merge: '{}'".format(path))
+    if args.metadata_file.endswith(".jsonl"):
+        num_records, num_duplicates, _ = merge_streams(args.manifest_streams,
+                                                       args.metadata_file)
+    else:
+        working_dir = args.working_dir
+        if working_dir is None:
+            working_dir = os.path.dirname(args.metadata_file)
+        working_dir = os.path.abspath(os.path.expanduser(working_dir))
+        stream_path = args.metadata_file + ".jsonl"
+        num_records, num_duplicates, next_index = merge_streams(
+            args.manifest_streams, stream_path)
+        # the merged run goes on as a single run, past every slice; the
+        # slices wrote no canonical names to continue --canonical_dedup from
+        run_state = {
+            "seed": int(args.seed),
+            "index_stride": 1,
+            "next_index": next_index,
+            "taut_only": args.taut_only,
+            "variants": args.variants,
+            "canonical_dedup": False
+        }
+        for name in ("cond_safe_ratio", "taut_safe_ratio"):
+            value = getattr(args, name)
+            run_state[name] = float(value) if value is not None else None
+        # the merged stream is kept, for --append to go on from
+        manifest.convert_stream_to_manifest(stream_path, args.metadata_file,
+                                            working_dir, num_records,
+                                            run_state)
+    print("{} instances, {} cross-slice duplicates dropped".format(
+        num_records, num_duplicates))
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
@@ -0,0 +1,372 @@
+"""shards.py: pack generated instances into a few large shard files
+
+Instead of one small .c file per instance, instances are appended to
+num_shards shard files. The shard of an instance is chosen by its filename
+hash, so a reader knows which shard to look in without scanning.
+
+Layout of a shard directory:
+    shards.json          {"num_shards": int, "name_len": int}
+    shard-00000.dat      records, one per instance
+    shard-00000.idx      index of shard-00000.dat, sorted by filename hash
+    ...
+
+A record is a header (filename hash, code length, number of tags), followed
+by the utf-8 code and one byte per tag (the Tag value). An index entry is the
+filename hash, followed by the offset and the length of the record.
+"""
+
+import heapq
+import json
+import mmap
+import os
+import struct
+
+import manifest
+
+# name of the file describing the shard directory
+SHARDS_META_FNAME = "shards.json"
+
+# shard filename template
+SHARD_STR = "shard-%05d"
+
+# record header: code length, number of tags (after the filename hash)
+RECORD_HEADER = struct.Struct(">IH")
+
+# index entry: record offset, record length (after the filename hash)
+INDEX_ENTRY = struct.Struct(">QI")
+
+# number of index entries sorted in memory at a time when closing a shard
+SORT_RUN_ENTRIES = 1 << 20
+
+# bytes read from each sorted run at a time while merging, rounded down to
+# whole index entries
+MERGE_READ_BYTES = 1 << 16
+
+
+def _fname_to_digest(fname):
+    """Get the raw hash bytes of an instance filename, e.g. '4a2405d586.c'"""
+    return bytes.fromhex(os.path.splitext(fname)[0])
+
+
+def _digest_to_fname(digest):
+    """Get the instance filename of raw hash bytes"""
+    return "{}.c".format(digest.hex())
+
+
+def _get_shard_num(digest, num_shards):
+    """Get the number of the shard which stores the instance with digest"""
+    return int.from_bytes(digest, 'big') % num_shards
+
+
+class ShardWriter(object):
+    """Append instances to shard files; write the sorted indices on close
+
+    While writing, index entries go unsorted to a temporary file per shard;
+    close() sorts each of them into the final index, one shard at a time, by
+    an external merge sort: runs of at most SORT_RUN_ENTRIES entries are
+    sorted in memory and merged from disk, so memory does not grow with the
+    number of instances.
+
+    sync() returns the sizes of the shard files; passing them back as sizes
+    reopens the shards of an interrupted run, dropping whatever was written
+    after that sync. Leaving a with block on an exception therefore keeps
+    the unsorted indices instead of sorting them.
+    """
+
+    def __init__(self, outdir, num_shards, name_len, sizes=None):
+        """
+        Args:
+            outdir (str): path to directory to write shards to; must exist
+            num_shards (int): number of shards
+            name_len (int): number of bytes in each filename hash
+            sizes (list of list): as returned by sync(), to continue writing
+                existing shards; if None, then start new shards
+        """
+        if num_shards < 1:
+            raise ValueError("num_shards must be positive: {}".format(
+                num_shards))
+        self.outdir = outdir
+        self.num_shards = num_shards
+        self.name_len = name_len
+        self._dat_files = []
+        self._idx_files = []
+        for shard_num in range(num_shards):
+            path = os.path.join(outdir, SHARD_STR % shard_num)
+            if sizes is None:
+                self._dat_files.append(open(path + ".dat", 'wb'))
+                self._idx_files.append(open(path + ".idx.tmp", 'wb'))
+                continue
+            dat_size, idx_size = sizes[shard_num]
+            for (suffix, size, files) in [(".dat", dat_size, self._dat_files),
+                                          (".idx.tmp", idx_size,
+                                           self._idx_files)]:
+                f = open(path + suffix, 'r+b')
+                f.truncate(size)
+                f.seek(size)
+                files.append(f)
+        with open(os.path.join(outdir, SHARDS_META_FNAME), 'w') as f:
+            json.dump({"num_shards": num_shards, "name_len": name_len}, f)
+
+    def write(self, fname, instance_str, tag_values):
+        """Append an instance to its shard
+
+        Args:
+            fname (str): filename of the instance, e.g. '4a2405d586.c'
+            instance_str (str): str of code example
+            tag_values (list of int): value of the tag of each line
+
+        Returns:
+            num_bytes (int): number of bytes of the record
+        """
+        digest = _fname_to_digest(fname)
+        if len(digest) != self.name_len:
+            raise ValueError("Unexpected filename length: '{}'".format(fname))
+        code = instance_str.encode('utf-8')
+        record = (digest + RECORD_HEADER.pack(len(code), len(tag_values)) +
+                  code + bytes(tag_values))
+        shard_num = _get_shard_num(digest, self.num_shards)
+        dat_file = self._dat_files[shard_num]
+        offset = dat_file.tell()
+        dat_file.write(record)
+        self._idx_files[shard_num].write(
+            digest + INDEX_ENTRY.pack(offset, len(record)))
+        return len(record)
+
+    def sync(self):
+        """Flush the shard files to disk
+
+        Returns:
+            sizes (list of list): [record bytes, index bytes] of each shard
+        """
+        sizes = []
+        for dat_file, idx_file in zip(self._dat_files, self._idx_files):
+            for f in (dat_file, idx_file):
+                f.flush()
+                os.fsync(f.fileno())
+            sizes.append([dat_file.tell(), idx_file.tell()])
+        return sizes
+
+    def close(self):
+        """Close the shard files and write the sorted shard indices"""
+        entry_len = self.name_len + INDEX_ENTRY.size
+        for shard_num in range(self.num_shards):
+            self._dat_files[shard_num].close()
+            self._idx_files[shard_num].close()
+            path = os.path.join(self.outdir, SHARD_STR % shard_num)
+            _sort_index(path + ".idx.tmp", path + ".idx", entry_len)
+            os.remove(path + ".idx.tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+            return
+        # interrupted: keep the unsorted indices, to resume from
+        for f in self._dat_files + self._idx_files:
+            f.close()
+
+
+def _iter_entries(f, entry_len, start, end):
+    """Yield the index entries of f between two offsets, one at a time
+
+    Reads are whole numbers of entries, so that no entry is split between
+    two reads.
+    """
+    chunk_len = max(MERGE_READ_BYTES // entry_len, 1) * entry_len
+    f.seek(start)
+    while start < end:
+        data = f.read(min(end - start, chunk_len))
+        start += len(data)
+        for pos in range(0, len(data), entry_len):
+            yield data[pos:pos + entry_len]
+
+
+def _sort_index(in_path, out_path, entry_len):
+    """Sort the index entries of in_path into out_path
+
+    Each run of SORT_RUN_ENTRIES entries is sorted in memory and written to
+    a temporary file, then the runs are merged with one buffered read per
+    run.
+    """
+    run_len = SORT_RUN_ENTRIES * entry_len
+    runs_path = out_path + ".runs.tmp"
+    run_bounds = []
+    with open(in_path, 'rb') as in_file, open(runs_path, 'wb') as runs_file:
+        while True:
+            data = in_file.read(run_len)
+            if not data:
+                break
+            start = runs_file.tell()
+            runs_file.write(b"".join(sorted(
+                data[pos:pos + entry_len]
+                for pos in range(0, len(data), entry_len))))
+            run_bounds.append((start, runs_file.tell()))
+
+    run_files = [open(runs_path, 'rb') for _ in run_bounds]
+    try:
+        with open(out_path, 'wb') as out_file:
+            for entry in heapq.merge(*[
+                    _iter_entries(f, entry_len, start, end)
+                    for (f, (start, end)) in zip(run_files, run_bounds)]):
+                out_file.write(entry)
+    finally:
+        for f in run_files:
+            f.close()
+        os.remove(runs_path)
+
+
+class ShardReader(object):
+    """Fetch instances from a shard directory written by ShardWriter
+
+    Lookups by filename binary-search the memory-mapped index of a single
+    shard, so they neither scan nor load whole shards.
+    """
+
+    def __init__(self, outdir):
+        """
+        Args:
+            outdir (str): path to the shard directory
+        """
+        self.outdir = outdir
+        with open(os.path.join(outdir, SHARDS_META_FNAME)) as f:
+            meta = json.load(f)
+        self.num_shards = meta["num_shards"]
+        self.name_len = meta["name_len"]
+        self._entry_len = self.name_len + INDEX_ENTRY.size
+        self._files = []
+        self._dats = []
+        self._idxs = []
+        for shard_num in range(self.num_shards):
+            path = os.path.join(outdir, SHARD_STR % shard_num)
+            self._dats.append(self._map(path + ".dat"))
+            self._idxs.append(self._map(path + ".idx"))
+
+    def _map(self, path):
+        """Memory-map a file read-only; empty files map to b''"""
+        f = open(path, 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _find(self, digest):
+        """Get (shard_num, offset, length) of the record of digest, or None"""
+        shard_num = _get_shard_num(digest, self.num_shards)
+        idx = self._idxs[shard_num]
+        entry_len = self._entry_len
+        low = 0
+        high = len(idx) // entry_len
+        while low < high:
+            mid = (low + high) // 2
+            pos = mid * entry_len
+            key = idx[pos:pos + self.name_len]
+            if key < digest:
+                low = mid + 1
+            elif key > digest:
+                high = mid
+            else:
+                offset, length = INDEX_ENTRY.unpack_from(
+                    idx, pos + self.name_len)
+                return shard_num, offset, length
+        return None
+
+    def _read_record(self, shard_num, offset):
+        """Decode the record at offset of a shard
+
+        Returns:
+            fname (str), instance_str (str), tag_values (list of int),
+            end (int): offset just past the record
+        """
+        dat = self._dats[shard_num]
+        digest = bytes(dat[offset:offset + self.name_len])
+        pos = offset + self.name_len
+        code_len, num_tags = RECORD_HEADER.unpack_from(dat, pos)
+        pos += RECORD_HEADER.size
+        instance_str = dat[pos:pos + code_len].decode('utf-8')
+        pos += code_len
+        tag_values = list(dat[pos:pos + num_tags])
+        return (_digest_to_fname(digest), instance_str, tag_values,
+                pos + num_tags)
+
+    def get(self, fname):
+        """Get an instance by filename
+
+        Args:
+            fname (str): filename of the instance, e.g. '4a2405d586.c'
+
+        Returns:
+            instance_str (str): str of code example
+            tag_values (list of int): value of the tag of each line
+
+        Raises:
+            KeyError: if there is no instance with that filename
+        """
+        found = self._find(_fname_to_digest(fname))
+        if found is None:
+            raise KeyError(fname)
+        shard_num, offset, _ = found
+        _, instance_str, tag_values, _ = self._read_record(shard_num, offset)
+        return instance_str, tag_values
+
+    def __contains__(self, fname):
+        return self._find(_fname_to_digest(fname)) is not None
+
+    def __len__(self):
+        return sum(len(idx) // self._entry_len for idx in self._idxs)
+
+    def __iter__(self):
+        """Yield (fname, instance_str, tag_values) in storage order"""
+        for shard_num, dat in enumerate(self._dats):
+            offset = 0
+            while offset < len(dat):
+                fname, instance_str, tag_values, offset = self._read_record(
+                    shard_num, offset)
+                yield fname, instance_str, tag_values
+
+    def close(self):
+        """Unmap and close the shard files"""
+        for mapped in self._dats + self._idxs:
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_dataset(metadata_file, working_dir=None):
+    """Yield the instances of a dataset, with the tags of its manifest
+
+    The instances are read from the shards in working_dir if it has any,
+    else from its .c files.
+
+    Args:
+        metadata_file (str): path of the manifest.json or manifest stream
+        working_dir (str): directory of the instances; default: the
+            working_dir of the manifest.json, or the directory of the
+            manifest stream
+
+    Yields:
+        fname (str), instance_str (str), tag_values (list of int)
+    """
+    if working_dir is None and metadata_file.endswith(".jsonl"):
+        working_dir = os.path.dirname(os.path.abspath(metadata_file))
+    elif working_dir is None:
+        working_dir = manifest.read_manifest_header(
+            metadata_file)["working_dir"]
+    if os.path.isfile(os.path.join(working_dir, SHARDS_META_FNAME)):
+        with ShardReader(working_dir) as reader:
+            for fname, tag_values in manifest.iter_manifest_tags(
+                    metadata_file):
+                yield fname, reader.get(fname)[0], tag_values
+        return
+
+    for fname, tag_values in manifest.iter_manifest_tags(metadata_file):
+        with open(os.path.join(working_dir, fname)) as f:
+            yield fname, f.read(), tag_values
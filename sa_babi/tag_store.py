@@ -0,0 +1,260 @@
+"""tag_store.py: compact binary store of the tags of a dataset
+
+The store is a single file which loaders memory-map; the tags, offsets and
+filename index are used in place, without parsing or copying.
+
+Layout (little-endian, every section starts on a multiple of 8 bytes):
+    header      magic, num_instances, name_len, num_tags (4 x uint64)
+    offsets     (num_instances + 1) x uint64; the tags of instance i are
+                tags[offsets[i]:offsets[i + 1]]
+    order       num_instances x uint64; instance numbers sorted by filename
+                hash, for lookups by filename
+    names       num_instances x name_len bytes; raw filename hash of each
+                instance, e.g. bytes.fromhex('4a2405d586') for 4a2405d586.c
+    tags        num_tags x uint8; Tag values of all lines of all instances
+
+e.g.
+    python sa_babi/tag_store.py manifest.json tags.bin
+"""
+
+import argparse
+import array
+import itertools
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+import manifest
+
+# identifies the file format and its version
+MAGIC = b"SATAGS01"
+
+# magic, num_instances, name_len, num_tags
+HEADER = struct.Struct("<8sQQQ")
+
+
+def _pad(size):
+    """Round size up to a multiple of 8"""
+    return (size + 7) // 8 * 8
+
+
+def _fname_to_digest(fname):
+    """Get the raw hash bytes of an instance filename, e.g. '4a2405d586.c'"""
+    return bytes.fromhex(os.path.splitext(fname)[0])
+
+
+class TagStoreWriter(object):
+    """Write a tag store one instance at a time
+
+    Names and tags are spooled to temporary files, only the offsets are kept
+    in memory (8 bytes per instance) until close() assembles the store.
+    """
+
+    def __init__(self, path, name_len):
+        """
+        Args:
+            path (str): path of the store to write
+            name_len (int): number of bytes in each filename hash
+        """
+        self.path = path
+        self.name_len = name_len
+        self._offsets = array.array('Q', [0])
+        self._names = open(path + ".names.tmp", 'w+b')
+        self._tags = open(path + ".tags.tmp", 'w+b')
+
+    def write(self, fname, tag_values):
+        """Append the tags of an instance
+
+        Args:
+            fname (str): filename of the instance, e.g. '4a2405d586.c'
+            tag_values (list of int): value of the tag of each line
+        """
+        digest = _fname_to_digest(fname)
+        if len(digest) != self.name_len:
+            raise ValueError("Unexpected filename length: '{}'".format(fname))
+        self._names.write(digest)
+        self._tags.write(bytes(tag_values))
+        self._offsets.append(self._offsets[-1] + len(tag_values))
+
+    def close(self):
+        """Assemble the store and remove the temporary files"""
+        num_instances = len(self._offsets) - 1
+        self._names.seek(0)
+        names = self._names.read()
+        order = array.array('Q', sorted(
+            range(num_instances),
+            key=lambda i: names[i * self.name_len:(i + 1) * self.name_len]))
+        offsets = self._offsets
+        if sys.byteorder != 'little':
+            offsets = array.array('Q', offsets)
+            offsets.byteswap()
+            order.byteswap()
+
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, num_instances, self.name_len,
+                                self._offsets[-1]))
+            for section in (offsets.tobytes(), order.tobytes(), names):
+                f.write(section)
+                f.write(b"\0" * (_pad(len(section)) - len(section)))
+            self._tags.seek(0)
+            shutil.copyfileobj(self._tags, f)
+
+        for tmp_file in (self._names, self._tags):
+            tmp_file.close()
+            os.remove(tmp_file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TagStore(object):
+    """Memory-mapped, read-only view of a tag store
+
+    Attributes:
+        offsets (memoryview of uint64): num_instances + 1 offsets into tags
+        tags (memoryview of uint8): Tag values of all lines
+        names (memoryview of bytes): raw filename hashes, name_len each
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): path of the store
+        """
+        if sys.byteorder != 'little':
+            raise NotImplementedError("Tag stores are little-endian")
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, num_instances, name_len, num_tags = HEADER.unpack_from(
+            self._mmap)
+        if magic != MAGIC:
+            raise ValueError("Not a tag store: '{}'".format(path))
+        self.num_instances = num_instances
+        self.name_len = name_len
+
+        view = memoryview(self._mmap)
+        pos = HEADER.size
+        sections = []
+        for size in (8 * (num_instances + 1), 8 * num_instances,
+                     name_len * num_instances):
+            sections.append(view[pos:pos + size])
+            pos += _pad(size)
+        self.offsets = sections[0].cast('Q')
+        self._order = sections[1].cast('Q')
+        self.names = sections[2]
+        self.tags = view[pos:pos + num_tags]
+
+    def __len__(self):
+        return self.num_instances
+
+    def fname(self, i):
+        """Get the filename of instance i"""
+        name = self.names[i * self.name_len:(i + 1) * self.name_len]
+        return "{}.c".format(name.hex())
+
+    def get_tags(self, i):
+        """Get the tag values of instance i, as a memoryview of uint8"""
+        return self.tags[self.offsets[i]:self.offsets[i + 1]]
+
+    def index(self, fname):
+        """Get the instance number of a filename, by binary search
+
+        Raises:
+            KeyError: if there is no instance with that filename
+        """
+        digest = _fname_to_digest(fname)
+        name_len = self.name_len
+        low = 0
+        high = self.num_instances
+        while low < high:
+            mid = (low + high) // 2
+            i = self._order[mid]
+            key = self.names[i * name_len:(i + 1) * name_len].tobytes()
+            if key < digest:
+                low = mid + 1
+            elif key > digest:
+                high = mid
+            else:
+                return i
+        raise KeyError(fname)
+
+    def __getitem__(self, fname):
+        """Get the tag values of the instance with a filename"""
+        return self.get_tags(self.index(fname))
+
+    def as_numpy(self):
+        """Get zero-copy numpy views of the store (requires numpy)
+
+        Returns:
+            tags (numpy.ndarray of uint8), offsets (numpy.ndarray of uint64)
+        """
+        import numpy as np
+        return (np.frombuffer(self.tags, dtype=np.uint8),
+                np.frombuffer(self.offsets, dtype=np.uint64))
+
+    def close(self):
+        """Release the views and unmap the store"""
+        for view in (self.offsets, self._order, self.names, self.tags):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_tag_store(path, tag_items, name_len):
+    """Write a tag store from an iterable of tags
+
+    Args:
+        path (str): path of the store to write
+        tag_items (iterable of tuple): (fname, tag_values) pairs
+        name_len (int): number of bytes in each filename hash
+    """
+    with TagStoreWriter(path, name_len) as writer:
+        for fname, tag_values in tag_items:
+            writer.write(fname, tag_values)
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Convert the tags of a manifest to a binary tag store")
+    parser.add_argument('metadata_file',
+                        help=("(str) Path of the manifest.json, or of a manifest "
+                              "stream (.jsonl)"),
+                        metavar="<path>")
+    parser.add_argument('tag_store',
+                        help="(str) Path of the tag store to write",
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Convert args.metadata_file to args.tag_store
+
+    Returns: 0 if no error
+    """
+    tag_items = manifest.iter_manifest_tags(args.metadata_file)
+    first = next(tag_items, None)
+    if first is None:
+        name_len = 0
+    else:
+        name_len = len(_fname_to_digest(first[0]))
+        tag_items = itertools.chain([first], tag_items)
+    write_tag_store(args.tag_store, tag_items, name_len)
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
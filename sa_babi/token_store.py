@@ -0,0 +1,338 @@
+"""token_store.py: pre-tokenized instances with a fixed vocabulary
+
+The generator only ever emits a known set of tokens: the keywords and
+punctuation of cond_template.py, the VAR_STR variable names, integer
+literals below MAX_IDX and character literals of CHARSET. VOCAB lists them
+in a fixed order, so token ids are the same for every dataset; it is
+published as vocab.json next to this file (write it with -vocab_file).
+
+A token store holds the token ids of each line of each instance, aligned to
+the tags of the lines (the tag comments are not tokens). Like the tag store,
+it is a single file which loaders memory-map.
+
+Layout (little-endian, every section starts on a multiple of 8 bytes):
+    header          magic, num_instances, name_len, num_lines, num_tokens,
+                    vocab_size (6 x uint64)
+    line_offsets    (num_instances + 1) x uint64; the lines of instance i
+                    are lines line_offsets[i] to line_offsets[i + 1]
+    token_offsets   (num_lines + 1) x uint64; the tokens of line j are
+                    tokens[token_offsets[j]:token_offsets[j + 1]]
+    names           num_instances x name_len bytes; raw filename hashes
+    tags            num_lines x uint8; Tag value of each line
+    tokens          num_tokens x uint16; token ids
+
+e.g. tokenize a generated dataset:
+    python sa_babi/token_store.py work_directory/manifest.json tokens.bin
+"""
+
+import argparse
+import array
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+
+import gen_cond_example as gen
+import shards
+
+# identifies the file format and its version
+MAGIC = b"SATOKS01"
+
+# magic, num_instances, name_len, num_lines, num_tokens, vocab_size
+HEADER = struct.Struct("<8sQQQQQ")
+
+# padding token, never emitted by the generator
+PAD_TOKEN = "<pad>"
+
+# keywords and punctuation of the templates, in vocabulary order
+FIXED_TOKENS = ["#include", "<stdlib.h>", "int", "main", "char", "if",
+                "else", "return", "(", ")", "{", "}", "[", "]", ";", "=",
+                "<"]
+
+# token ids, in the order of their ids; append only, to keep ids stable
+VOCAB = ([PAD_TOKEN] + FIXED_TOKENS +
+         [gen.VAR_STR % itm for itm in range(gen.MAX_NUM_VARS)] +
+         [str(itm) for itm in range(gen.MAX_IDX)] +
+         ["'{}'".format(char) for char in gen.CHARSET])
+
+TOKEN_IDS = {token: token_id for (token_id, token) in enumerate(VOCAB)}
+
+# a token, or the tag comment which ends a line
+_TOKEN_RE = re.compile(r"//.*|#include|<stdlib\.h>|'.'|\w+|\S")
+
+
+def tokenize_line(line):
+    """Get the token ids of a line of an instance, without its tag comment
+
+    Raises:
+        ValueError: if the line has a token which is not in VOCAB
+    """
+    token_ids = []
+    for token in _TOKEN_RE.findall(line):
+        if token.startswith("//"):
+            break
+        try:
+            token_ids.append(TOKEN_IDS[token])
+        except KeyError:
+            raise ValueError("Token not in vocabulary: {!r}".format(token))
+    return token_ids
+
+
+def _pad(size):
+    """Round size up to a multiple of 8"""
+    return (size + 7) // 8 * 8
+
+
+def _write_section(f, data):
+    """Write data, followed by zeros up to a multiple of 8 bytes"""
+    f.write(data)
+    f.write(b"\0" * (_pad(len(data)) - len(data)))
+
+
+def _copy_section(f, tmp_file):
+    """Copy a spooled section, followed by zeros up to a multiple of 8 bytes"""
+    size = tmp_file.tell()
+    tmp_file.seek(0)
+    shutil.copyfileobj(tmp_file, f)
+    f.write(b"\0" * (_pad(size) - size))
+
+
+class TokenStoreWriter(object):
+    """Tokenize and write instances one at a time
+
+    Has the write() interface of the instance writers, so that main() can
+    tokenize instances as they are written. Only the line offsets are kept
+    in memory (8 bytes per instance); everything else is spooled to
+    temporary files until close() assembles the store.
+    """
+
+    def __init__(self, path, name_len):
+        """
+        Args:
+            path (str): path of the store to write
+            name_len (int): number of bytes in each filename hash
+        """
+        self.path = path
+        self.name_len = name_len
+        self._line_offsets = array.array('Q', [0])
+        self._num_tokens = 0
+        self._spools = {section: open("{}.{}.tmp".format(path, section), 'w+b')
+                        for section in ("token_offsets", "names", "tags",
+                                        "tokens")}
+        self._spools["token_offsets"].write(struct.pack("<Q", 0))
+
+    def write(self, fname, instance_str, tag_values):
+        """Append the token ids of the lines of an instance
+
+        Args:
+            fname (str): filename of the instance, e.g. '4a2405d586.c'
+            instance_str (str): str of code example
+            tag_values (list of int): value of the tag of each line
+
+        Returns:
+            num_tokens (int): number of tokens of the instance
+        """
+        digest = bytes.fromhex(os.path.splitext(fname)[0])
+        if len(digest) != self.name_len:
+            raise ValueError("Unexpected filename length: '{}'".format(fname))
+        lines = instance_str.split("\n")
+        if len(lines) != len(tag_values):
+            raise ValueError("{} has {} lines but {} tags".format(
+                fname, len(lines), len(tag_values)))
+
+        tokens = array.array('H')
+        token_offsets = array.array('Q')
+        for line in lines:
+            tokens.extend(tokenize_line(line))
+            token_offsets.append(self._num_tokens + len(tokens))
+        if sys.byteorder != 'little':
+            tokens.byteswap()
+            token_offsets.byteswap()
+        self._spools["names"].write(digest)
+        self._spools["tags"].write(bytes(tag_values))
+        self._spools["tokens"].write(tokens.tobytes())
+        self._spools["token_offsets"].write(token_offsets.tobytes())
+        self._num_tokens += len(tokens)
+        self._line_offsets.append(self._line_offsets[-1] + len(lines))
+        return len(tokens)
+
+    def sync(self):
+        """Nothing to restore on resume; the store is assembled at close()"""
+        return None
+
+    def close(self):
+        """Assemble the store and remove the temporary files"""
+        num_instances = len(self._line_offsets) - 1
+        line_offsets = self._line_offsets
+        if sys.byteorder != 'little':
+            line_offsets = array.array('Q', line_offsets)
+            line_offsets.byteswap()
+
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, num_instances, self.name_len,
+                                self._line_offsets[-1], self._num_tokens,
+                                len(VOCAB)))
+            _write_section(f, line_offsets.tobytes())
+            for section in ("token_offsets", "names", "tags", "tokens"):
+                _copy_section(f, self._spools[section])
+
+        for tmp_file in self._spools.values():
+            tmp_file.close()
+            os.remove(tmp_file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TokenStore(object):
+    """Memory-mapped, read-only view of a token store
+
+    Attributes:
+        line_offsets (memoryview of uint64): num_instances + 1 offsets into
+            the lines
+        token_offsets (memoryview of uint64): num_lines + 1 offsets into
+            tokens
+        names (memoryview of bytes): raw filename hashes, name_len each
+        tags (memoryview of uint8): Tag value of each line
+        tokens (memoryview of uint16): token ids of all lines
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): path of the store
+
+        Raises:
+            ValueError: if the store was written with another vocabulary
+                size than VOCAB
+        """
+        if sys.byteorder != 'little':
+            raise NotImplementedError("Token stores are little-endian")
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        (magic, num_instances, name_len, num_lines, num_tokens,
+         vocab_size) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError("Not a token store: '{}'".format(path))
+        if vocab_size != len(VOCAB):
+            raise ValueError("Token store has {} tokens in its vocabulary, "
+                             "not {}".format(vocab_size, len(VOCAB)))
+        self.num_instances = num_instances
+        self.name_len = name_len
+
+        view = memoryview(self._mmap)
+        pos = HEADER.size
+        sections = []
+        for size in (8 * (num_instances + 1), 8 * (num_lines + 1),
+                     name_len * num_instances, num_lines, 2 * num_tokens):
+            sections.append(view[pos:pos + size])
+            pos += _pad(size)
+        self.line_offsets = sections[0].cast('Q')
+        self.token_offsets = sections[1].cast('Q')
+        self.names = sections[2]
+        self.tags = sections[3]
+        self.tokens = sections[4].cast('H')
+
+    def __len__(self):
+        return self.num_instances
+
+    def fname(self, i):
+        """Get the filename of instance i"""
+        name = self.names[i * self.name_len:(i + 1) * self.name_len]
+        return "{}.c".format(name.hex())
+
+    def get_tags(self, i):
+        """Get the tag values of the lines of instance i, as memoryview"""
+        return self.tags[self.line_offsets[i]:self.line_offsets[i + 1]]
+
+    def get_lines(self, i):
+        """Get the token ids of each line of instance i
+
+        Returns:
+            lines (list of memoryview of uint16), aligned to get_tags(i)
+        """
+        offsets = self.token_offsets
+        return [self.tokens[offsets[line]:offsets[line + 1]]
+                for line in range(self.line_offsets[i],
+                                  self.line_offsets[i + 1])]
+
+    def as_numpy(self):
+        """Get zero-copy numpy views of the store (requires numpy)
+
+        Returns:
+            tokens (numpy.ndarray of uint16), token_offsets,
+            line_offsets (numpy.ndarray of uint64), tags (numpy.ndarray of
+            uint8)
+        """
+        import numpy as np
+        return (np.frombuffer(self.tokens, dtype=np.uint16),
+                np.frombuffer(self.token_offsets, dtype=np.uint64),
+                np.frombuffer(self.line_offsets, dtype=np.uint64),
+                np.frombuffer(self.tags, dtype=np.uint8))
+
+    def close(self):
+        """Release the views and unmap the store"""
+        for view in (self.line_offsets, self.token_offsets, self.names,
+                     self.tags, self.tokens):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_vocab(path):
+    """Publish VOCAB as a JSON list; the index of a token is its id"""
+    with open(path, 'w') as f:
+        json.dump(VOCAB, f, indent=0)
+        f.write("\n")
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Tokenize the instances of a generated dataset")
+    parser.add_argument('metadata_file',
+                        help="(str) Path of the manifest.json of the dataset",
+                        metavar="<path>")
+    parser.add_argument('token_store',
+                        help="(str) Path of the token store to write",
+                        metavar="<path>")
+    parser.add_argument('-vocab_file',
+                        help="(str) Path of a JSON file to publish the vocabulary to",
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Tokenize the instances of args.metadata_file into args.token_store
+
+    The instances are read from the .c files (or shards) in the working_dir
+    of the manifest.
+
+    Returns: 0 if no error
+    """
+    with TokenStoreWriter(args.token_store, gen.FNAME_HASHLEN) as writer:
+        for fname, instance_str, tag_values in shards.iter_dataset(
+                args.metadata_file):
+            writer.write(fname, instance_str, tag_values)
+
+    if args.vocab_file is not None:
+        write_vocab(args.vocab_file)
+    return 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
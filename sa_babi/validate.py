@@ -0,0 +1,344 @@
+"""validate.py: check that the buffer write tags match what the code does
+
+Two checks, both reporting mismatches per filename and line:
+
+evaluate   An in-process interpreter of the C subset of cond_template.py
+           (declarations, integer assignments, one if/else on a comparison
+           and buffer writes) recomputes the tag of every buffer write: a
+           write is safe if its index is within the buffer, and it is a
+           BUFWRITE_COND_* write if its index is assigned inside the
+           control flow, else a BUFWRITE_TAUT_* write. Writes in the branch
+           not taken are judged by the values they would see. This runs at
+           about the speed of generation.
+
+compile    Thousands of instances are wrapped into one translation unit:
+           the main() of each becomes a static function, every buffer write
+           is instrumented to report whether its index is in bounds (and
+           is only performed if it is), and #line directives map compiler
+           diagnostics back to the filename and line of the instance. One
+           compiler call and one run then check a whole batch. Writes in
+           the branch not taken are not executed and hence not checked.
+
+e.g.
+    python sa_babi/validate.py work_directory/manifest.json --compile
+"""
+
+import argparse
+import collections
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import shards
+
+from sa_tag import Tag
+
+# number of instances compiled into one translation unit
+DEFAULT_COMPILE_BATCH_SIZE = 2000
+
+# C compiler used by the compile check
+DEFAULT_CC = os.environ.get("CC", "cc")
+
+# seconds a compiled batch may run
+RUN_TIMEOUT = 60
+
+_SAFE_TAGS = (Tag.BUFWRITE_COND_SAFE, Tag.BUFWRITE_TAUT_SAFE)
+_BUFWRITE_TAGS = _SAFE_TAGS + (Tag.BUFWRITE_COND_UNSAFE,
+                               Tag.BUFWRITE_TAUT_UNSAFE)
+
+# statements of the C subset, without indentation and tag comment
+_BUF_DEC_RE = re.compile(r"char (\w+)\[(\d+)\];$")
+_INT_DEC_RE = re.compile(r"int (\w+);$")
+_ASSIGN_RE = re.compile(r"(\w+) = (\w+);$")
+_IF_RE = re.compile(r"if\((\w+) < (\w+)\)\{$")
+_BUFWRITE_RE = re.compile(r"(\w+)\[(\w+)\] = '.';$")
+_WRAPPER_LINES = frozenset(["#include <stdlib.h>", "int main()", "{",
+                            "return 0;"])
+
+# a buffer write in the compiled batch, with its indentation
+_BUFWRITE_LINE_RE = re.compile(r"^(\s*)(\w+)\[(\w+)\] = ('.');")
+
+# a compiler diagnostic located by #line, e.g. "4a2405d586.c:7:5: error: ..."
+_DIAGNOSTIC_RE = re.compile(r"^(\w+\.c):(\d+):(?:\d+:)? error: (.*)$")
+
+_BATCH_PROLOGUE = """#include <stdio.h>
+static int sa_inst;
+#define SA_WRITE(line, buf, idx, chr) do { \\
+    int sa_ok = (idx) >= 0 && (idx) < (int)sizeof(buf); \\
+    printf("%d %d %d\\n", sa_inst, line, sa_ok); \\
+    if (sa_ok) (buf)[idx] = (chr); \\
+} while (0)
+"""
+
+
+def _get_statement(line):
+    """Strip the indentation and the tag comment of a line"""
+    return line.split("//", 1)[0].strip()
+
+
+def evaluate_instance(instance_str):
+    """Recompute the tags of the buffer writes of an instance
+
+    Args:
+        instance_str (str): str of code example, with or without tag
+            comments
+
+    Returns:
+        bufwrite_tags (dict): line number (0-based) -> Tag of each buffer
+            write
+
+    Raises:
+        ValueError: if a line is not in the C subset, or a variable is used
+            before it is declared or assigned
+    """
+    buf_lens = {}
+    values = {}
+    # (branch taken, whether the else branch was reached) of each open if
+    branches = []
+    control_flow_vars = set()
+    bufwrite_tags = {}
+
+    def value(token, line_num):
+        if token.isdigit():
+            return int(token)
+        if values.get(token) is None:
+            raise ValueError("Line {}: '{}' is not assigned".format(
+                line_num + 1, token))
+        return values[token]
+
+    for (line_num, line) in enumerate(instance_str.split("\n")):
+        statement = _get_statement(line)
+        executed = all(taken != in_else for (taken, in_else) in branches)
+        match = _BUFWRITE_RE.match(statement)
+        if match:
+            buf_var, idx = match.groups()
+            if buf_var not in buf_lens:
+                raise ValueError("Line {}: '{}' is not a buffer".format(
+                    line_num + 1, buf_var))
+            safe = 0 <= value(idx, line_num) < buf_lens[buf_var]
+            if idx in control_flow_vars:
+                tags = (Tag.BUFWRITE_COND_SAFE, Tag.BUFWRITE_COND_UNSAFE)
+            else:
+                tags = (Tag.BUFWRITE_TAUT_SAFE, Tag.BUFWRITE_TAUT_UNSAFE)
+            bufwrite_tags[line_num] = tags[0] if safe else tags[1]
+            continue
+
+        match = _ASSIGN_RE.match(statement)
+        if match:
+            var, token = match.groups()
+            if var not in values:
+                raise ValueError("Line {}: '{}' is not declared".format(
+                    line_num + 1, var))
+            if branches:
+                control_flow_vars.add(var)
+            if executed:
+                values[var] = value(token, line_num)
+            continue
+
+        match = _IF_RE.match(statement)
+        if match:
+            left, right = match.groups()
+            taken = value(left, line_num) < value(right, line_num)
+            branches.append((taken, False))
+            continue
+
+        match = _BUF_DEC_RE.match(statement)
+        if match:
+            buf_lens[match.group(1)] = int(match.group(2))
+            continue
+
+        match = _INT_DEC_RE.match(statement)
+        if match:
+            values[match.group(1)] = None
+        elif statement == "} else {" and branches:
+            branches[-1] = (branches[-1][0], True)
+        elif statement == "}" and branches:
+            branches.pop()
+        elif statement not in _WRAPPER_LINES and statement != "}":
+            raise ValueError("Line {}: not in the C subset: '{}'".format(
+                line_num + 1, statement))
+    return bufwrite_tags
+
+
+def check_instance(instance_str, tag_values):
+    """Compare the tags of an instance with those evaluate_instance computes
+
+    Args:
+        instance_str (str): str of code example
+        tag_values (list of int): value of the tag of each line
+
+    Returns:
+        mismatches (list of tuple): (line number (1-based), message)
+    """
+    try:
+        bufwrite_tags = evaluate_instance(instance_str)
+    except ValueError as error:
+        return [(0, str(error))]
+    mismatches = []
+    for (line_num, tag_value) in enumerate(tag_values):
+        tag = Tag(tag_value)
+        expected = bufwrite_tags.get(line_num)
+        if expected is None and tag in _BUFWRITE_TAGS:
+            mismatches.append((line_num + 1, "tagged {} but not a buffer "
+                               "write".format(tag)))
+        elif expected is not None and tag != expected:
+            mismatches.append((line_num + 1, "tagged {}, evaluates to "
+                               "{}".format(tag, expected)))
+    return mismatches
+
+
+def _get_batch_source(instances):
+    """Wrap instances into one translation unit, see the module docstring
+
+    Args:
+        instances (list of tuple): (fname, instance_str, tag_values)
+
+    Returns:
+        source (str)
+    """
+    parts = [_BATCH_PROLOGUE]
+    for (inst_num, (fname, instance_str, _)) in enumerate(instances):
+        parts.append('#line 1 "{}"'.format(fname))
+        for (line_num, line) in enumerate(instance_str.split("\n")):
+            statement = _get_statement(line)
+            if statement == "#include <stdlib.h>":
+                line = ""  # keeps the line numbers
+            elif statement == "int main()":
+                line = "static int sa_main_{}(void)".format(inst_num)
+            else:
+                line = _BUFWRITE_LINE_RE.sub(
+                    r"\1SA_WRITE({}, \2, \3, \4);".format(line_num + 1), line)
+            parts.append(line)
+    parts.append('#line 1 "sa_batch_driver.c"')
+    parts.append("int main(void)\n{")
+    for inst_num in range(len(instances)):
+        parts.append("    sa_inst = {0}; sa_main_{0}();".format(inst_num))
+    parts.append("    return 0;\n}\n")
+    return "\n".join(parts)
+
+
+def compile_check(instances, cc=DEFAULT_CC):
+    """Compile and run a batch of instances with instrumented buffer writes
+
+    Args:
+        instances (list of tuple): (fname, instance_str, tag_values)
+        cc (str): C compiler to use
+
+    Returns:
+        mismatches (list of tuple): (fname, line number, message)
+        num_checked (int): number of buffer writes executed and checked
+    """
+    mismatches = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = os.path.join(tmp_dir, "sa_batch.c")
+        exe_path = os.path.join(tmp_dir, "sa_batch")
+        with open(src_path, 'w') as f:
+            f.write(_get_batch_source(instances))
+        result = subprocess.run([cc, "-std=c99", "-w", "-O0", "-o", exe_path,
+                                 src_path], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            for line in result.stderr.splitlines():
+                match = _DIAGNOSTIC_RE.match(line)
+                if match:
+                    fname, line_num, message = match.groups()
+                    mismatches.append((fname, int(line_num),
+                                       "compile error: " + message))
+            if not mismatches:
+                raise OSError("{} failed: {}".format(cc, result.stderr))
+            return mismatches, 0
+        result = subprocess.run([exe_path], stdout=subprocess.PIPE,
+                                universal_newlines=True, timeout=RUN_TIMEOUT,
+                                check=True)
+
+    num_checked = 0
+    for line in result.stdout.splitlines():
+        inst_num, line_num, in_bounds = (int(itm) for itm in line.split())
+        fname, _, tag_values = instances[inst_num]
+        tag = Tag(tag_values[line_num - 1])
+        num_checked += 1
+        if tag not in _BUFWRITE_TAGS:
+            mismatches.append((fname, line_num, "tagged {} but writes a "
+                               "buffer".format(tag)))
+        elif (tag in _SAFE_TAGS) != bool(in_bounds):
+            mismatches.append((fname, line_num, "tagged {}, but the index "
+                               "is {}in bounds".format(
+                                   tag, "" if in_bounds else "not ")))
+    return mismatches, num_checked
+
+
+def _iter_batches(items, batch_size):
+    """Yield lists of up to batch_size items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _get_args():
+    """Get command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Check the buffer write tags of a generated dataset")
+    parser.add_argument('metadata_file',
+                        help="(str) Path of the manifest.json of the dataset",
+                        metavar="<path>")
+    parser.add_argument('--compile',
+                        action='store_true',
+                        help=("If passed, then also compile and run the instances, "
+                              "in batches"))
+    parser.add_argument('-compile_batch_size',
+                        help=("(int) Number of instances per compiler call; default "
+                              "{}".format(DEFAULT_COMPILE_BATCH_SIZE)),
+                        default=DEFAULT_COMPILE_BATCH_SIZE,
+                        metavar="<int>")
+    parser.add_argument('-cc',
+                        help="(str) C compiler; default {}".format(DEFAULT_CC),
+                        default=DEFAULT_CC,
+                        metavar="<path>")
+    return parser.parse_args()
+
+
+def main(args):
+    """Report the mismatches of args.metadata_file, one per line
+
+    Returns: 0 if every tag matches, 1 otherwise
+    """
+    batch_size = int(args.compile_batch_size)
+    if batch_size < 1:
+        raise ValueError("compile_batch_size must be positive: {}".format(
+            batch_size))
+
+    counts = collections.Counter()
+    for batch in _iter_batches(shards.iter_dataset(args.metadata_file),
+                               batch_size):
+        for fname, instance_str, tag_values in batch:
+            counts["instances"] += 1
+            for line_num, message in check_instance(instance_str, tag_values):
+                counts["mismatches"] += 1
+                print("{}:{}: {}".format(fname, line_num, message))
+        if args.compile:
+            mismatches, num_checked = compile_check(batch, args.cc)
+            counts["compiled_writes"] += num_checked
+            for fname, line_num, message in mismatches:
+                counts["mismatches"] += 1
+                print("{}:{}: {}".format(fname, line_num, message))
+
+    summary = "{} instances, {} mismatches".format(counts["instances"],
+                                                   counts["mismatches"])
+    if args.compile:
+        summary += ", {} executed buffer writes compiled and checked".format(
+            counts["compiled_writes"])
+    print(summary, file=sys.stderr)
+    return 1 if counts["mismatches"] else 0
+
+
+if __name__ == '__main__':
+    RET = main(_get_args())
+    sys.exit(RET)
@@ -0,0 +1,195 @@
+"""writers.py: write generated instances to the output directory"""
+
+import os
+import queue
+import threading
+
+# maximum number of instances a writer thread takes from the queue at once
+WRITE_BATCH_SIZE = 64
+
+
+class FileWriter(object):
+    """Write every instance to its own .c file"""
+
+    def __init__(self, outdir):
+        """
+        Args:
+            outdir (str): path to directory to write instance.c files to;
+                must exist
+        """
+        self.outdir = outdir
+
+    def write(self, fname, instance_str, tag_values):
+        """Write an instance to outdir/fname
+
+        Args:
+            fname (str): filename of the instance, e.g. '4a2405d586.c'
+            instance_str (str): str of code example
+            tag_values (list of int): value of the tag of each line; unused,
+                the tags only go to the metadata file
+
+        Returns:
+            num_bytes (int): number of bytes written; instances are ASCII
+        """
+        path = os.path.join(self.outdir, fname)
+        with open(path, 'w') as f:
+            return f.write(instance_str)
+
+    def sync(self):
+        """Nothing to flush; every file is closed right after writing
+
+        Returns:
+            None, as there is no state to restore on resume
+        """
+        return None
+
+    def close(self):
+        """Nothing to flush; every file is closed right after writing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PipelinedFileWriter(object):
+    """Write every instance to its own .c file from a pool of writer threads
+
+    write() only puts the instance into a bounded queue, so that generation
+    continues while the threads wait on the file system; when the queue is
+    full, write() blocks until the threads catch up, which bounds memory.
+    Each thread takes up to WRITE_BATCH_SIZE instances at a time, writes
+    them, and with fsync flushes the whole batch to disk before taking the
+    next one.
+
+    Every instance goes to the file named by its hash, so the files do not
+    depend on the order in which the threads write them.
+    """
+
+    def __init__(self, outdir, num_threads, queue_depth, fsync=False):
+        """
+        Args:
+            outdir (str): path to directory to write instance.c files to;
+                must exist
+            num_threads (int): number of writer threads
+            queue_depth (int): maximum number of instances waiting to be
+                written
+            fsync (bool): whether to flush every batch of files (and outdir)
+                to disk
+        """
+        self.outdir = outdir
+        self.fsync = fsync
+        self._queue = queue.Queue(queue_depth)
+        self._error = None
+        self._threads = [threading.Thread(target=self._drain, daemon=True)
+                         for _ in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _drain(self):
+        """Write batches from the queue until a None sentinel is taken"""
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            try:
+                if self._error is None:
+                    self._write_batch(batch)
+            except Exception as error:  # re-raised in the main thread
+                self._error = error
+            finally:
+                for _ in range(len(batch) + done):
+                    self._queue.task_done()
+            if done:
+                return
+
+    def _write_batch(self, batch):
+        """Write a batch of (fname, instance_str), fsynced if self.fsync"""
+        files = []
+        try:
+            for fname, instance_str in batch:
+                f = open(os.path.join(self.outdir, fname), 'w')
+                files.append(f)
+                f.write(instance_str)
+            if self.fsync:
+                for f in files:
+                    f.flush()
+                    os.fsync(f.fileno())
+        finally:
+            for f in files:
+                f.close()
+        if self.fsync and batch:
+            dir_fd = os.open(self.outdir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _check(self):
+        """Raise the first error of a writer thread, if any"""
+        if self._error is not None:
+            raise self._error
+
+    def write(self, fname, instance_str, tag_values):
+        """Queue an instance to be written to outdir/fname
+
+        Blocks while the queue is full.
+
+        Args:
+            fname (str): filename of the instance, e.g. '4a2405d586.c'
+            instance_str (str): str of code example
+            tag_values (list of int): value of the tag of each line; unused,
+                the tags only go to the metadata file
+
+        Returns:
+            num_bytes (int): number of bytes to be written; instances are
+                ASCII
+        """
+        self._check()
+        self._queue.put((fname, instance_str))
+        return len(instance_str)
+
+    def sync(self):
+        """Wait until every queued instance is written
+
+        Returns:
+            None, as there is no state to restore on resume
+        """
+        self._queue.join()
+        self._check()
+        return None
+
+    def _stop(self):
+        """Write the queued instances and stop the threads"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        """Write the queued instances and stop the threads
+
+        Raises:
+            OSError: the first error of a writer thread, if any
+        """
+        self._stop()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+            return
+        # leaving on an exception: raising an error of a writer thread
+        # would hide it
+        self._stop()
@@ -0,0 +1,62 @@
+"""Shared fixtures; the modules of sa_babi import each other by name"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "sa_babi"))
+
+import gen_cond_example as gen  # noqa: E402
+
+
+def run_main(outdir, *argv):
+    """Run gen_cond_example.main() with command-line arguments"""
+    return gen.main(gen._get_args([str(outdir)] + [str(arg) for arg in argv]))
+
+
+def read_dataset(outdir):
+    """Get {filename: contents} of the .c files of outdir"""
+    instances = {}
+    for fname in os.listdir(str(outdir)):
+        if fname.endswith(".c"):
+            with open(os.path.join(str(outdir), fname)) as f:
+                instances[fname] = f.read()
+    return instances
+
+
+def read_tags(metadata_file):
+    """Get the tags of a manifest.json as a list of (fname, tags) pairs"""
+    with open(str(metadata_file)) as f:
+        return list(json.load(f)["tags"].items())
+
+
+def read_run(outdir):
+    """Get the .c files, tags and run state of a run"""
+    with open(str(outdir / "manifest.json")) as f:
+        metadata = json.load(f)
+    del metadata["working_dir"]
+    return read_dataset(outdir), metadata
+
+
+@pytest.fixture(scope="module")
+def instances():
+    """(fname, instance_str, tag_values) of 300 instances, without repeats"""
+    items = {}
+    for index in range(300):
+        instance_str, tags = gen.generate_instance(0, index)
+        items[gen._generate_file_name(instance_str)] = (
+            instance_str, [tag.value for tag in tags])
+    return [(fname,) + item for (fname, item) in items.items()]
+
+
+@pytest.fixture
+def make_dir(tmp_path):
+    """Create a subdirectory of tmp_path by name"""
+    def make(name):
+        path = tmp_path / name
+        path.mkdir()
+        return path
+    return make
@@ -0,0 +1,72 @@
+"""Appended runs equal single runs"""
+
+import os
+
+import pytest
+
+from conftest import read_run, run_main
+
+
+def _run(outdir, num_instances, *argv):
+    """Run into outdir with its manifest and manifest stream"""
+    run_main(outdir, "-num_instances", num_instances,
+             "-metadata_file", outdir / "manifest.json",
+             "-manifest_stream", outdir / "manifest.jsonl", *argv)
+
+
+# 200 + 300 keeps the digits of the header, 5 + 10 does not
+@pytest.mark.parametrize("extra_args", [(), ("--canonical_dedup",)])
+@pytest.mark.parametrize("first, second", [(200, 300), (5, 10)])
+def test_append_equals_single_run(make_dir, extra_args, first, second):
+    reference = make_dir("reference")
+    _run(reference, first + second, *extra_args)
+
+    appended = make_dir("appended")
+    _run(appended, first, *extra_args)
+    _run(appended, second, "--append", *extra_args)
+    assert read_run(appended) == read_run(reference)
+    assert sorted(path.name for path in appended.iterdir()
+                  if not path.name.endswith(".c")) == sorted(
+                      path.name for path in reference.iterdir()
+                      if not path.name.endswith(".c"))
+    with open(str(appended / "manifest.json")) as f:
+        appended_json = f.read()
+    with open(str(reference / "manifest.json")) as f:
+        assert appended_json == f.read().replace(str(reference),
+                                                 str(appended))
+
+
+def test_append_writes_the_manifest_in_place(make_dir):
+    outdir = make_dir("out")
+    _run(outdir, 200)
+    inode = os.stat(str(outdir / "manifest.json")).st_ino
+    _run(outdir, 300, "--append")
+    assert os.stat(str(outdir / "manifest.json")).st_ino == inode
+
+
+def test_append_rejects_another_seed(make_dir):
+    outdir = make_dir("out")
+    _run(outdir, 10)
+    with pytest.raises(ValueError):
+        _run(outdir, 10, "-seed", 1, "--append")
+
+
+@pytest.mark.parametrize("extra_args", [("--taut_only",),
+                                        ("-cond_safe_ratio", 0.5),
+                                        ("-taut_safe_ratio", 0.5),
+                                        ("-variants", "clean"),
+                                        ("--canonical_dedup",),
+                                        ("-tag_store", "tags.bin")])
+def test_append_rejects_other_options(make_dir, extra_args):
+    outdir = make_dir("out")
+    _run(outdir, 10)
+    with pytest.raises(ValueError):
+        _run(outdir, 10, "--append", *extra_args)
+
+
+def test_append_requires_the_manifest_stream(make_dir):
+    outdir = make_dir("out")
+    _run(outdir, 10)
+    with pytest.raises(ValueError):
+        run_main(outdir, "-num_instances", 10, "--append",
+                 "-metadata_file", outdir / "manifest.json")
@@ -0,0 +1,53 @@
+"""Labels of vectorized batches agree with their rendered instances"""
+
+import pytest
+
+from sa_tag import Tag
+
+import validate
+from conftest import gen
+
+np = pytest.importorskip("numpy")
+
+import batch_gen  # noqa: E402
+
+
+@pytest.mark.parametrize("include_cond_bufwrite", [True, False])
+def test_labels_match_rendered_instances(include_cond_bufwrite):
+    batch = batch_gen.gen_cond_examples(
+        300, rng=0, include_cond_bufwrite=include_cond_bufwrite)
+    assert len(batch) == 300
+    for i, (instance_str, tags) in enumerate(batch):
+        tag_values = [tag.value for tag in tags]
+        assert validate.check_instance(instance_str, tag_values) == []
+
+        cond_tags = [tag.value for tag in tags
+                     if tag.name.startswith("BUFWRITE_COND")]
+        if include_cond_bufwrite:
+            assert cond_tags == [batch.cond_tags[i]]
+        else:
+            assert cond_tags == [] and batch.cond_tags[i] == -1
+        num_dummies = batch.num_dummies[i]
+        assert sorted(tag.value for tag in tags
+                      if tag.name.startswith("BUFWRITE_TAUT")) == sorted(
+                          batch.taut_tags[i, :num_dummies])
+        assert (batch.taut_tags[i, num_dummies:] == -1).all()
+        assert "[{}];".format(batch.buf_len[i]) in instance_str
+
+
+def test_batch_depends_on_seed_only():
+    first = batch_gen.gen_cond_examples(50, rng=3)
+    again = batch_gen.gen_cond_examples(50, rng=3)
+    assert list(first) == list(again)
+    assert (first.cond_tags == again.cond_tags).all()
+    assert list(batch_gen.gen_cond_examples(50, rng=4)) != list(first)
+
+
+def test_labels_follow_the_generator_distribution():
+    # the conditional write is safe with probability 0.495 (see
+    # gen_cond_example); 20000 draws put 0.47 and 0.52 over 7 sigma away
+    batch = batch_gen.gen_cond_examples(20000, rng=1)
+    safe_ratio = np.mean(batch.cond_tags == Tag.BUFWRITE_COND_SAFE.value)
+    assert 0.47 < safe_ratio < 0.52
+    assert set(np.unique(batch.num_dummies)) == set(
+        range(gen.MAX_NUM_DUMMIES + 1))
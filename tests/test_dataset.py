@@ -0,0 +1,92 @@
+"""The streaming dataset yields the instances of a run"""
+
+import json
+
+import pytest
+
+import dataset
+from conftest import gen, run_main
+
+
+def _collect(records):
+    return [(instance_str, tag_values) for (instance_str, tag_values)
+            in records]
+
+
+def _owner(record, num_workers):
+    """Get the worker of a record without tag comments"""
+    return int(gen._generate_file_name(record[0])[:-2], 16) % num_workers
+
+
+def test_one_worker_with_dedup_equals_main(make_dir):
+    outdir = make_dir("out")
+    run_main(outdir, "-num_instances", 300, "-seed", 2,
+             "-metadata_file", outdir / "manifest.json")
+    written = []
+    with open(str(outdir / "manifest.json")) as f:
+        for fname, tag_values in json.load(f)["tags"].items():
+            written.append(((outdir / fname).read_text(), tag_values))
+    assert _collect(dataset.CondExampleDataset(
+        seed=2, num_instances=300, dedup=True)) == written
+
+
+@pytest.mark.parametrize("dedup", [False, True])
+def test_workers_split_the_instances_by_hash(dedup):
+    single = _collect(dataset.iter_examples(0, 100, dedup=dedup,
+                                            tags_as_comments=False))
+    shares = [_collect(dataset.iter_examples(
+        0, 100, dedup=dedup, worker_id=worker_id, num_workers=3,
+        tags_as_comments=False)) for worker_id in range(3)]
+    assert sum(len(share) for share in shares) == 100
+    for worker_id, share in enumerate(shares):
+        # each worker keeps the records of the single stream it owns
+        assert share == [record for record in single
+                         if _owner(record, 3) == worker_id]
+
+
+def test_workers_never_yield_the_same_instance():
+    fnames = [gen._generate_file_name(instance_str)
+              for worker_id in range(4)
+              for (instance_str, _) in dataset.iter_examples(
+                  0, 400, dedup=True, worker_id=worker_id, num_workers=4,
+                  tags_as_comments=False)]
+    assert len(fnames) == len(set(fnames)) == 400
+
+
+def test_prefetch_yields_the_same_records():
+    expected = _collect(dataset.CondExampleDataset(seed=1, num_instances=50))
+    assert _collect(dataset.CondExampleDataset(
+        seed=1, num_instances=50, prefetch=4)) == expected
+
+
+def test_prefetch_raises_errors_and_stops(monkeypatch):
+    def failing(*args, **kwargs):
+        yield gen.generate_instance(0, 0)[0], []
+        raise ValueError("failed")
+
+    monkeypatch.setattr(dataset, "iter_examples", failing)
+    records = iter(dataset.CondExampleDataset(prefetch=2))
+    next(records)
+    with pytest.raises(ValueError):
+        next(records)
+
+    # closing early stops the background thread
+    monkeypatch.undo()
+    records = iter(dataset.CondExampleDataset(prefetch=2))
+    next(records)
+    records.close()
+
+
+def test_clean_records_have_no_tag_comments():
+    for (clean, clean_tags), (annotated, tags) in zip(
+            dataset.iter_examples(0, 20, tags_as_comments=False),
+            dataset.iter_examples(0, 20)):
+        assert "//" not in clean
+        assert clean_tags == tags
+        assert gen.annotate_instance(
+            clean, [gen.Tag(tag_value) for tag_value in tags]) == annotated
+
+
+def test_worker_id_is_checked():
+    with pytest.raises(ValueError):
+        next(dataset.iter_examples(0, 10, worker_id=2, num_workers=2))
@@ -0,0 +1,63 @@
+"""Dataset stats of --dataset_stats"""
+
+import argparse
+import collections
+
+from sa_tag import Tag
+
+import dataset_stats
+from conftest import read_tags, run_main
+
+
+def _run(outdir, *argv):
+    """Run with --dataset_stats; get the stats and the manifest tags"""
+    run_main(outdir, "-metadata_file", outdir / "manifest.json",
+             "--dataset_stats", *argv)
+    stats = dataset_stats.load(str(outdir / dataset_stats.STATS_FNAME))
+    return stats, read_tags(outdir / "manifest.json")
+
+
+def test_counters_match_the_manifest(make_dir):
+    stats, tags = _run(make_dir("out"), "-num_instances", 300,
+                       "-workers", 2)
+    tag_counts = collections.Counter(
+        value for (_, tag_values) in tags for value in tag_values)
+    assert stats.counters["instances"] == len(tags) == 300
+    assert stats.counters["attempts"] == 300 + stats.counters["collisions"]
+    for tag in Tag:
+        assert stats.counters[tag.name] == tag_counts[tag.value]
+    assert stats.histograms["num_lines"] == collections.Counter(
+        len(tag_values) for (_, tag_values) in tags)
+    # one buffer length is sampled per instance
+    assert sum(stats.histograms["buf_len"].values()) == 300
+
+
+def test_summary_round_trips(make_dir):
+    stats, _ = _run(make_dir("out"), "-num_instances", 50)
+    summary = stats.summary()
+    again = dataset_stats.DatasetStats.from_summary(summary)
+    assert again.counters == stats.counters
+    assert again.histograms == stats.histograms
+    assert again.summary() == summary
+    fractions = summary["derived"]["tag_fractions"]
+    assert abs(sum(fractions.values()) - 1) < 1e-9
+
+
+def test_slice_stats_merge_into_the_run_stats(make_dir):
+    paths = []
+    slice_stats = []
+    for slice_num in range(2):
+        outdir = make_dir("slice-{}".format(slice_num))
+        stats, _ = _run(outdir, "-num_instances", 100,
+                        "-index_offset", slice_num, "-index_stride", 2)
+        paths.append(str(outdir / dataset_stats.STATS_FNAME))
+        slice_stats.append(stats)
+    merged_path = str(make_dir("merged") / dataset_stats.STATS_FNAME)
+    dataset_stats.main(argparse.Namespace(out_file=merged_path,
+                                          stats_files=paths))
+
+    merged = dataset_stats.load(merged_path)
+    assert merged.counters == slice_stats[0].counters + slice_stats[1].counters
+    for name, histogram in merged.histograms.items():
+        assert histogram == (slice_stats[0].histograms[name] +
+                             slice_stats[1].histograms[name])
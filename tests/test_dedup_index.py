@@ -0,0 +1,26 @@
+"""Round trip of the persistent dedup index"""
+
+import pytest
+
+import dedup_index
+
+
+@pytest.mark.parametrize("with_numpy", [True, False])
+def test_dedup_index_round_trip(tmp_path, monkeypatch, instances, with_numpy):
+    if not with_numpy:
+        # several sorted runs, merged
+        monkeypatch.setattr(dedup_index, "np", None)
+        monkeypatch.setattr(dedup_index, "SORT_RUN_KEYS", 16)
+    index_dir = str(tmp_path / "index")
+    fnames = [fname for (fname, _, _) in instances]
+    # repeated filenames are stored once
+    dedup_index.write_dataset_set(index_dir, "train",
+                                  fnames[:200] + fnames[100:150])
+    dedup_index.write_dataset_set(index_dir, "test", fnames[200:250])
+    assert dedup_index.list_datasets(index_dir) == ["test", "train"]
+    with dedup_index.DedupIndex(index_dir, ["train", "test"]) as index:
+        assert len(index) == 250
+        assert all(fname in index for fname in fnames[:250])
+        assert not any(fname in index for fname in fnames[250:])
+    with pytest.raises(ValueError):
+        dedup_index.DedupIndex(index_dir, ["valid"])
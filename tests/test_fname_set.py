@@ -0,0 +1,26 @@
+"""The compact filename table of the collision check"""
+
+import pytest
+
+import dedup_index
+from conftest import gen
+
+
+@pytest.mark.parametrize("in_file", [False, True])
+def test_fname_set(tmp_path, monkeypatch, instances, in_file):
+    # grows from 4 slots, through several rehashes
+    monkeypatch.setattr(dedup_index, "MIN_CAPACITY", 4)
+    path = str(tmp_path / "fnames") if in_file else None
+    fnames = [fname for (fname, _, _) in instances] + ["0000000000.c"]
+    with dedup_index.FnameSet(gen.FNAME_HASHLEN, path) as fname_set:
+        for i, fname in enumerate(fnames):
+            assert fname not in fname_set
+            fname_set.add(fname)
+            fname_set.add(fname)
+            assert fname in fname_set
+            assert len(fname_set) == i + 1
+        assert sorted(fname_set) == sorted(fnames)
+        if in_file:
+            assert sorted(path.name for path in tmp_path.iterdir()) == [
+                "fnames"]
+    assert not (tmp_path / "fnames").exists()
@@ -0,0 +1,77 @@
+"""Records served by gen_server over localhost HTTP"""
+
+import multiprocessing
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import gen_server
+from conftest import gen
+
+
+@pytest.fixture(params=[1, 2])
+def server_url(request):
+    """Serve on a free port, without and with worker processes"""
+    server = gen_server._ThreadingHTTPServer(
+        ("127.0.0.1", 0), gen_server.GeneratorRequestHandler)
+    server.workers = request.param
+    if server.workers > 1:
+        server.pool = multiprocessing.Pool(server.workers,
+                                           gen_server._init_worker)
+    else:
+        server.pool = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    if server.pool is not None:
+        server.pool.terminate()
+        server.pool.join()
+
+
+def test_records_are_the_generated_instances(server_url):
+    records = list(gen_server.iter_remote_records(server_url, seed=2,
+                                                  offset=5, count=40))
+    assert [record["index"] for record in records] == list(range(5, 45))
+    for record in records:
+        instance_str, tags = gen.generate_instance(2, record["index"])
+        assert record["instance"] == instance_str
+        assert record["tags"] == [tag.value for tag in tags]
+        assert record["fname"] == gen._generate_file_name(
+            gen.generate_instance(2, record["index"],
+                                  tags_as_comments=False)[0])
+
+
+def test_records_do_not_depend_on_the_requests(server_url):
+    whole = list(gen_server.iter_remote_records(server_url, seed=0,
+                                                offset=0, count=60))
+    parts = []
+    for offset, end in ((0, 7), (7, 30), (30, 60)):
+        parts.extend(gen_server.iter_remote_records(
+            server_url, seed=0, offset=offset, count=end - offset))
+    assert parts == whole
+
+
+def test_options_select_the_instances(server_url):
+    records = list(gen_server.iter_remote_records(
+        server_url, seed=1, offset=0, count=20, taut_only=1,
+        cond_safe_ratio=0.5, variants="both"))
+    for record in records:
+        clean_str, tags = gen.generate_instance(
+            1, record["index"], include_cond_bufwrite=False,
+            cond_safe_ratio=0.5, tags_as_comments=False)
+        assert record["instance"] == clean_str
+        assert record["annotated"] == gen.annotate_instance(clean_str, tags)
+
+
+@pytest.mark.parametrize("query", ["count=10", "seed=0&count=-1",
+                                   "seed=0&count=1&variants=other",
+                                   "seed=0&count=1&taut_only=2"])
+def test_invalid_requests_are_rejected(server_url, query):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen("{}/records?{}".format(server_url, query))
+    assert error.value.code == 400
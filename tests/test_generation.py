@@ -0,0 +1,148 @@
+"""Determinism of the generated instances"""
+
+import collections
+import hashlib
+import random
+
+import pytest
+
+from sa_tag import Tag
+
+import validate
+from conftest import gen, read_dataset, read_tags, run_main
+
+# SHA-256 of the first 50 instances and tags of seed 0; changes whenever the
+# draws or the rendering change, i.e. when every existing dataset changes
+INSTANCES_DIGEST = \
+    "0517c0d7b0bd0eb099a1725bde4f66b610df6e14ae720346a9cb1ed1e2bc66d8"
+
+
+def _digest_instances(seed, num_instances, **gen_kwargs):
+    digest = hashlib.sha256()
+    for index in range(num_instances):
+        instance_str, tags = gen.generate_instance(seed, index, **gen_kwargs)
+        digest.update(instance_str.encode('utf-8'))
+        digest.update(bytes(tag.value for tag in tags))
+    return digest.hexdigest()
+
+
+def test_generate_instance_is_stable():
+    assert _digest_instances(0, 50) == INSTANCES_DIGEST
+    assert gen._generate_file_name(gen.generate_instance(
+        0, 0, tags_as_comments=False)[0]) == "f49956f561.c"
+
+
+def test_generate_instance_depends_on_seed_and_index_only():
+    first = gen.generate_instance(3, 17)
+    gen.generate_instance(3, 18)
+    assert gen.generate_instance(3, 17) == first
+    assert gen.generate_instance(4, 17) != first
+
+
+@pytest.mark.parametrize("gen_kwargs", [
+    {}, {"tags_as_comments": False},
+    {"cond_safe_ratio": 0.5, "taut_safe_ratio": 0.5}])
+def test_skeletons_equal_assembled_instances(gen_kwargs):
+    for include_cond_bufwrite in (True, False):
+        for index in range(300):
+            assert gen.generate_instance(
+                5, index, include_cond_bufwrite=include_cond_bufwrite,
+                skeletons=True, **gen_kwargs) == gen.generate_instance(
+                    5, index, include_cond_bufwrite=include_cond_bufwrite,
+                    **gen_kwargs)
+
+
+def test_workers_do_not_change_output(make_dir):
+    outdirs = []
+    for workers in (1, 3):
+        outdir = make_dir("workers-{}".format(workers))
+        run_main(outdir, "-num_instances", 600, "-workers", workers,
+                 "-metadata_file", outdir / "manifest.json")
+        outdirs.append(outdir)
+    assert read_dataset(outdirs[0]) == read_dataset(outdirs[1])
+    assert (read_tags(outdirs[0] / "manifest.json") ==
+            read_tags(outdirs[1] / "manifest.json"))
+
+
+def test_canonical_form_ignores_names_and_characters():
+    instance_str = gen.generate_instance(0, 3)[0]
+    renamed = instance_str.replace("entity_1", "entity_X").replace(
+        "entity_5", "entity_1").replace("entity_X", "entity_5")
+    renamed = renamed.replace("'c'", "'Q'")
+    assert renamed != instance_str
+    assert (gen.canonicalize_instance(renamed) ==
+            gen.canonicalize_instance(instance_str))
+
+
+def _bufwrite_tags(seed, num_instances, **gen_kwargs):
+    """Count the buffer write tags of some instances"""
+    counts = collections.Counter()
+    for index in range(num_instances):
+        instance_str, tags = gen.generate_instance(seed, index, **gen_kwargs)
+        assert validate.check_instance(
+            instance_str, [tag.value for tag in tags]) == []
+        counts.update(tag for tag in tags if tag.name.startswith("BUFWRITE"))
+    return counts
+
+
+@pytest.mark.parametrize("ratio", [0.0, 0.3, 0.8, 1.0])
+def test_safe_ratios_are_met(ratio):
+    counts = _bufwrite_tags(6, 3000, cond_safe_ratio=ratio,
+                            taut_safe_ratio=1 - ratio)
+    taut_ratio = counts[Tag.BUFWRITE_TAUT_SAFE] / (
+        counts[Tag.BUFWRITE_TAUT_SAFE] + counts[Tag.BUFWRITE_TAUT_UNSAFE])
+    assert counts[Tag.BUFWRITE_COND_SAFE] == int(3000 * ratio + 0.5)
+    # each instance is within one of its share, balanced across instances
+    assert abs(taut_ratio - (1 - ratio)) < 0.01
+
+
+@pytest.mark.parametrize("ratio", [0.1, 0.5, 2 / 3])
+def test_every_prefix_meets_the_cond_ratio(ratio):
+    num_safe = 0
+    for index in range(500):
+        _, tags = gen.generate_instance(3, index, cond_safe_ratio=ratio)
+        num_safe += Tag.BUFWRITE_COND_SAFE in tags
+        assert num_safe == int((index + 1) * ratio + 0.5)
+
+
+def test_len_idx_pairs_are_uniform_within_a_label():
+    rng = random.Random(0)
+    for safe in (True, False):
+        counts = collections.Counter(gen._sample_len_idx(safe, rng)
+                                     for _ in range(200000))
+        expected = {(buf_len, idx) for buf_len in range(gen.MAX_IDX)
+                    for idx in range(gen.MAX_IDX)
+                    if (idx < buf_len) == safe}
+        assert set(counts) == expected
+        # chi-square statistic, within 6 sigma of its mean
+        mean = 200000 / len(expected)
+        chi2 = sum((counts[pair] - mean) ** 2 / mean for pair in expected)
+        assert chi2 < len(expected) + 6 * (2 * len(expected)) ** 0.5
+
+
+def test_safe_ratios_out_of_range_are_rejected(make_dir):
+    outdir = make_dir("out")
+    with pytest.raises(ValueError):
+        run_main(outdir, "-num_instances", 10, "-cond_safe_ratio", 1.5)
+
+
+def test_variants_share_filenames_and_tags(make_dir):
+    runs = {}
+    for variants in gen.VARIANTS:
+        outdir = make_dir(variants)
+        run_main(outdir, "-num_instances", 200, "-variants", variants,
+                 "-metadata_file", outdir / "manifest.json")
+        runs[variants] = (read_dataset(outdir),
+                          read_tags(outdir / "manifest.json"))
+        if variants == "both":
+            both_annotated = read_dataset(outdir / gen.ANNOTATED_DIRNAME)
+    annotated, tags = runs["annotated"]
+    clean = runs["clean"][0]
+    assert runs["clean"][1] == runs["both"][1] == tags
+    assert runs["both"][0] == clean
+    assert both_annotated == annotated
+    for fname, tag_values in tags:
+        assert "//" not in clean[fname]
+        assert gen._generate_file_name(clean[fname]) == fname
+        assert annotated[fname] == gen.annotate_instance(
+            clean[fname], [Tag(value) for value in tag_values])
@@ -0,0 +1,25 @@
+"""Round trip of the cached columnar loader"""
+
+import loader
+import manifest
+
+
+def test_loader_round_trip(tmp_path, instances):
+    working_dir = tmp_path / "data"
+    working_dir.mkdir()
+    for fname, instance_str, _ in instances:
+        (working_dir / fname).write_text(instance_str)
+    metadata_file = str(working_dir / "manifest.json")
+    manifest.write_manifest(
+        metadata_file, str(working_dir), len(instances),
+        ((fname, tag_values) for (fname, _, tag_values) in instances))
+
+    for _ in range(2):  # builds, then maps the cache
+        with loader.load(metadata_file) as dataset:
+            assert len(dataset) == len(instances)
+            for i, (fname, instance_str, tag_values) in enumerate(instances):
+                assert dataset.fname(i) == fname
+                assert list(dataset.get_tags(i)) == tag_values
+                assert dataset.get_lines(i) == [
+                    line.split("//", 1)[0].rstrip()
+                    for line in instance_str.split("\n")]
@@ -0,0 +1,38 @@
+"""Manifest streams and the streaming manifest.json reader"""
+
+import json
+
+import manifest
+from conftest import run_main
+
+
+def test_stream_converts_to_json_dump_output(make_dir):
+    in_memory = make_dir("in_memory")
+    streamed = make_dir("streamed")
+    run_main(in_memory, "-num_instances", 300,
+             "-metadata_file", in_memory / "manifest.json")
+    run_main(streamed, "-num_instances", 300,
+             "-metadata_file", streamed / "manifest.json",
+             "-manifest_stream", streamed / "manifest.jsonl")
+
+    with open(str(in_memory / "manifest.json")) as f:
+        expected = f.read().replace(str(in_memory), str(streamed))
+    with open(str(streamed / "manifest.json")) as f:
+        assert f.read() == expected
+
+
+def test_iter_manifest_json_matches_json_load(make_dir, monkeypatch):
+    outdir = make_dir("out")
+    metadata_file = str(outdir / "manifest.json")
+    run_main(outdir, "-num_instances", 200, "-metadata_file", metadata_file)
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+
+    # chunks of 3 characters split keys, filenames and numbers
+    monkeypatch.setattr(manifest._JsonReader.__init__, "__defaults__", (3,))
+    header = {}
+    assert (list(manifest.iter_manifest_json(metadata_file, header)) ==
+            list(metadata["tags"].items()))
+    assert header == {key: value for (key, value) in metadata.items()
+                      if key != "tags"}
+    assert manifest.read_manifest_header(metadata_file) == header
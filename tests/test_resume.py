@@ -0,0 +1,52 @@
+"""Resumed runs equal uninterrupted ones"""
+
+import json
+
+import pytest
+
+from conftest import gen, read_run, run_main
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _interrupt_after(monkeypatch, num_records):
+    """Make the next run fail after generating num_records records"""
+    iter_records = gen._iter_records
+
+    def interrupted(*args, **kwargs):
+        records = iter_records(*args, **kwargs)
+        for _ in range(num_records):
+            yield next(records)
+        records.close()
+        raise _Interrupted()
+
+    monkeypatch.setattr(gen, "_iter_records", interrupted)
+
+
+@pytest.mark.parametrize("extra_args", [(), ("-num_shards", 2),
+                                        ("--canonical_dedup",)])
+def test_resume_equals_uninterrupted_run(make_dir, monkeypatch, extra_args):
+    reference = make_dir("reference")
+    run_main(reference, "-num_instances", 500,
+             "-metadata_file", reference / "manifest.json", *extra_args)
+
+    resumed = make_dir("resumed")
+    argv = ["-num_instances", 500, "-metadata_file", resumed / "manifest.json",
+            "-checkpoint_file", resumed / "checkpoint.json",
+            "-checkpoint_every", 100] + list(extra_args)
+    _interrupt_after(monkeypatch, 250)
+    with pytest.raises(_Interrupted):
+        run_main(resumed, *argv)
+    monkeypatch.undo()
+    with open(str(resumed / "checkpoint.json")) as f:
+        assert json.load(f)["num_written"] == 200
+
+    run_main(resumed, "--resume", *argv)
+    if extra_args and extra_args[0] == "-num_shards":
+        for name in ("shard-00000.dat", "shard-00000.idx",
+                     "shard-00001.dat", "shard-00001.idx"):
+            assert ((resumed / name).read_bytes() ==
+                    (reference / name).read_bytes())
+    assert read_run(resumed) == read_run(reference)
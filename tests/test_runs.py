@@ -0,0 +1,50 @@
+"""Interrupted runs stop at once"""
+
+import threading
+import time
+
+import writers
+from conftest import gen, run_main
+
+# records of the indices from which _stalled_record never returns
+_STALL_INDEX = 600
+
+
+def _stalled_record(task):
+    """_generate_record of a worker killed in the middle of a batch"""
+    if task[1] >= _STALL_INDEX:
+        time.sleep(3600)
+    return _generate_record(task)
+
+
+_generate_record = gen._generate_record
+
+
+def test_interrupted_workers_stop_at_once(make_dir, monkeypatch):
+    # the batch of indices 512 to 1023 is in flight and never completes,
+    # as after a Ctrl-C which also killed the workers
+    monkeypatch.setattr(gen, "_generate_record", _stalled_record)
+    write = writers.FileWriter.write
+    num_written = []
+
+    def interrupted_write(self, *args):
+        if len(num_written) == 100:
+            raise KeyboardInterrupt()
+        num_written.append(1)
+        return write(self, *args)
+
+    outdir = make_dir("out")
+    errors = []
+
+    def run():
+        try:
+            run_main(outdir, "-num_instances", 1000, "-workers", 2)
+        except KeyboardInterrupt as error:
+            errors.append(error)
+
+    monkeypatch.setattr(writers.FileWriter, "write", interrupted_write)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert len(errors) == 1
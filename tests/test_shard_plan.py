@@ -0,0 +1,92 @@
+"""Runs split into slices by shard_plan and merged back"""
+
+import argparse
+
+import pytest
+
+import manifest
+import shard_plan
+from conftest import gen, read_dataset, run_main
+
+
+def test_slices_split_the_run():
+    slices = shard_plan.plan_slices(3, 1001, 4)
+    assert sum(slice_args["num_instances"] for slice_args in slices) == 1001
+    assert ([slice_args["index_offset"] for slice_args in slices] ==
+            [0, 1, 2, 3])
+    assert all(slice_args["index_stride"] == 4 and slice_args["seed"] == 3
+               for slice_args in slices)
+    with pytest.raises(ValueError):
+        shard_plan.plan_slices(3, 1001, 0)
+
+
+def _run_slices(outdir, num_instances, num_slices):
+    """Run every slice of a plan into outdir; get their stream paths"""
+    stream_paths = []
+    for slice_num, slice_args in enumerate(
+            shard_plan.plan_slices(0, num_instances, num_slices)):
+        stream_path = outdir / (shard_plan.SLICE_STREAM_STR % slice_num)
+        run_main(outdir, "-seed", slice_args["seed"],
+                 "-num_instances", slice_args["num_instances"],
+                 "-index_offset", slice_args["index_offset"],
+                 "-index_stride", slice_args["index_stride"],
+                 "-manifest_stream", stream_path)
+        stream_paths.append(str(stream_path))
+    return stream_paths
+
+
+def _merge(stream_paths, metadata_file):
+    return shard_plan.main(argparse.Namespace(
+        command='merge', metadata_file=str(metadata_file),
+        manifest_streams=stream_paths, seed=0, working_dir=None,
+        taut_only=False, cond_safe_ratio=None, taut_safe_ratio=None,
+        variants=gen.DEFAULT_VARIANTS))
+
+
+def test_merge_keeps_every_slice_in_index_order(make_dir):
+    outdir = make_dir("out")
+    stream_paths = _run_slices(outdir, 300, 3)
+    merged_path = str(outdir / "merged.jsonl")
+    num_records, num_duplicates, next_index = shard_plan.merge_streams(
+        stream_paths, merged_path)
+
+    records = list(manifest.iter_manifest_stream(merged_path))
+    slice_records = [record for path in stream_paths
+                     for record in manifest.iter_manifest_stream(path)]
+    assert len(records) == num_records == 300 - num_duplicates
+    indices = [index for (_, index, _) in records]
+    assert indices == sorted(indices)
+    assert next_index == max(index for (_, index, _) in slice_records) + 1
+    assert len({fname for (fname, _, _) in records}) == num_records
+    assert ({fname for (fname, _, _) in records} ==
+            {fname for (fname, _, _) in slice_records})
+    for fname, index, tag_values in records[:30]:
+        instance_str, tags = gen.generate_instance(0, index)
+        assert tag_values == [tag.value for tag in tags]
+        assert gen._generate_file_name(gen.generate_instance(
+            0, index, tags_as_comments=False)[0]) == fname
+
+
+def test_merge_rejects_a_stream_passed_twice(make_dir):
+    outdir = make_dir("out")
+    stream_paths = _run_slices(outdir, 20, 2)
+    with pytest.raises(ValueError):
+        shard_plan.merge_streams(stream_paths + stream_paths[:1],
+                                 str(outdir / "merged.jsonl"))
+
+
+def test_append_continues_a_merged_run(make_dir):
+    outdir = make_dir("out")
+    metadata_file = outdir / "manifest.json"
+    _merge(_run_slices(outdir, 200, 4), metadata_file)
+    header = manifest.read_manifest_header(str(metadata_file))
+    assert header["seed"] == 0 and header["index_stride"] == 1
+
+    run_main(outdir, "-num_instances", 100, "--append",
+             "-metadata_file", metadata_file,
+             "-manifest_stream", str(metadata_file) + ".jsonl")
+    tags = dict(manifest.iter_manifest_tags(str(metadata_file)))
+    assert len(tags) == header["num_instances"] + 100
+    assert set(tags) == set(read_dataset(outdir))
+    assert manifest.read_manifest_header(str(metadata_file))[
+        "next_index"] >= header["next_index"] + 100
@@ -0,0 +1,34 @@
+"""Round trips of sharded container output"""
+
+import shards
+from conftest import gen
+
+
+def test_shard_round_trip(tmp_path, monkeypatch, instances):
+    # several sorted runs per shard index
+    monkeypatch.setattr(shards, "SORT_RUN_ENTRIES", 16)
+    with shards.ShardWriter(str(tmp_path), 3, gen.FNAME_HASHLEN) as writer:
+        for fname, instance_str, tag_values in instances:
+            writer.write(fname, instance_str, tag_values)
+
+    with shards.ShardReader(str(tmp_path)) as reader:
+        assert len(reader) == len(instances)
+        for fname, instance_str, tag_values in instances:
+            assert reader.get(fname) == (instance_str, tag_values)
+        assert sorted(reader) == sorted(instances)
+        assert "0000000000.c" not in reader
+
+
+def test_sort_runs_longer_than_a_merge_read(tmp_path, monkeypatch):
+    # 5000 entries of 17 bytes a run, i.e. entries across 64 KiB boundaries
+    monkeypatch.setattr(shards, "SORT_RUN_ENTRIES", 5000)
+    fnames = ["{:010x}.c".format(key * 2654435761 % (1 << 40))
+              for key in range(12000)]
+    with shards.ShardWriter(str(tmp_path), 1, gen.FNAME_HASHLEN) as writer:
+        for key, fname in enumerate(fnames):
+            writer.write(fname, str(key), [key % 7])
+
+    with shards.ShardReader(str(tmp_path)) as reader:
+        assert len(reader) == len(fnames)
+        for key, fname in enumerate(fnames):
+            assert reader.get(fname) == (str(key), [key % 7])
@@ -0,0 +1,53 @@
+"""Run stats of --stats"""
+
+import io
+import json
+import os
+
+import run_stats
+from conftest import run_main
+
+
+def test_run_stats_count_the_run(make_dir):
+    outdir = make_dir("out")
+    run_main(outdir, "-num_instances", 300, "-workers", 2,
+             "-metadata_file", outdir / "manifest.json", "--stats")
+    with open(str(outdir / run_stats.STATS_FNAME)) as f:
+        stats = json.load(f)
+
+    counters = stats["counters"]
+    assert counters["instances"] == 300
+    assert counters["attempts"] == 300 + counters.get("collisions", 0)
+    assert counters["bytes_written"] == sum(
+        os.path.getsize(str(path)) for path in outdir.iterdir()
+        if path.name.endswith(".c"))
+    # instance stages are timed in the workers, the others in main()
+    assert set(stats["stages"]) == {"sampling", "assembly", "render",
+                                    "hashing", "generate", "write",
+                                    "metadata"}
+    assert all(seconds >= 0 for seconds in stats["stages"].values())
+    assert stats["inst_per_sec"] > 0
+
+
+def test_progress_reports_rate_and_eta():
+    out = io.StringIO()
+    stats = run_stats.RunStats(10, out=out, interval=0)
+    stats.progress(0)
+    for num_written in range(1, 5):
+        stats.count("instances")
+        stats.split("write")
+        stats.progress(num_written)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 5
+    assert lines[-1].startswith("4/10 instances, ")
+    assert "inst/s, ETA " in lines[-1]
+
+
+def test_progress_waits_for_the_interval():
+    out = io.StringIO()
+    stats = run_stats.RunStats(10, out=out, interval=3600)
+    for num_written in range(1, 5):
+        stats.count("instances")
+        stats.split("write")
+        stats.progress(num_written)
+    assert out.getvalue() == ""
@@ -0,0 +1,21 @@
+"""Round trip of the binary tag store"""
+
+import pytest
+
+import tag_store
+from conftest import gen
+
+
+def test_tag_store_round_trip(tmp_path, instances):
+    path = str(tmp_path / "tags.bin")
+    tag_store.write_tag_store(
+        path, ((fname, tag_values) for (fname, _, tag_values) in instances),
+        gen.FNAME_HASHLEN)
+    with tag_store.TagStore(path) as store:
+        assert len(store) == len(instances)
+        for i, (fname, _, tag_values) in enumerate(instances):
+            assert store.fname(i) == fname
+            assert list(store.get_tags(i)) == tag_values
+            assert store.index(fname) == i
+        with pytest.raises(KeyError):
+            store.index("0000000000.c")
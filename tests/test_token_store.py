@@ -0,0 +1,19 @@
+"""Round trip of the pre-tokenized token store"""
+
+import token_store
+from conftest import gen
+
+
+def test_token_store_round_trip(tmp_path, instances):
+    path = str(tmp_path / "tokens.bin")
+    with token_store.TokenStoreWriter(path, gen.FNAME_HASHLEN) as writer:
+        for fname, instance_str, tag_values in instances:
+            writer.write(fname, instance_str, tag_values)
+    with token_store.TokenStore(path) as store:
+        assert len(store) == len(instances)
+        for i, (fname, instance_str, tag_values) in enumerate(instances):
+            assert store.fname(i) == fname
+            assert list(store.get_tags(i)) == tag_values
+            assert [list(line) for line in store.get_lines(i)] == [
+                token_store.tokenize_line(line)
+                for line in instance_str.split("\n")]
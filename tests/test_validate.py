@@ -0,0 +1,42 @@
+"""The validator agrees with the generator and catches wrong tags"""
+
+from sa_tag import Tag
+
+import validate
+from conftest import gen
+
+_FLIPPED = {
+    Tag.BUFWRITE_COND_SAFE.value: Tag.BUFWRITE_COND_UNSAFE.value,
+    Tag.BUFWRITE_COND_UNSAFE.value: Tag.BUFWRITE_COND_SAFE.value,
+    Tag.BUFWRITE_TAUT_SAFE.value: Tag.BUFWRITE_TAUT_UNSAFE.value,
+    Tag.BUFWRITE_TAUT_UNSAFE.value: Tag.BUFWRITE_TAUT_SAFE.value
+}
+
+
+def _instances(num_instances):
+    for index in range(num_instances):
+        instance_str, tags = gen.generate_instance(2, index)
+        yield instance_str, [tag.value for tag in tags]
+
+
+def test_generated_tags_validate():
+    for instance_str, tag_values in _instances(300):
+        assert validate.check_instance(instance_str, tag_values) == []
+
+
+def test_flipped_tags_are_detected():
+    for instance_str, tag_values in _instances(100):
+        line_num = next(line_num for (line_num, tag_value)
+                        in enumerate(tag_values) if tag_value in _FLIPPED)
+        corrupted = list(tag_values)
+        corrupted[line_num] = _FLIPPED[corrupted[line_num]]
+        mismatches = validate.check_instance(instance_str, corrupted)
+        assert [mismatch[0] for mismatch in mismatches] == [line_num + 1]
+
+
+def test_bufwrite_tag_on_another_line_is_detected():
+    instance_str, tag_values = next(_instances(1))
+    corrupted = list(tag_values)
+    corrupted[tag_values.index(Tag.BODY.value)] = \
+        Tag.BUFWRITE_TAUT_SAFE.value
+    assert validate.check_instance(instance_str, corrupted)
@@ -0,0 +1,49 @@
+"""The pipelined writer writes what the plain writer writes"""
+
+import pytest
+
+import writers
+from conftest import gen, read_dataset
+
+
+def _instances(num_instances):
+    for index in range(num_instances):
+        instance_str, tags = gen.generate_instance(1, index)
+        yield (gen._generate_file_name(instance_str), instance_str,
+               [tag.value for tag in tags])
+
+
+@pytest.mark.parametrize("fsync", [False, True])
+def test_pipelined_writer_equals_file_writer(make_dir, fsync):
+    plain = make_dir("plain")
+    pipelined = make_dir("pipelined")
+    with writers.FileWriter(str(plain)) as writer:
+        for instance in _instances(300):
+            writer.write(*instance)
+    # a queue shorter than a batch, so that write() blocks
+    with writers.PipelinedFileWriter(str(pipelined), 3, 8, fsync) as writer:
+        for (i, instance) in enumerate(_instances(300)):
+            assert writer.write(*instance) == len(instance[1])
+            if i == 150:
+                assert writer.sync() is None
+                assert len(read_dataset(pipelined)) == 151
+    assert read_dataset(pipelined) == read_dataset(plain)
+
+
+def test_writer_thread_error_is_raised(tmp_path):
+    writer = writers.PipelinedFileWriter(str(tmp_path / "missing"), 2, 8)
+    writer.write(*next(_instances(1)))
+    with pytest.raises(OSError):
+        writer.close()
+
+
+def test_error_of_the_with_block_is_kept(tmp_path):
+    class _Failed(Exception):
+        pass
+
+    with pytest.raises(_Failed):
+        with writers.PipelinedFileWriter(str(tmp_path / "missing"), 2,
+                                         8) as writer:
+            writer.write(*next(_instances(1)))
+            writer._queue.join()  # the writer thread has failed
+            raise _Failed()